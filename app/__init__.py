@@ -2,6 +2,9 @@ from flask import Flask
 from .config import Config
 from .routes import init_routes
 from .utils.logger import logger
+from .utils.http_client import http_client
+from .utils.readiness import ReadinessProbe
+from .wechat.accounts import AccountRegistry
 
 def create_app():
     app = Flask(__name__)
@@ -10,17 +13,33 @@ def create_app():
     # 记录应用启动日志
     logger.info('WeChat Backend Application Starting...')
 
-    # 初始化token管理器
-    with app.app_context():
-        from .wechat.token_manager import TokenManager
-        token_manager = TokenManager(app.config['TOKEN_FILE_PATH'])
-        if not token_manager.access_token:
-            token_manager.refresh_token(
-                app.config['WECHAT_APPID'],
-                app.config['WECHAT_APPSECRET']
-            )
-        # 将token_manager附加到app对象
-        app.token_manager = token_manager
+    # 配置共享HTTP连接池
+    http_client.configure(
+        pool_connections=app.config['HTTP_POOL_CONNECTIONS'],
+        pool_maxsize=app.config['HTTP_POOL_MAXSIZE'],
+        max_retries=app.config['HTTP_MAX_RETRIES']
+    )
+
+    # 启动过程不访问网络：token获取与连接预热都在后台进行，就绪状态通过/readyz查询
+    readiness = ReadinessProbe(required_kinds=app.config['READINESS_REQUIRED'])
+    app.readiness = readiness
+
+    # 初始化公众号（单公众号使用WECHAT_*配置，多公众号从ACCOUNTS_FILE加载）及其token管理器
+    accounts = AccountRegistry.from_config(app.config)
+    for account in accounts:
+        token_manager = account.token_manager
+        # 文件中没有有效token时后台刷新立即执行，否则在过期前刷新；发送路径不再同步等待刷新
+        token_manager.start_background_refresh(
+            account.appid,
+            account.appsecret,
+            margin=app.config['TOKEN_REFRESH_MARGIN'],
+            jitter=app.config['TOKEN_REFRESH_JITTER']
+        )
+        readiness.add(f"token:{account.appid}", 'token', check=account.token_status)
+    app.accounts = accounts
+    # 默认公众号（/wechat路由）的token_manager
+    app.token_manager = accounts.default.token_manager if accounts.default is not None else None
 
     init_routes(app)
+    readiness.start()
     return app
\ No newline at end of file
@@ -5,10 +5,22 @@ class Config:
     WECHAT_AES_KEY = os.getenv('WECHAT_AES_KEY', 'your_aes_key')
     WECHAT_APPID = os.getenv('WECHAT_APPID', 'your_appid')
     WECHAT_APPSECRET = os.getenv('WECHAT_APPSECRET', 'your_appsecret')
+    # 多公众号配置文件（JSON数组，每项含appid/appsecret/token/aes_key），设置后通过 /wechat/<appid> 接入，
+    # /wechat 对应appid等于WECHAT_APPID的公众号
+    ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE', '')
+    # 每个公众号的默认配额（0表示不限）：外部服务排队+执行中的请求数、客服消息排队条数
+    ACCOUNT_MAX_PENDING = int(os.getenv('ACCOUNT_MAX_PENDING', 0))
+    ACCOUNT_MAX_QUEUED = int(os.getenv('ACCOUNT_MAX_QUEUED', 0))
+    # 微信API地址（压测或内网代理时可替换为本地地址）
+    WECHAT_API_BASE = os.getenv('WECHAT_API_BASE', 'https://api.weixin.qq.com').rstrip('/')
+    # 多个后端节点以逗号分隔，可用 "|权重" 指定权重，如 http://node1/api|2,http://node2/api
     EXTERNAL_SERVICE_URL = os.getenv('EXTERNAL_SERVICE_URL', 'http://default-service/api/wechat')
     EXTERNAL_SERVICE_TIMEOUT = int(os.getenv('EXTERNAL_SERVICE_TIMEOUT', 5))
     EXTERNAL_SERVICE_TYPE = os.getenv('EXTERNAL_SERVICE_TYPE', 'default').lower()
     TOKEN_FILE_PATH = os.getenv('TOKEN_FILE_PATH', '/app/data/access_token.json')
+    TOKEN_FILE_CHECK_INTERVAL = float(os.getenv('TOKEN_FILE_CHECK_INTERVAL', 1.0))
+    TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', 600))
+    TOKEN_REFRESH_JITTER = int(os.getenv('TOKEN_REFRESH_JITTER', 120))
     EXTERNAL_SERVICE_TIMEOUT_MSG = os.getenv(
         'EXTERNAL_SERVICE_TIMEOUT_MSG',
         '请求处理超时，请稍后再试'
@@ -16,4 +28,121 @@ class Config:
     EXTERNAL_SERVICE_ERROR_MSG = os.getenv(
         'EXTERNAL_SERVICE_ERROR_MSG',
         '服务暂时不可用，请稍后重试'
-    )
\ No newline at end of file
+    )
+    EXTERNAL_SERVICE_BUSY_MSG = os.getenv(
+        'EXTERNAL_SERVICE_BUSY_MSG',
+        '当前咨询人数较多，请稍后再试'
+    )
+    # 外部服务线程池与准入控制（排队+执行中的请求数上限，超出时直接回复繁忙提示）
+    EXTERNAL_SERVICE_MAX_WORKERS = int(os.getenv('EXTERNAL_SERVICE_MAX_WORKERS', 10))
+    EXTERNAL_SERVICE_MAX_PENDING = int(os.getenv('EXTERNAL_SERVICE_MAX_PENDING', 100))
+    # 后端节点连续失败EJECT_FAILURES次后摘除EJECT_SECONDS秒
+    EXTERNAL_SERVICE_EJECT_FAILURES = int(os.getenv('EXTERNAL_SERVICE_EJECT_FAILURES', 5))
+    EXTERNAL_SERVICE_EJECT_SECONDS = float(os.getenv('EXTERNAL_SERVICE_EJECT_SECONDS', 30))
+    # 对冲请求：首个请求超过该时间（秒）未返回时向另一个节点再发一次，0表示关闭
+    EXTERNAL_SERVICE_HEDGE_DELAY = float(os.getenv('EXTERNAL_SERVICE_HEDGE_DELAY', 0))
+    # 熔断配置：最近WINDOW秒内请求数达到MIN_REQUESTS且失败率（或慢调用比例）超过阈值时熔断OPEN_SECONDS秒
+    CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_BREAKER_WINDOW = int(os.getenv('CIRCUIT_BREAKER_WINDOW', 30))
+    CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv('CIRCUIT_BREAKER_MIN_REQUESTS', 20))
+    CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv('CIRCUIT_BREAKER_ERROR_RATE', 0.5))
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_SECONDS', 0))  # 0表示不统计慢调用
+    CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_RATE', 0.5))
+    CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', 30))
+    # HTTP连接池配置
+    HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 10))
+    HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 1))
+    # 服务进程配置：gunicorn -c gunicorn.conf.py run:app（每个worker为独立进程，各自创建线程池与连接池）
+    SERVER_BIND = os.getenv('SERVER_BIND', '0.0.0.0:80')
+    # 消息去重、限流、合并与响应缓存均为进程内状态：多个worker时微信重试的同一条消息可能落到不同worker被重复处理，
+    # 客服消息配额也会放大为worker数倍，因此默认单进程（靠SERVER_THREADS扩展并发）
+    SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 1))
+    # 每个worker的请求线程数；被动回复最长占用请求线程约PASSIVE_REPLY_BUDGET秒
+    SERVER_THREADS = int(os.getenv('SERVER_THREADS', 32))
+    SERVER_TIMEOUT = int(os.getenv('SERVER_TIMEOUT', 30))
+    # 客户端keep-alive秒数：gthread worker停止时会等待空闲的keep-alive连接，可能占满SERVER_GRACEFUL_TIMEOUT，
+    # 来不及发送剩余的回复；前面有nginx等反向代理时保持0
+    SERVER_KEEPALIVE = int(os.getenv('SERVER_KEEPALIVE', 0))
+    # 停止时等待进行中的回复发送完成的时间，应小于SERVER_GRACEFUL_TIMEOUT
+    SERVER_GRACEFUL_TIMEOUT = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30))
+    SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 20))
+    # 启动预热：后台预先建立到微信API与各后端节点的连接，结束前/readyz返回503
+    WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+    WARMUP_CONNECTIONS = int(os.getenv('WARMUP_CONNECTIONS', 2))
+    WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 5))
+    # 必须可用才就绪的依赖类型（token/wechat_api/backend），其余只在/readyz中报告状态
+    READINESS_REQUIRED = [t.strip().lower() for t in os.getenv('READINESS_REQUIRED', 'token').split(',') if t.strip()]
+
+    # 消息去重配置（微信重试去重）
+    DEDUP_TTL = int(os.getenv('DEDUP_TTL', 60))
+    DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', 10000))
+
+    # 被动回复配置（在微信5秒窗口内直接返回结果）
+    PASSIVE_REPLY_ENABLED = os.getenv('PASSIVE_REPLY_ENABLED', 'false').lower() == 'true'
+    PASSIVE_REPLY_BUDGET = float(os.getenv('PASSIVE_REPLY_BUDGET', 4.2))
+
+    # 连续消息合并：同一用户在静默窗口内发送的多条文本消息合并为一次外部服务调用
+    COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', 'false').lower() == 'true'
+    COALESCE_QUIET_WINDOW = float(os.getenv('COALESCE_QUIET_WINDOW', 1.5))
+    COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', 5.0))
+    COALESCE_MAX_FRAGMENTS = int(os.getenv('COALESCE_MAX_FRAGMENTS', 10))
+
+    # 图片/语音消息的媒体处理：下载到本地磁盘缓存后交给外部服务（openai/ollama内联base64，其余为文件引用）
+    MEDIA_ENABLED = os.getenv('MEDIA_ENABLED', 'false').lower() == 'true'
+    MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '/app/data/media')
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    MEDIA_MAX_FILE_BYTES = int(os.getenv('MEDIA_MAX_FILE_BYTES', 10 * 1024 * 1024))
+    MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 4))
+    MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', 10))
+    MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', 64 * 1024))
+    # 临时素材下载失败时允许改用PicUrl下载的域名（含子域名，仅https）
+    MEDIA_PICURL_HOSTS = [h.strip().lower() for h in os.getenv('MEDIA_PICURL_HOSTS', 'qpic.cn').split(',') if h.strip()]
+    MEDIA_ERROR_MSG = os.getenv('MEDIA_ERROR_MSG', '图片/语音获取失败，请稍后重试')
+    # openai/ollama收到没有语音识别结果（Recognition为空）的语音消息时的回复
+    MEDIA_VOICE_UNRECOGNIZED_MSG = os.getenv('MEDIA_VOICE_UNRECOGNIZED_MSG', '未能识别语音内容，请重新发送或改用文字')
+
+    # 响应缓存配置（仅对列出的服务类型生效）
+    RESPONSE_CACHE_SERVICE_TYPES = [t.strip().lower() for t in os.getenv('RESPONSE_CACHE_SERVICE_TYPES', '').split(',') if t.strip()]
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+    RESPONSE_CACHE_NORMALIZE = [t.strip().lower() for t in os.getenv('RESPONSE_CACHE_NORMALIZE', 'whitespace,case,width').split(',') if t.strip()]
+    RESPONSE_CACHE_IGNORE_FIELDS = [t.strip() for t in os.getenv('RESPONSE_CACHE_IGNORE_FIELDS', 'user_id,timestamp,session_id,metadata').split(',') if t.strip()]
+
+    # 对话上下文配置（openai/ollama映射器）
+    CONVERSATION_ENABLED = os.getenv('CONVERSATION_ENABLED', 'false').lower() == 'true'
+    CONVERSATION_MAX_TURNS = int(os.getenv('CONVERSATION_MAX_TURNS', 6))
+    CONVERSATION_MAX_USERS = int(os.getenv('CONVERSATION_MAX_USERS', 100000))
+    CONVERSATION_MAX_TOTAL_CHARS = int(os.getenv('CONVERSATION_MAX_TOTAL_CHARS', 20 * 1024 * 1024))
+    CONVERSATION_IDLE_TTL = int(os.getenv('CONVERSATION_IDLE_TTL', 1800))
+    CONVERSATION_PROMPT_CHAR_BUDGET = int(os.getenv('CONVERSATION_PROMPT_CHAR_BUDGET', 4000))
+
+    # 流式消息推送配置（openai/ollama）
+    EXTERNAL_SERVICE_STREAM = os.getenv('EXTERNAL_SERVICE_STREAM', 'false').lower() == 'true'
+    STREAM_SEGMENT_MAX_BYTES = int(os.getenv('STREAM_SEGMENT_MAX_BYTES', 2000))
+    STREAM_SEGMENT_MIN_CHARS = int(os.getenv('STREAM_SEGMENT_MIN_CHARS', 60))
+
+    # 客服消息发送调度配置
+    # 发送速率与突发容量按公众号（appid）计算，多公众号时可在公众号配置文件中用send_rate/send_burst覆盖
+    CUSTOM_MESSAGE_RATE = float(os.getenv('CUSTOM_MESSAGE_RATE', 50))
+    CUSTOM_MESSAGE_BURST = int(os.getenv('CUSTOM_MESSAGE_BURST', 100))
+    CUSTOM_MESSAGE_QUEUE_SIZE = int(os.getenv('CUSTOM_MESSAGE_QUEUE_SIZE', 5000))
+    CUSTOM_MESSAGE_ENQUEUE_TIMEOUT = float(os.getenv('CUSTOM_MESSAGE_ENQUEUE_TIMEOUT', 1.0))
+    CUSTOM_MESSAGE_WORKERS = int(os.getenv('CUSTOM_MESSAGE_WORKERS', 20))
+    # 发送失败后的重试：带抖动的指数退避，等待期间不占用发送线程
+    CUSTOM_MESSAGE_MAX_ATTEMPTS = int(os.getenv('CUSTOM_MESSAGE_MAX_ATTEMPTS', 3))
+    CUSTOM_MESSAGE_RETRY_BASE = float(os.getenv('CUSTOM_MESSAGE_RETRY_BASE', 1.0))
+    CUSTOM_MESSAGE_RETRY_MAX_DELAY = float(os.getenv('CUSTOM_MESSAGE_RETRY_MAX_DELAY', 30))
+    # 不可重试的错误码（逗号分隔），为空时使用内置列表
+    CUSTOM_MESSAGE_FATAL_ERRCODES = [int(c) for c in os.getenv('CUSTOM_MESSAGE_FATAL_ERRCODES', '').split(',') if c.strip()]
+
+    # 持久化出站队列配置（重启后恢复未完成的回复）
+    OUTBOX_ENABLED = os.getenv('OUTBOX_ENABLED', 'false').lower() == 'true'
+    OUTBOX_PATH = os.getenv('OUTBOX_PATH', '/app/data/outbox.db')
+    OUTBOX_FLUSH_INTERVAL = float(os.getenv('OUTBOX_FLUSH_INTERVAL', 0.05))
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 256))
+    OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', 86400))
+    # 多进程共用同一文件时，进程退出（或崩溃）后其未完成的任务在租约过期后由其他进程重放
+    OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 30))
+    # 同一条记录最多重放的次数（投递被拒绝或重放失败后每个租约周期重试一次），超过后保留为死信
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
\ No newline at end of file
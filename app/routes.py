@@ -1,29 +1,338 @@
 from flask import request, current_app
-from app.wechat.crypto import WeChatCrypto
 from app.wechat.handler import MessageHandler
-from app.utils.logger import logger
-from app.wechat.external_service import ExternalServiceAdapter, default_request_mapper, default_response_mapper, AsyncResponseHandler, openai_request_mapper, openai_response_mapper, ollama_request_mapper, ollama_response_mapper, custom_request_mapper, custom_response_mapper
+from app.wechat.envelope import parse_envelope
+from app.wechat.dedup import MessageDeduplicator
+from app.wechat.coalescer import MessageCoalescer
+from app.wechat.conversation import conversation_store
+from app.utils.logger import log_stats, logger, payload_logging_enabled
+from app.utils.http_client import http_client
+from app.utils.metrics import metrics, request_seconds, stage_seconds
+from app.utils.scheduler import RetryPolicy, deadline_timer
+from app.utils.circuit_breaker import OPEN, CircuitBreakerRegistry
+from app.utils.load_balancer import EndpointPool, parse_endpoints
+from app.utils.readiness import FAILED, OK
+from app.wechat.external_service import SERVICE_MAPPERS, ExternalServiceAdapter, ResponseCache, default_request_mapper, default_response_mapper, AsyncResponseHandler, CUSTOM_MESSAGE_FATAL_ERRCODES, MEDIA_INLINE_SERVICE_TYPES
+from app.wechat.media import MediaCache, MediaPipeline
+from app.wechat.outbox import DurableOutbox
+from app.wechat.dispatcher import OutboundDispatcher
+import json
 import time
 import xml.etree.ElementTree as ET
-import random
-import string
+
+def _dispatcher_pool_stats(dispatcher):
+    stats = dispatcher.stats()
+    return {'executor_queue_depth': stats['dispatch_queue_length'], 'executor_active_workers': stats['dispatch_active']}
+
+def _endpoint_status(endpoint, breaker):
+    """后端节点的就绪状态：被摘除或熔断时为failed，预热失败后恢复服务时为ok，否则沿用预热结果"""
+    if endpoint.ejected_until > time.monotonic():
+        return FAILED, 'ejected'
+    if breaker is not None and breaker.state == OPEN:
+        return FAILED, 'circuit open'
+    if endpoint.requests and endpoint.consecutive_failures == 0:
+        return OK, f"serving ({endpoint.requests} requests)"
+    return None
+
+def _wait_idle(is_idle, timeout: float, interval: float = 0.05) -> bool:
+    """轮询等待is_idle()连续两次为True（覆盖外部服务调用结束到客服消息入队之间的间隙），超时返回False"""
+    deadline = time.monotonic() + timeout
+    streak = 0
+    while streak < 2:
+        streak = streak + 1 if is_idle() else 0
+        if streak < 2:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+    return True
 
 def init_routes(app):
-    crypto = WeChatCrypto(
-        app.config['WECHAT_TOKEN'],
-        app.config['WECHAT_AES_KEY'],
-        app.config['WECHAT_APPID']
+    accounts = app.accounts
+
+    outbox = None
+    if app.config['OUTBOX_ENABLED']:
+        outbox = DurableOutbox(
+            app.config['OUTBOX_PATH'],
+            flush_interval=app.config['OUTBOX_FLUSH_INTERVAL'],
+            batch_size=app.config['OUTBOX_BATCH_SIZE'],
+            retention=app.config['OUTBOX_RETENTION'],
+            lease=app.config['OUTBOX_LEASE'],
+            max_attempts=app.config['OUTBOX_MAX_ATTEMPTS']
+        )
+    app.outbox = outbox
+
+    # 所有公众号共用一个客服消息调度器（线程与队列），每个公众号使用自己的令牌桶并只占用自己的排队配额
+    dispatcher = OutboundDispatcher(
+        workers=app.config['CUSTOM_MESSAGE_WORKERS'],
+        rate=app.config['CUSTOM_MESSAGE_RATE'],
+        burst=app.config['CUSTOM_MESSAGE_BURST'],
+        max_queue=app.config['CUSTOM_MESSAGE_QUEUE_SIZE'],
+        enqueue_timeout=app.config['CUSTOM_MESSAGE_ENQUEUE_TIMEOUT'],
+        name='custom-send',
+        retry_policy=RetryPolicy(
+            max_attempts=app.config['CUSTOM_MESSAGE_MAX_ATTEMPTS'],
+            base=app.config['CUSTOM_MESSAGE_RETRY_BASE'],
+            max_delay=app.config['CUSTOM_MESSAGE_RETRY_MAX_DELAY'],
+            fatal_errcodes=app.config['CUSTOM_MESSAGE_FATAL_ERRCODES'] or CUSTOM_MESSAGE_FATAL_ERRCODES
+        )
+    )
+    for account in accounts:
+        account.async_handler = AsyncResponseHandler(
+            account.token_manager,
+            appid=account.appid,
+            appsecret=account.appsecret,
+            outbox=outbox,
+            api_base=app.config['WECHAT_API_BASE'],
+            max_workers=app.config['CUSTOM_MESSAGE_WORKERS'],
+            dispatcher=dispatcher,
+            max_queued=account.max_queued,
+            rate=app.config['CUSTOM_MESSAGE_RATE'] if account.send_rate is None else account.send_rate,
+            burst=app.config['CUSTOM_MESSAGE_BURST'] if account.send_burst is None else account.send_burst
+        )
+    default_account = accounts.default
+    async_handler = default_account.async_handler if default_account is not None else None
+    app.async_handler = async_handler
+    response_cache = ResponseCache(
+        service_types=app.config['RESPONSE_CACHE_SERVICE_TYPES'],
+        ttl=app.config['RESPONSE_CACHE_TTL'],
+        max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+        normalize=app.config['RESPONSE_CACHE_NORMALIZE'],
+        ignore_fields=app.config['RESPONSE_CACHE_IGNORE_FIELDS']
+    )
+    app.response_cache = response_cache
+    breakers = CircuitBreakerRegistry(
+        enabled=app.config['CIRCUIT_BREAKER_ENABLED'],
+        window=app.config['CIRCUIT_BREAKER_WINDOW'],
+        min_requests=app.config['CIRCUIT_BREAKER_MIN_REQUESTS'],
+        error_rate=app.config['CIRCUIT_BREAKER_ERROR_RATE'],
+        slow_call_seconds=app.config['CIRCUIT_BREAKER_SLOW_CALL_SECONDS'],
+        slow_call_rate=app.config['CIRCUIT_BREAKER_SLOW_CALL_RATE'],
+        open_seconds=app.config['CIRCUIT_BREAKER_OPEN_SECONDS']
     )
+    endpoints = EndpointPool(
+        parse_endpoints(app.config['EXTERNAL_SERVICE_URL']),
+        breakers=breakers,
+        eject_failures=app.config['EXTERNAL_SERVICE_EJECT_FAILURES'],
+        eject_seconds=app.config['EXTERNAL_SERVICE_EJECT_SECONDS']
+    )
+    media = None
+    if app.config['MEDIA_ENABLED']:
+        media = MediaPipeline(
+            cache=MediaCache(app.config['MEDIA_CACHE_DIR'], max_bytes=app.config['MEDIA_CACHE_MAX_BYTES']),
+            api_base=app.config['WECHAT_API_BASE'],
+            workers=app.config['MEDIA_WORKERS'],
+            inline_base64=app.config['EXTERNAL_SERVICE_TYPE'] in MEDIA_INLINE_SERVICE_TYPES,
+            max_file_bytes=app.config['MEDIA_MAX_FILE_BYTES'],
+            chunk_size=app.config['MEDIA_CHUNK_SIZE'],
+            timeout=app.config['MEDIA_DOWNLOAD_TIMEOUT'],
+            pic_url_hosts=app.config['MEDIA_PICURL_HOSTS']
+        )
+    app.media = media
+    external_adapter = ExternalServiceAdapter(
+        async_handler,
+        timeout=app.config['EXTERNAL_SERVICE_TIMEOUT'],
+        response_cache=response_cache,
+        stream=app.config['EXTERNAL_SERVICE_STREAM'],
+        segment_max_bytes=app.config['STREAM_SEGMENT_MAX_BYTES'],
+        segment_min_chars=app.config['STREAM_SEGMENT_MIN_CHARS'],
+        max_workers=app.config['EXTERNAL_SERVICE_MAX_WORKERS'],
+        max_pending=app.config['EXTERNAL_SERVICE_MAX_PENDING'],
+        timeout_msg=app.config['EXTERNAL_SERVICE_TIMEOUT_MSG'],
+        error_msg=app.config['EXTERNAL_SERVICE_ERROR_MSG'],
+        busy_msg=app.config['EXTERNAL_SERVICE_BUSY_MSG'],
+        breakers=breakers,
+        endpoints=endpoints,
+        hedge_delay=app.config['EXTERNAL_SERVICE_HEDGE_DELAY'],
+        media=media,
+        media_error_msg=app.config['MEDIA_ERROR_MSG'],
+        voice_unrecognized_msg=app.config['MEDIA_VOICE_UNRECOGNIZED_MSG']
+    )
+
+    # 连接池大小与对应线程池保持一致，避免线程等待连接
+    http_client.mount_host_pool(app.config['WECHAT_API_BASE'],
+                                app.config['CUSTOM_MESSAGE_WORKERS'] + (media.workers if media is not None else 0))
+    for endpoint in endpoints.endpoints:
+        http_client.mount_host_pool(endpoint.url, external_adapter.max_workers)
+
+    # 启动预热：由create_app在路由注册完成后于后台执行
+    readiness = app.readiness
+    if app.config['WARMUP_ENABLED']:
+        warmup_connections, warmup_timeout = app.config['WARMUP_CONNECTIONS'], app.config['WARMUP_TIMEOUT']
+        readiness.add('wechat_api', 'wechat_api',
+                      warmup=lambda: http_client.warm(app.config['WECHAT_API_BASE'], warmup_connections, warmup_timeout))
+        for endpoint in endpoints.endpoints:
+            readiness.add(f"backend:{endpoint.url}", 'backend',
+                          warmup=lambda url=endpoint.url: http_client.warm(url, warmup_connections, warmup_timeout),
+                          check=lambda ep=endpoint: _endpoint_status(ep, breakers.get(ep.url)))
 
-    async_handler = AsyncResponseHandler(
-        app.token_manager,
-        appid=app.config['WECHAT_APPID'],
-        appsecret=app.config['WECHAT_APPSECRET']
+    deduplicator = MessageDeduplicator(
+        max_size=app.config['DEDUP_MAX_SIZE'],
+        ttl=app.config['DEDUP_TTL']
     )
-    external_adapter = ExternalServiceAdapter(async_handler, timeout=app.config['EXTERNAL_SERVICE_TIMEOUT'])
+    app.deduplicator = deduplicator
+
+    coalescer = None
+    if app.config['COALESCE_ENABLED']:
+        def _submit_coalesced(merged_msg, account):
+            # 合并后的消息不使用被动回复，结果通过客服消息下发
+            service_type = app.config['EXTERNAL_SERVICE_TYPE']
+            req_mapper, resp_mapper = SERVICE_MAPPERS.get(
+                service_type,
+                (default_request_mapper, default_response_mapper)
+            )
+            openid = merged_msg.get('FromUserName')
+            pending = external_adapter.call_service(
+                wechat_msg=merged_msg,
+                request_mapper=req_mapper,
+                response_mapper=resp_mapper,
+                openid=openid,
+                service_type=service_type,
+                account=account
+            )
+            if pending is not None and pending.busy:
+                # 繁忙提示原本以被动回复返回，合并后改由客服消息下发
+                handler = account.async_handler
+                handler.send_async_response(openid, handler._build_message_payload(pending.result(), openid))
+            return pending
+
+        coalescer = MessageCoalescer(
+            _submit_coalesced,
+            quiet_window=app.config['COALESCE_QUIET_WINDOW'],
+            max_wait=app.config['COALESCE_MAX_WAIT'],
+            max_fragments=app.config['COALESCE_MAX_FRAGMENTS']
+        )
+    app.coalescer = coalescer
+
+    if outbox is not None:
+        def _replay_account(key, appid):
+            # 未记录公众号的旧任务属于默认公众号；公众号已从配置中移除时不再重放
+            account = accounts.get(appid) if appid else default_account
+            if account is None:
+                logger.warning("出站任务所属的公众号不存在，已跳过: %s", key)
+                outbox.complete(key)
+            return account
+
+        def _replay_request(key, openid, payload):
+            # 经过去重器重放，重启后微信的重试消息会复用重放的请求；使用当前配置的服务地址
+            account = _replay_account(key, payload.get('appid'))
+            if account is None:
+                return
+            if outbox.is_done(f"{key}#reply"):
+                # 回复已通过客服消息送达，只是请求记录未及标记完成
+                outbox.complete(key)
+                return
+            wechat_msg = payload['wechat_msg']
+            req_mapper, resp_mapper = SERVICE_MAPPERS.get(
+                payload['service_type'],
+                (default_request_mapper, default_response_mapper)
+            )
+            pending, _ = deduplicator.get_or_submit(key, lambda: external_adapter.call_service(
+                wechat_msg=wechat_msg,
+                request_mapper=req_mapper,
+                response_mapper=resp_mapper,
+                openid=openid,
+                service_type=payload['service_type'],
+                account=account
+            ))
+            if pending is None or getattr(pending, 'busy', False):
+                # 未能提交（外部服务繁忙）：由replay交还租约，稍后重试
+                raise RuntimeError("外部服务繁忙，未能重放请求")
+
+        def _replay_reply(key, openid, payload):
+            account = _replay_account(key, MessageDeduplicator.namespace_of(key))
+            if account is not None:
+                account.async_handler.send_async_response(openid, payload, outbox_key=key)
+
+        outbox.replay({'request': _replay_request, 'reply': _replay_reply})
+
+    conversation_store.configure(
+        enabled=app.config['CONVERSATION_ENABLED'],
+        max_turns=app.config['CONVERSATION_MAX_TURNS'],
+        max_users=app.config['CONVERSATION_MAX_USERS'],
+        max_total_chars=app.config['CONVERSATION_MAX_TOTAL_CHARS'],
+        idle_ttl=app.config['CONVERSATION_IDLE_TTL'],
+        prompt_char_budget=app.config['CONVERSATION_PROMPT_CHAR_BUDGET']
+    )
+
+    # 各组件的运行状态统一通过/metrics输出
+    metrics.register_stats(http_client.stats)
+    metrics.register_stats(deduplicator.stats)
+    if coalescer is not None:
+        metrics.register_stats(coalescer.stats)
+    metrics.register_stats(response_cache.stats)
+    metrics.register_stats(conversation_store.stats)
+    metrics.register_stats(log_stats)
+    metrics.register_stats(dispatcher.stats)
+    metrics.register_stats(external_adapter.stats)
+    metrics.register_stats(deadline_timer.stats)
+    metrics.register_stats(breakers.stats)
+    metrics.register_stats(readiness.stats)
+    for endpoint in endpoints.endpoints:
+        metrics.register_stats(endpoint.stats, endpoint=endpoint.url)
+    metrics.register_stats(external_adapter.executor.stats, pool='external_service')
+    metrics.register_stats(lambda: _dispatcher_pool_stats(dispatcher), pool='custom_message')
+    if app.config['ACCOUNTS_FILE']:
+        for account in accounts:
+            metrics.register_stats(account.stats, account=account.appid)
+    if outbox is not None:
+        metrics.register_stats(outbox.stats)
+    if media is not None:
+        metrics.register_stats(media.stats)
+        metrics.register_stats(media.executor.stats, pool='media')
+
+    def drain(timeout: float) -> bool:
+        """
+        进程退出前等待进行中的工作完成（gunicorn worker退出时调用）
+
+        合并中的消息、外部服务调用与客服消息发送（含等待重试的）全部结束后落盘持久化队列；
+        超时未完成的回复在启用OUTBOX时于下次启动后重放。
+        """
+        start = time.monotonic()
+        drained = _wait_idle(lambda: (not (coalescer is not None and coalescer.stats()['coalesce_users'])
+                                      and not external_adapter.stats()['external_pending']
+                                      and not dispatcher.stats()['dispatch_keys']), timeout)
+        if outbox is not None:
+            outbox.flush(max(timeout - (time.monotonic() - start), 0.1))
+        if drained:
+            logger.info(f"进行中的回复已全部发送，耗时{time.monotonic() - start:.2f}秒")
+        else:
+            stats = dispatcher.stats()
+            logger.warning(f"等待{timeout}秒后仍有未完成的回复: 外部服务调用{external_adapter.stats()['external_pending']}个，"
+                           f"客服消息{stats['dispatch_queue_length'] + stats['dispatch_active'] + stats['dispatch_retry_waiting']}条")
+        return drained
+
+    app.drain = drain
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        # 存活检查：只要进程能处理请求即返回200，不访问任何外部依赖
+        return 'ok', 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        ready, dependencies = readiness.status()
+        body = json.dumps({'ready': ready, 'dependencies': dependencies}, ensure_ascii=False)
+        return body, 200 if ready else 503, {'Content-Type': 'application/json; charset=utf-8'}
 
     @app.route('/wechat', methods=['GET', 'POST'])
     def wechat():
+        if default_account is None:
+            return 'Not found', 404
+        return handle_wechat(default_account)
+
+    @app.route('/wechat/<appid>', methods=['GET', 'POST'])
+    def wechat_account(appid):
+        # 多公众号模式：每个公众号在公众平台配置各自的服务器地址 /wechat/<appid>
+        account = accounts.get(appid)
+        if account is None:
+            return 'Unknown account', 404
+        return handle_wechat(account)
+
+    def handle_wechat(account):
+        crypto = account.crypto
         # 公共参数获取
         signature = request.args.get('signature', '')
         timestamp = request.args.get('timestamp', '')
@@ -39,41 +348,51 @@ def init_routes(app):
             return 'Verification failed', 403
 
         # 处理POST消息
+        request_start = time.monotonic()  # 被动回复预算从收到请求开始计算
+        # 判断消息模式
+        is_encrypted = 'encrypt_type' in request.args or 'aes' in request.args.values()
+        # 明文消息同样校验签名（加密消息在解密时校验），拒绝伪造的消息
+        if not is_encrypted and not crypto.check_signature(signature, timestamp, nonce):
+            return 'Verification failed', 403
         try:
             # 根据加密类型处理消息
             xml_str = request.data
-            logger.debug(f'Raw request data (str): {xml_str}')
-            logger.debug(f'Raw request data (hex): {xml_str.hex()}')
 
-            # 判断消息模式
-            is_encrypted = 'encrypt_type' in request.args or 'aes' in request.args.values()
+            parse_start = time.perf_counter()
             if is_encrypted:
-                # 先解析XML获取Encrypt字段
+                # 先解析外层XML获取Encrypt字段
                 try:
-                    xml_tree = ET.fromstring(xml_str)
-                    encrypt_node = xml_tree.find('Encrypt')
-                    if encrypt_node is None:
+                    encrypted_msg = parse_envelope(xml_str).get('Encrypt')
+                    if encrypted_msg is None:
                         raise ValueError("No Encrypt field in XML")
-                    encrypted_msg = encrypt_node.text
                 except ET.ParseError as e:
-                    logger.error(f"Failed to parse XML: {str(e)}")
+                    logger.error("Failed to parse XML: %s", e)
                     return 'Invalid XML', 400
+                parse_elapsed = time.perf_counter() - parse_start
 
-                # 加密消息处理
-                decrypted_xml = crypto.decrypt_message(
+                # 加密消息处理（解密结果直接按字节解析，不再解码为字符串）
+                decrypted_xml = crypto.decrypt_to_bytes(
                     encrypted_msg,  # 传入Encrypt字段的内容
                     signature,
                     timestamp,
                     nonce
                 )
+                parse_start = time.perf_counter()
                 msg = MessageHandler.parse_message(decrypted_xml)
             else:
                 # 明文消息处理
+                parse_elapsed = 0.0
                 msg = MessageHandler.parse_message(xml_str)
+            stage_seconds.observe(parse_elapsed + time.perf_counter() - parse_start, 'parse')
+
+            # 报文日志按openid采样，且仅在DEBUG级别下才序列化
+            if payload_logging_enabled(msg.get('FromUserName')):
+                logger.debug('Raw request data (str): %r', xml_str)
+                logger.debug('Raw request data (hex): %s', xml_str.hex())
 
             # 检查access_token状态
-            if not app.token_manager.access_token:
-                error_msg = f"系统服务暂时不可用，请稍后再试。（access_token error: {app.token_manager.last_error}）"
+            if not account.token_manager.access_token:
+                error_msg = f"系统服务暂时不可用，请稍后再试。（access_token error: {account.token_manager.last_error}）"
                 reply_data = {
                     'msg_type': 'text',
                     'content': error_msg,
@@ -81,40 +400,64 @@ def init_routes(app):
                     'to_user': msg.get('FromUserName')
                 }
                 if is_encrypted:
-                    reply_xml = MessageHandler.build_reply(**reply_data)
-                    encrypted_reply = crypto.encrypt_message(reply_xml, nonce)
-                    return encrypted_reply
+                    return MessageHandler.build_encrypted_reply(crypto, **reply_data)
                 else:
                     return MessageHandler.build_reply(**reply_data)
 
             # 在调用外部服务前添加分发逻辑
             service_type = current_app.config['EXTERNAL_SERVICE_TYPE']
 
-            # 定义服务类型映射表
-            service_mappers = {
-                'default': (default_request_mapper, default_response_mapper),
-                'openai': (openai_request_mapper, openai_response_mapper),
-                'ollama': (ollama_request_mapper, ollama_response_mapper),
-                'custom': (custom_request_mapper, custom_response_mapper)
-            }
-
             # 获取对应的映射器
-            req_mapper, resp_mapper = service_mappers.get(
+            req_mapper, resp_mapper = SERVICE_MAPPERS.get(
                 service_type,
                 (default_request_mapper, default_response_mapper)
             )
 
+            passive_enabled = current_app.config['PASSIVE_REPLY_ENABLED']
+            coalesce = coalescer is not None and coalescer.accepts(msg)
+
             # 调用服务时使用动态映射器
-            external_response = external_adapter.call_service(
-                wechat_msg=msg,
-                endpoint=current_app.config['EXTERNAL_SERVICE_URL'],
-                request_mapper=req_mapper,
-                response_mapper=resp_mapper,
-                openid=msg.get('FromUserName')
-            )
+            def submit():
+                if coalesce:
+                    return coalescer.add(msg, account)
+                return external_adapter.call_service(
+                    wechat_msg=msg,
+                    request_mapper=req_mapper,
+                    response_mapper=resp_mapper,
+                    openid=msg.get('FromUserName'),
+                    passive=passive_enabled,
+                    service_type=service_type,
+                    account=account
+                )
+
+            # 微信重试消息复用首次请求，不重复调用外部服务
+            dedup_key = MessageDeduplicator.make_key(msg, namespace=account.appid)
+            if dedup_key is None:
+                pending = submit()
+            else:
+                pending, is_new = deduplicator.get_or_submit(dedup_key, submit)
+                if not is_new:
+                    logger.info("重复消息已忽略: %s", dedup_key)
+                    return 'success'
 
             # 构建回复
-            reply_content = "AI处理中..."  # 替换为实际回复内容
+            reply_content = "AI处理中..."  # 超出被动回复预算时的占位回复
+
+            # 合并的连续消息只对每批第一条回复占位提示，其余直接返回success
+            if coalesce:
+                if pending is None or not pending.opens_batch:
+                    return 'success'
+            # 外部服务繁忙被拒绝时直接回复繁忙提示
+            elif pending is not None and pending.busy:
+                reply_content = pending.result()['content']
+            # 在微信5秒窗口内等待外部服务结果，超时则转为客服消息异步下发
+            elif passive_enabled and pending is not None:
+                budget = current_app.config['PASSIVE_REPLY_BUDGET'] - (time.monotonic() - request_start)
+                mapped_response = pending.wait_passive(budget)
+                if mapped_response:
+                    payload = account.async_handler._build_message_payload(mapped_response, msg.get('FromUserName'))
+                    reply_content = payload['text']['content']
+                    logger.info("被动回复已在预算内完成: %s", msg.get('FromUserName'))
             reply_data = {
                 'msg_type': 'text',
                 'content': reply_content,
@@ -123,29 +466,17 @@ def init_routes(app):
             }
 
             # 根据加密模式返回不同格式
-            if is_encrypted:
-                reply_xml = MessageHandler.build_reply(**reply_data)
-                encrypted_reply = crypto.encrypt_message(reply_xml, nonce)
-                # 生成新的消息签名
-                timestamp = str(int(time.time()))
-                new_nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-                msg_signature = crypto.generate_signature(encrypted_reply, timestamp, new_nonce)
-                # 构建符合微信要求的加密消息结构
-                encrypted_xml = f"""
-                <xml>
-                    <Encrypt><![CDATA[{encrypted_reply}]]></Encrypt>
-                    <MsgSignature><![CDATA[{msg_signature}]]></MsgSignature>
-                    <TimeStamp>{timestamp}</TimeStamp>
-                    <Nonce><![CDATA[{new_nonce}]]></Nonce>
-                </xml>
-                """
-                return encrypted_xml.strip()
-            else:
-                return MessageHandler.build_reply(**reply_data)
+            with stage_seconds.time('reply'):
+                if is_encrypted:
+                    return MessageHandler.build_encrypted_reply(crypto, **reply_data)
+                else:
+                    return MessageHandler.build_reply(**reply_data)
 
         except ValueError as e:
-            logger.error(f"签名验证失败: {str(e)}")
+            logger.error("签名验证失败: %s", e)
             return 'Invalid signature', 403
         except ET.ParseError as e:
-            logger.error(f"XML解析错误: {str(e)}")
+            logger.error("XML解析错误: %s", e)
             return 'XML parse error', 400
+        finally:
+            request_seconds.observe(time.monotonic() - request_start, 'true' if is_encrypted else 'false')
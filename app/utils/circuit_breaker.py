@@ -0,0 +1,188 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from app.utils.logger import logger
+from app.utils.metrics import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 熔断器状态的gauge取值
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+circuit_breaker_state = metrics.gauge(
+    'circuit_breaker_state', '熔断器状态（0 closed，1 open，2 half_open）', ('endpoint',))
+circuit_breaker_transitions = metrics.counter(
+    'circuit_breaker_transitions_total', '熔断器状态切换次数', ('endpoint', 'state'))
+circuit_breaker_rejected = metrics.counter(
+    'circuit_breaker_rejected_total', '熔断期间被快速失败的请求数', ('endpoint',))
+
+
+class CircuitBreaker:
+    """
+    熔断器（closed / open / half_open）
+
+    按秒分桶统计最近window秒内的调用结果，请求数达到min_requests后，失败率达到error_rate
+    或慢调用比例达到slow_call_rate即熔断。熔断open_seconds秒后进入半开状态，放行一个探测请求：
+    成功则恢复，失败则重新熔断。探测请求未回报结果时，open_seconds秒后再放行下一个。
+    调用方回报结果时带上请求的开始时间（time.monotonic()），早于当前状态的请求（如熔断前发出、
+    熔断后才结束的请求，或已被新探测取代的旧探测）的结果被忽略。
+    """
+
+    def __init__(self, name: str, window: int = 30, min_requests: int = 20, error_rate: float = 0.5,
+                 slow_call_seconds: float = 0, slow_call_rate: float = 0.5, open_seconds: float = 30):
+        self.name = name
+        self.window = max(int(window), 1)
+        self.min_requests = max(min_requests, 1)
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._buckets: deque = deque()  # [秒, 总数, 失败数, 慢调用数]
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._changed_at = time.monotonic()  # 进入当前状态的时间
+        self._probe_at: Optional[float] = None
+        circuit_breaker_state.set(STATE_VALUES[CLOSED], name)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def available(self) -> bool:
+        """allow()是否会放行（只查看状态：不切换到半开、不占用探测名额、不计入拒绝数），用于选择节点"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == OPEN and now - self._opened_at < self.open_seconds:
+                return False
+            return self._probe_at is None or now - self._probe_at >= self.open_seconds
+
+    def reject(self):
+        """调用方因熔断快速失败（未调用allow时）计入拒绝数"""
+        circuit_breaker_rejected.inc(self.name)
+
+    def allow(self) -> bool:
+        """是否放行本次调用；熔断中返回False，调用方应快速失败"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    circuit_breaker_rejected.inc(self.name)
+                    return False
+                self._transition(HALF_OPEN)
+            if self._probe_at is None or now - self._probe_at >= self.open_seconds:
+                self._probe_at = now
+                return True
+            circuit_breaker_rejected.inc(self.name)
+            return False
+
+    def record(self, success: bool, latency: Optional[float] = None, started_at: Optional[float] = None):
+        """
+        回报一次调用结果；latency为None时不参与慢调用统计（如流式请求）
+
+        started_at为请求开始时的time.monotonic()，未提供时视为当前状态下发出的请求。
+        """
+        slow = success and latency is not None and 0 < self.slow_call_seconds <= latency
+        with self._lock:
+            if self._state == OPEN:
+                return
+            if started_at is not None and started_at < self._changed_at:
+                return  # 进入当前状态之前发出的请求
+            if self._state == HALF_OPEN:
+                # 只有当前探测名额放行之后发出的请求才是探测请求
+                if started_at is not None and (self._probe_at is None or started_at < self._probe_at):
+                    return
+                # 探测请求的结果决定恢复还是重新熔断
+                if success and not slow:
+                    self._buckets.clear()
+                    self._transition(CLOSED)
+                else:
+                    self._open()
+                return
+
+            second = int(time.monotonic())
+            if self._buckets and self._buckets[-1][0] == second:
+                bucket = self._buckets[-1]
+            else:
+                bucket = [second, 0, 0, 0]
+                self._buckets.append(bucket)
+            bucket[1] += 1
+            if not success:
+                bucket[2] += 1
+            if slow:
+                bucket[3] += 1
+
+            while self._buckets and self._buckets[0][0] <= second - self.window:
+                self._buckets.popleft()
+            total = failures = slow_calls = 0
+            for _, count, failed, slowed in self._buckets:
+                total += count
+                failures += failed
+                slow_calls += slowed
+            if total < self.min_requests:
+                return
+            if failures >= total * self.error_rate:
+                logger.warning("外部服务熔断: %s 最近%s秒失败率 %s/%s", self.name, self.window, failures, total)
+                self._open()
+            elif self.slow_call_seconds and slow_calls >= total * self.slow_call_rate:
+                logger.warning("外部服务熔断: %s 最近%s秒慢调用 %s/%s（>%ss）",
+                               self.name, self.window, slow_calls, total, self.slow_call_seconds)
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._probe_at = None
+        self._buckets.clear()
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.info("熔断器状态变更: %s %s -> %s", self.name, self._state, state)
+        self._state = state
+        self._changed_at = time.monotonic()
+        circuit_breaker_state.set(STATE_VALUES[state], self.name)
+        circuit_breaker_transitions.inc(self.name, state)
+
+
+class CircuitBreakerRegistry:
+    """按endpoint懒创建熔断器，所有熔断器共用同一组参数"""
+
+    def __init__(self, enabled: bool = True, **settings):
+        self.enabled = enabled
+        self.settings = settings
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint: str) -> Optional[CircuitBreaker]:
+        """未启用熔断时返回None"""
+        if not self.enabled:
+            return None
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(endpoint)
+                if breaker is None:
+                    breaker = self._breakers[endpoint] = CircuitBreaker(endpoint, **self.settings)
+        return breaker
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        states = [breaker.state for breaker in breakers]
+        return {
+            'circuit_breakers': len(breakers),
+            'circuit_breakers_open': states.count(OPEN),
+            'circuit_breakers_half_open': states.count(HALF_OPEN),
+        }
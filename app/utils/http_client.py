@@ -0,0 +1,206 @@
+import threading
+import time
+from http.client import RemoteDisconnected
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
+from urllib3.util.util import reraise
+
+from app.utils.logger import logger
+
+HTTP_POOL_CONNECTIONS_DEFAULT = 10
+HTTP_POOL_MAXSIZE_DEFAULT = 10
+HTTP_MAX_RETRIES_DEFAULT = 1
+
+
+class _PoolStats:
+    """连接池命中统计（所有连接池共享）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0  # 从连接池取连接的次数
+        self.created = 0   # 新建连接的次数（未命中）
+
+    def on_acquire(self):
+        with self._lock:
+            self.acquired += 1
+
+    def on_create(self):
+        with self._lock:
+            self.created += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            acquired, created = self.acquired, self.created
+        return {
+            'pool_hits': max(acquired - created, 0),
+            'pool_misses': created,
+        }
+
+
+_pool_stats = _PoolStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        _pool_stats.on_acquire()
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        _pool_stats.on_create()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        _pool_stats.on_acquire()
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        _pool_stats.on_create()
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    """带命中统计的连接池适配器"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+
+class _ConnectionRetry(Retry):
+    """
+    只重试请求未被对端处理的错误：建立连接失败，以及复用的keep-alive连接已被对端关闭
+    （未收到任何响应即断开）。读超时等请求可能已被处理的错误直接抛出，
+    POST不会被重复发送（重复的客服消息、重复的外部服务调用）。
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if error is not None and not self._is_connection_error(error) and not _is_stale_connection(error):
+            raise reraise(type(error), error, _stacktrace)
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+
+def _is_stale_connection(error: Exception) -> bool:
+    """对端在发送任何响应之前关闭了连接（典型情况为连接池中空闲连接已被服务端关闭）"""
+    if not isinstance(error, ProtocolError) or len(error.args) < 2:
+        return False
+    return isinstance(error.args[1], (RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+
+
+def _build_retry(max_retries: int) -> Retry:
+    """仅对连接层错误重试（见_ConnectionRetry），不对HTTP状态码重试。"""
+    return _ConnectionRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=0,
+        redirect=0,
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+    )
+
+
+class HttpClient:
+    """
+    共享的HTTP连接池客户端
+
+    所有出站请求（外部服务、微信客服消息、access_token刷新）共用一个Session，
+    按主机挂载独立大小的连接池并保持keep-alive。
+    """
+
+    def __init__(self,
+                 pool_connections: int = HTTP_POOL_CONNECTIONS_DEFAULT,
+                 pool_maxsize: int = HTTP_POOL_MAXSIZE_DEFAULT,
+                 max_retries: int = HTTP_MAX_RETRIES_DEFAULT):
+        self._lock = threading.Lock()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self._host_pool_sizes: Dict[str, int] = {}
+        self.session = self._build_session()
+
+    def _new_adapter(self, maxsize: int) -> HTTPAdapter:
+        return _PooledAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=maxsize,
+            max_retries=_build_retry(self.max_retries),
+        )
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount('http://', self._new_adapter(self.pool_maxsize))
+        session.mount('https://', self._new_adapter(self.pool_maxsize))
+        for prefix, maxsize in self._host_pool_sizes.items():
+            session.mount(prefix, self._new_adapter(maxsize))
+        return session
+
+    def configure(self, pool_connections: Optional[int] = None,
+                  pool_maxsize: Optional[int] = None,
+                  max_retries: Optional[int] = None):
+        """更新连接池参数并重建Session"""
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if max_retries is not None:
+                self.max_retries = max_retries
+            old_session, self.session = self.session, self._build_session()
+        old_session.close()
+        logger.info(f"HTTP连接池已配置: pool_connections={self.pool_connections}, "
+                    f"pool_maxsize={self.pool_maxsize}, max_retries={self.max_retries}")
+
+    def mount_host_pool(self, url: str, maxsize: int):
+        """为指定主机挂载独立大小的连接池（通常与调用方线程池大小一致）"""
+        parts = urlsplit(url)
+        if not parts.scheme or not parts.netloc:
+            logger.warning(f"无效的连接池地址，已忽略: {url}")
+            return
+        prefix = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            # 同一主机被多个调用方使用时，取较大值
+            maxsize = max(maxsize, self._host_pool_sizes.get(prefix, 0))
+            self._host_pool_sizes[prefix] = maxsize
+            self.session.mount(prefix, self._new_adapter(maxsize))
+        logger.info(f"HTTP连接池已挂载: {prefix} (pool_maxsize={maxsize})")
+
+    def warm(self, url: str, connections: int = 1, timeout: float = 5) -> str:
+        """
+        预先建立到url所在主机的keep-alive连接（并发HEAD请求，每个请求占用一个连接，完成后放回连接池）
+
+        任何HTTP状态码都说明主机可达；连接失败时抛出异常。返回说明文字。
+        """
+        connections = max(connections, 1)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            responses = list(executor.map(
+                lambda _: self.session.head(url, timeout=timeout, allow_redirects=False), range(connections)))
+        for response in responses:
+            response.close()
+        return (f"HTTP {responses[0].status_code}, {connections} connection(s) "
+                f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.session.post(url, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """返回连接池命中/未命中计数"""
+        return _pool_stats.snapshot()
+
+
+# 默认共享实例
+http_client = HttpClient()
@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.utils.circuit_breaker import CircuitBreakerRegistry
+from app.utils.logger import logger
+
+
+def parse_endpoints(spec: str) -> List[Tuple[str, float]]:
+    """
+    解析后端地址列表：逗号分隔，每项可用 "|权重" 指定权重（默认1）
+
+    例如 "http://node1:11434/api/generate|2,http://node2:11434/api/generate"
+    """
+    endpoints = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        url, sep, weight = item.rpartition('|')
+        if not sep:
+            url, weight = item, '1'
+        try:
+            endpoints.append((url.strip(), max(float(weight), 0.01)))
+        except ValueError:
+            logger.warning(f"无效的后端权重，按1处理: {item}")
+            endpoints.append((url.strip(), 1.0))
+    return endpoints
+
+
+class Endpoint:
+    """单个后端节点及其运行状态"""
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0          # 已分配但未完成（排队+执行中）的请求数
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'endpoint_outstanding': self.outstanding,
+            'endpoint_ejected': int(self.ejected_until > time.monotonic()),
+            'endpoint_requests': self.requests,
+            'endpoint_failures': self.failures,
+            'endpoint_ejections': self.ejections,
+        }
+
+
+class EndpointPool:
+    """
+    多后端节点路由
+
+    - 按 (未完成请求数+1)/权重 选择负载最低的节点，同分随机，能感知每个节点的实际处理速度
+    - 连续失败eject_failures次的节点被摘除eject_seconds秒；全部被摘除时忽略摘除状态
+    - 节点的熔断器不放行时跳过该节点，所有节点均熔断时choose返回None；
+      选择时只查看熔断器状态，只有选中的节点调用allow()（半开状态的探测名额只由实际发出的请求占用）
+    """
+
+    def __init__(self, endpoints: Iterable[Tuple[str, float]], breakers: Optional[CircuitBreakerRegistry] = None,
+                 eject_failures: int = 5, eject_seconds: float = 30):
+        self.endpoints = [Endpoint(url, weight) for url, weight in endpoints]
+        if not self.endpoints:
+            raise ValueError("至少需要配置一个外部服务地址")
+        self.breakers = breakers
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def choose(self, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        """选择节点并计入其未完成请求数，调用方完成后必须调用release"""
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            now = time.monotonic()
+            healthy = [ep for ep in candidates if ep.ejected_until <= now] or candidates
+            healthy.sort(key=lambda ep: ((ep.outstanding + 1) / ep.weight, random.random()))
+            refused = []
+            for ep in healthy:
+                breaker = self.breakers.get(ep.url) if self.breakers is not None else None
+                if breaker is not None and not breaker.available():
+                    refused.append(breaker)
+                    continue
+                # available()与allow()之间其他线程可能已占用半开探测名额，此时继续尝试下一个节点
+                if breaker is None or breaker.allow():
+                    ep.outstanding += 1
+                    return ep
+        for breaker in refused:
+            breaker.reject()
+        return None
+
+    def release(self, endpoint: Endpoint, success: Optional[bool]):
+        """请求结束；success为None表示请求未实际发出（如排队中被取消）"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success is None:
+                return
+            endpoint.requests += 1
+            if success:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if self.eject_failures and endpoint.consecutive_failures >= self.eject_failures:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = time.monotonic() + self.eject_seconds
+                endpoint.ejections += 1
+                logger.warning("后端节点连续失败%s次，摘除%s秒: %s",
+                               self.eject_failures, self.eject_seconds, endpoint.url)
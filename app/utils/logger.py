@@ -1,12 +1,19 @@
+import atexit
+import copy
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import zlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from datetime import datetime
 
 LOG_LEVEL_DEFAULT = 'INFO'
 LOG_DIR_DEFAULT = 'logs'
 LOG_FILE_SIZE_DEFAULT = '50M'
 LOG_BACKUP_COUNT_DEFAULT = 5
+LOG_ASYNC_DEFAULT = 'true'
+LOG_QUEUE_SIZE_DEFAULT = 10000
+LOG_PAYLOAD_SAMPLE_RATE_DEFAULT = 1.0
 
 # 缓冲区，用于存储在logger实例创建前需要记录的日志消息
 _log_buffer_for_setup_logger = []
@@ -40,6 +47,42 @@ def parse_log_file_size(size_str: str) -> int:
         })
         return parse_log_file_size(LOG_FILE_SIZE_DEFAULT)  # 默认返回50MB
 
+class DroppingQueueHandler(QueueHandler):
+    """
+    非阻塞的队列日志处理器
+
+    请求线程只合并消息参数并放入有界队列，格式化与文件写入由QueueListener线程完成；
+    队列已满时直接丢弃该条日志并计数，不阻塞请求线程。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 参数可能在之后被修改，因此在调用线程合并；时间与格式化留给监听线程
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_EXC_FORMATTER = logging.Formatter()
+_queue_handler = None
+_queue_listener = None
+_payload_sample_rate = LOG_PAYLOAD_SAMPLE_RATE_DEFAULT
+_payload_openids = frozenset()
+
+
 def setup_logger(name='wx-backend'):
     """
     配置logger
@@ -129,12 +172,78 @@ def setup_logger(name='wx-backend'):
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
 
-    # 添加处理器
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # 异步模式：请求线程只入队，由后台监听线程写文件和控制台
+    if os.getenv('LOG_ASYNC', LOG_ASYNC_DEFAULT).lower() == 'true':
+        global _queue_handler, _queue_listener
+        try:
+            queue_size = int(os.getenv('LOG_QUEUE_SIZE', LOG_QUEUE_SIZE_DEFAULT))
+            if queue_size <= 0:
+                raise ValueError("队列长度必须为正数")
+        except ValueError as e:
+            _log_buffer_for_setup_logger.append({
+                'level': 'warning',
+                'message': f"LOG_QUEUE_SIZE无效，使用默认值{LOG_QUEUE_SIZE_DEFAULT}。错误信息: {e}"
+            })
+            queue_size = LOG_QUEUE_SIZE_DEFAULT
+        log_queue = queue.Queue(maxsize=queue_size)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        _queue_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(_queue_listener.stop)  # 退出前写完队列中剩余的日志
+        logger.addHandler(_queue_handler)
+        _log_buffer_for_setup_logger.append({
+            'level': 'info',
+            'message': f"LOG_ASYNC: true (LOG_QUEUE_SIZE: {queue_size})"
+        })
+    else:
+        # 添加处理器
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
+
+    _setup_payload_sampling()
 
     return logger
 
+
+def _setup_payload_sampling():
+    """读取请求/响应报文日志的采样配置"""
+    global _payload_sample_rate, _payload_openids
+    try:
+        rate = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', LOG_PAYLOAD_SAMPLE_RATE_DEFAULT))
+        if not 0 <= rate <= 1:
+            raise ValueError("采样率必须在0到1之间")
+        _payload_sample_rate = rate
+    except ValueError as e:
+        _log_buffer_for_setup_logger.append({
+            'level': 'warning',
+            'message': f"LOG_PAYLOAD_SAMPLE_RATE无效，使用默认值{LOG_PAYLOAD_SAMPLE_RATE_DEFAULT}。错误信息: {e}"
+        })
+    _payload_openids = frozenset(
+        openid.strip() for openid in os.getenv('LOG_PAYLOAD_OPENIDS', '').split(',') if openid.strip())
+
+
+def payload_logging_enabled(openid) -> bool:
+    """
+    是否记录该用户的报文DEBUG日志
+
+    按openid确定性采样：同一用户要么全部记录、要么全部跳过，便于完整追踪一次会话；
+    LOG_PAYLOAD_OPENIDS中的用户始终记录。非DEBUG级别时直接返回False。
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    if _payload_sample_rate >= 1 or (openid and openid in _payload_openids):
+        return True
+    if _payload_sample_rate <= 0 or not openid:
+        return False
+    return zlib.crc32(openid.encode('utf-8')) % 10000 < _payload_sample_rate * 10000
+
+
+def log_stats() -> dict:
+    """异步日志队列状态"""
+    if _queue_handler is None:
+        return {'log_queue_size': 0, 'log_dropped': 0}
+    return {'log_queue_size': _queue_handler.queue.qsize(), 'log_dropped': _queue_handler.dropped}
+
 # 创建默认logger实例
 logger = setup_logger()
 
@@ -0,0 +1,246 @@
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# 请求处理各阶段（签名、解密、解析、回复渲染）的耗时通常在亚毫秒级
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+# 网络调用（外部服务、客服消息、access_token）
+NETWORK_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_PREFIX = 'wxb_'
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增计数器，可带标签"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = _PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """可设置任意值的带标签gauge"""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = _PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """
+    固定桶直方图
+
+    observe只做一次二分查找和加锁计数，开销在微秒以下，可常驻开启。
+    """
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = _PREFIX + name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple, list] = {}  # labels -> [各桶计数..., +Inf桶计数, 总和]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels) -> '_Timer':
+        """with metrics_hist.time('label'): ... 统计代码块耗时"""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                label_str = _format_labels(self.labelnames, labels, 'le="%s"' % le)
+                lines.append(f'{self.name}_bucket{label_str} {cumulative}')
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_str} {repr(series[-1])}')
+            lines.append(f'{self.name}_count{label_str} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """记录排队任务数与执行中任务数的线程池"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self._queued += 1
+        try:
+            return super().submit(self._run, fn, *args, **kwargs)
+        except BaseException:
+            with self._stats_lock:
+                self._queued -= 1
+            raise
+
+    def _run(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return {'executor_queue_depth': self._queued, 'executor_active_workers': self._active}
+
+
+class MetricsRegistry:
+    """
+    进程内指标注册表
+
+    除直方图、计数器和gauge外，还可注册返回dict的stats函数（如各组件的stats()），
+    渲染时每个键输出为一个gauge。
+    """
+
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Tuple[Callable[[], Dict], Dict[str, str]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        metric = Gauge(name, help, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = NETWORK_BUCKETS,
+                  labelnames: Sequence[str] = ()) -> Histogram:
+        metric = Histogram(name, help, buckets, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, collector: Callable[[], Dict], **labels: str):
+        """注册stats函数；labels会附加到该函数输出的每个gauge上"""
+        with self._lock:
+            self._collectors.append((collector, labels))
+
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        gauges: Dict[str, List[str]] = {}
+        for collector, labels in collectors:
+            try:
+                values = collector()
+            except Exception:
+                continue
+            label_str = _format_labels(tuple(labels), tuple(labels.values()))
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauges.setdefault(_PREFIX + key, []).append(f'{_PREFIX}{key}{label_str} {_format_value(value)}')
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+# 全局指标注册表与各阶段指标
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram(
+    'wechat_stage_seconds', '/wechat请求各处理阶段耗时', STAGE_BUCKETS, ('stage',))
+request_seconds = metrics.histogram(
+    'wechat_request_seconds', '/wechat请求总耗时', STAGE_BUCKETS + NETWORK_BUCKETS[6:], ('encrypted',))
+external_service_seconds = metrics.histogram(
+    'external_service_seconds', '外部服务调用耗时', NETWORK_BUCKETS, ('service_type', 'outcome'))
+custom_message_seconds = metrics.histogram(
+    'custom_message_send_seconds', '客服消息接口调用耗时', NETWORK_BUCKETS)
+custom_message_errcodes = metrics.counter(
+    'custom_message_errcode_total', '客服消息接口返回的errcode', ('errcode',))
+token_refresh_seconds = metrics.histogram(
+    'token_refresh_seconds', 'access_token刷新请求耗时', NETWORK_BUCKETS, ('outcome',))
+media_download_seconds = metrics.histogram(
+    'media_download_seconds', '媒体文件下载耗时', NETWORK_BUCKETS, ('source', 'outcome'))
@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from app.utils.logger import logger
+
+PENDING = 'pending'
+OK = 'ok'
+FAILED = 'failed'
+
+# check返回 (状态, 说明)；返回None表示沿用预热结果
+CheckResult = Optional[Tuple[str, str]]
+
+
+class _Dependency:
+    __slots__ = ('name', 'kind', 'required', 'warmup', 'check', 'state', 'detail', 'duration')
+
+    def __init__(self, name: str, kind: str, required: bool, warmup: Optional[Callable], check: Optional[Callable]):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.warmup = warmup
+        self.check = check
+        self.state = PENDING if warmup is not None else OK
+        self.detail = 'warming up' if warmup is not None else ''
+        self.duration = None
+
+
+class ReadinessProbe:
+    """
+    启动预热与就绪状态
+
+    应用启动时不再同步访问网络：各依赖的预热任务（连接池、后端连接）在后台线程中执行，
+    access_token由后台刷新获取。/readyz按依赖输出状态：
+    - 预热任务全部结束前不就绪，避免流量进入冷进程
+    - required_kinds中的依赖（默认token）必须为ok才就绪，其他依赖只报告状态，
+      不会因为某个后端节点不可用而把所有进程摘出流量
+    """
+
+    def __init__(self, required_kinds: Iterable[str] = ('token',)):
+        self.required_kinds = frozenset(required_kinds)
+        self._deps: Dict[str, _Dependency] = {}
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._ready_at = None
+
+    def add(self, name: str, kind: str, warmup: Optional[Callable[[], str]] = None,
+            check: Optional[Callable[[], CheckResult]] = None):
+        """
+        注册依赖
+
+        warmup: 预热函数，返回说明文字，抛出异常表示失败
+        check: 预热结束后每次/readyz调用的动态检查
+        """
+        with self._lock:
+            self._deps[name] = _Dependency(name, kind, kind in self.required_kinds, warmup, check)
+
+    def start(self, max_workers: int = 4):
+        """在后台执行所有预热任务（每个依赖单独计时，慢依赖不拖延其他依赖）"""
+        deps = [dep for dep in self._deps.values() if dep.warmup is not None]
+        if not deps:
+            return
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(deps)), thread_name_prefix='warmup')
+        for dep in deps:
+            executor.submit(self._run_warmup, dep)
+        executor.shutdown(wait=False)  # 任务结束后线程自动退出
+
+    def _run_warmup(self, dep: _Dependency):
+        start = time.perf_counter()
+        try:
+            detail, state = dep.warmup() or '', OK
+        except Exception as e:
+            detail, state = str(e), FAILED
+            logger.warning(f"预热失败: {dep.name}: {detail}")
+        dep.duration = time.perf_counter() - start
+        dep.detail, dep.state = detail, state
+
+    def status(self) -> Tuple[bool, Dict[str, Dict]]:
+        """返回 (是否就绪, 各依赖状态)"""
+        ready = True
+        report = {}
+        for dep in list(self._deps.values()):
+            state, detail = dep.state, dep.detail
+            if state != PENDING and dep.check is not None:
+                try:
+                    result = dep.check()
+                except Exception as e:
+                    result = (FAILED, str(e))
+                if result is not None:
+                    state, detail = result
+            if dep.warmup is not None and dep.state == PENDING:
+                ready = False
+            elif dep.required and state != OK:
+                ready = False
+            entry = {'kind': dep.kind, 'state': state, 'required': dep.required}
+            if detail:
+                entry['detail'] = detail
+            if dep.duration is not None:
+                entry['warmup_seconds'] = round(dep.duration, 3)
+            report[dep.name] = entry
+        if ready and self._ready_at is None:
+            self._ready_at = time.monotonic()
+            logger.info(f"服务已就绪，启动后{self._ready_at - self._started_at:.2f}秒")
+        return ready, report
+
+    def stats(self) -> Dict[str, float]:
+        ready, report = self.status()
+        return {
+            'ready': int(ready),
+            'ready_dependencies_failed': sum(1 for entry in report.values() if entry['state'] == FAILED),
+            'ready_dependencies_pending': sum(1 for entry in report.values() if entry['state'] == PENDING),
+        }
@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from app.utils.logger import logger
+
+
+class TimerHandle:
+    """定时任务句柄，cancel()后任务不再执行"""
+    __slots__ = ('cancelled', '_timer')
+
+    def __init__(self, timer: 'DeadlineTimer'):
+        self.cancelled = False
+        self._timer = timer
+
+    def cancel(self) -> bool:
+        """取消任务；返回是否在触发前取消成功（已触发或已取消时返回False）"""
+        with self._timer._cond:
+            # 与定时器线程的出堆在同一把锁下判断：出堆时已标记，之后的cancel()不会再计数
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            self._timer._on_cancel_locked()
+            return True
+
+
+class DeadlineTimer:
+    """
+    集中式定时器
+
+    所有超时与延迟任务共用一个线程和一个最小堆，不再为每个请求占用一个阻塞等待的线程。
+    回调在定时器线程中执行，必须简短且不能长时间阻塞。
+    """
+
+    def __init__(self, name: str = 'deadline-timer'):
+        self.name = name
+        self._heap = []
+        self._cancelled = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.fired = 0
+
+    def schedule(self, delay: float, fn: Callable, *args) -> TimerHandle:
+        """delay秒后在定时器线程中调用fn(*args)"""
+        handle = TimerHandle(self)
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (time.monotonic() + max(delay, 0), next(self._seq), handle, fn, args))
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def _on_cancel_locked(self):
+        """调用方持有self._cond"""
+        self._cancelled += 1
+        # 已取消的任务过多时重建堆，避免长超时下堆无限增长
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    deadline, _, handle, fn, args = self._heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self._heap)
+                        self._cancelled -= 1
+                        continue
+                    wait = deadline - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    # 出堆前在锁内再次确认未被取消（cancel()同样在锁内修改），出堆与标记为原子操作
+                    heapq.heappop(self._heap)
+                    handle.cancelled = True  # 已触发，之后的cancel()无效且不计数
+                    break
+            self.fired += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("定时任务执行失败: %s", e, exc_info=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {'timer_pending': len(self._heap) - self._cancelled, 'timer_cancelled': self._cancelled,
+                    'timer_fired': self.fired}
+
+
+class RetryLater(Exception):
+    """任务遇到可重试的失败；由调度方按RetryPolicy退避后重新执行，而不是在工作线程中sleep"""
+
+    def __init__(self, reason: str, errcode: Optional[int] = None):
+        super().__init__(reason)
+        self.errcode = errcode
+
+
+class RetryPolicy:
+    """
+    重试策略：带抖动的指数退避 + 按错误码区分可重试与不可重试
+
+    第attempt次重试前等待 [d/2, d] 内的随机时间，d = min(max_delay, base * 2^attempt)，
+    避免大量任务在同一时刻集中重试。
+    """
+
+    def __init__(self, max_attempts: int = 3, base: float = 1.0, max_delay: float = 30.0,
+                 fatal_errcodes: Iterable[int] = ()):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.max_delay = max_delay
+        self.fatal_errcodes = frozenset(fatal_errcodes)
+
+    def retryable(self, errcode: Optional[int]) -> bool:
+        """网络异常（errcode为None）与未列为不可重试的错误码均可重试"""
+        return errcode not in self.fatal_errcodes
+
+    def should_retry(self, attempt: int, errcode: Optional[int] = None) -> bool:
+        """第attempt次执行（从0开始）失败后是否还应重试"""
+        return attempt + 1 < self.max_attempts and self.retryable(errcode)
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+# 进程内共享的定时器
+deadline_timer = DeadlineTimer()
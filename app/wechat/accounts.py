@@ -0,0 +1,145 @@
+import json
+import os
+import time
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.utils.logger import logger
+from app.utils.readiness import FAILED, OK, PENDING
+from app.wechat.crypto import WeChatCrypto
+from app.wechat.token_manager import WECHAT_API_BASE, TokenManager
+
+# 公众号配置文件中每项必填的字段
+REQUIRED_FIELDS = ('appid', 'appsecret', 'token', 'aes_key')
+
+
+class Account:
+    """
+    单个公众号的配置与运行状态：消息加解密、access_token与客服消息发送
+
+    线程池、HTTP连接池、缓存等由所有公众号共享，每个公众号只在共享资源上占用自己的配额：
+    - max_pending: 外部服务排队+执行中的请求数上限（0表示只受全局上限限制）
+    - max_queued: 客服消息排队中的条数上限（0表示只受全局队列上限限制）
+    - send_rate/send_burst: 客服消息发送速率与突发容量（微信按appid计算配额，None表示使用全局设置）
+    """
+
+    def __init__(self, appid: str, appsecret: str, token: str, aes_key: str, token_manager: TokenManager,
+                 max_pending: int = 0, max_queued: int = 0, send_rate: Optional[float] = None,
+                 send_burst: Optional[int] = None):
+        self.appid = appid
+        self.appsecret = appsecret
+        self.crypto = WeChatCrypto(token, aes_key, appid)
+        self.token_manager = token_manager
+        self.max_pending = max_pending
+        self.max_queued = max_queued
+        self.send_rate = send_rate
+        self.send_burst = send_burst
+        self.async_handler = None  # 由init_routes创建（共享客服消息调度器）
+        self.pending = 0           # 由ExternalServiceAdapter在其准入锁内维护
+        self.rejected = 0
+
+    def token_status(self) -> Tuple[str, str]:
+        """access_token的就绪状态（/readyz）"""
+        token_manager = self.token_manager
+        remaining = token_manager.expires_at - time.time()
+        if token_manager.access_token and remaining > 0:
+            return OK, f"expires in {remaining:.0f}s"
+        if token_manager.last_error:
+            return FAILED, token_manager.last_error
+        return PENDING, 'refreshing'
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            'account_pending': self.pending,
+            'account_rejected': self.rejected,
+            'account_token_valid': int(bool(self.token_manager.access_token)),
+        }
+        if self.async_handler is not None:
+            stats.update(self.async_handler.quota_stats())
+        return stats
+
+
+class AccountRegistry:
+    """
+    公众号注册表
+
+    单公众号部署时只包含WECHAT_*配置的公众号；配置了ACCOUNTS_FILE时从文件加载多个公众号，
+    通过 /wechat/<appid> 区分。default为 /wechat 路由对应的公众号。
+    """
+
+    def __init__(self):
+        self._accounts: Dict[str, Account] = {}
+        self._lock = Lock()
+        self.default: Optional[Account] = None
+
+    def add(self, account: Account, default: bool = False):
+        with self._lock:
+            if account.appid in self._accounts:
+                raise ValueError(f"公众号重复配置: {account.appid}")
+            self._accounts[account.appid] = account
+        if default:
+            self.default = account
+
+    def get(self, appid: Optional[str]) -> Optional[Account]:
+        return self._accounts.get(appid) if appid else None
+
+    def __iter__(self) -> Iterator[Account]:
+        return iter(list(self._accounts.values()))
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    @classmethod
+    def from_config(cls, config) -> 'AccountRegistry':
+        registry = cls()
+        api_base = config.get('WECHAT_API_BASE', WECHAT_API_BASE)
+        check_interval = config['TOKEN_FILE_CHECK_INTERVAL']
+
+        if not config.get('ACCOUNTS_FILE'):
+            appid, appsecret = config['WECHAT_APPID'], config['WECHAT_APPSECRET']
+            token_manager = TokenManager(config['TOKEN_FILE_PATH'], file_check_interval=check_interval,
+                                         api_base=api_base, appid=appid, appsecret=appsecret)
+            registry.add(Account(appid, appsecret, config['WECHAT_TOKEN'], config['WECHAT_AES_KEY'], token_manager,
+                                 max_pending=config['ACCOUNT_MAX_PENDING'], max_queued=config['ACCOUNT_MAX_QUEUED']),
+                         default=True)
+            return registry
+
+        # 多公众号：每个公众号的token文件与TOKEN_FILE_PATH放在同一目录，按appid区分
+        token_dir = os.path.dirname(config['TOKEN_FILE_PATH'])
+        for entry in load_accounts_file(config['ACCOUNTS_FILE']):
+            appid = entry['appid']
+            token_manager = TokenManager(
+                entry.get('token_file') or os.path.join(token_dir, f"access_token_{appid}.json"),
+                file_check_interval=check_interval,
+                api_base=api_base,
+                appid=appid,
+                appsecret=entry['appsecret']
+            )
+            registry.add(Account(
+                appid, entry['appsecret'], entry['token'], entry['aes_key'], token_manager,
+                max_pending=int(entry.get('max_pending', config['ACCOUNT_MAX_PENDING'])),
+                max_queued=int(entry.get('max_queued', config['ACCOUNT_MAX_QUEUED'])),
+                send_rate=float(entry['send_rate']) if entry.get('send_rate') is not None else None,
+                send_burst=int(entry['send_burst']) if entry.get('send_burst') is not None else None
+            ), default=appid == config['WECHAT_APPID'])
+        logger.info(f"已加载{len(registry)}个公众号: {config['ACCOUNTS_FILE']}")
+        return registry
+
+
+def load_accounts_file(path: str) -> List[Dict]:
+    """
+    读取公众号配置文件（JSON数组）
+
+    [{"appid": "...", "appsecret": "...", "token": "...", "aes_key": "...",
+      "max_pending": 20, "max_queued": 500, "send_rate": 20, "send_burst": 40, "token_file": "..."}]
+    max_pending/max_queued/send_rate/send_burst/token_file可选。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f"公众号配置文件应为JSON数组: {path}")
+    for i, entry in enumerate(entries):
+        missing = [field for field in REQUIRED_FIELDS if not entry.get(field)]
+        if missing:
+            raise ValueError(f"公众号配置第{i + 1}项缺少字段: {', '.join(missing)}")
+    return entries
@@ -0,0 +1,152 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+
+from app.utils.logger import logger
+from app.utils.scheduler import DeadlineTimer, deadline_timer
+
+
+class _Fragment(Future):
+    """一条等待合并的消息，所在批次的外部服务调用结束后完成；opens_batch表示它是批次的第一条"""
+
+    def __init__(self, opens_batch: bool):
+        super().__init__()
+        self.opens_batch = opens_batch
+
+
+class _UserState:
+    __slots__ = ('messages', 'fragments', 'first_at', 'timer', 'in_flight', 'account')
+
+    def __init__(self, account=None):
+        self.account = account  # openid只属于一个公众号，批次随该用户的状态提交
+        self.messages: List = []
+        self.fragments: List[_Fragment] = []
+        self.first_at = 0.0
+        self.timer = None
+        self.in_flight = False
+
+
+class MessageCoalescer:
+    """
+    按openid合并短时间内连续发送的文本消息
+
+    - 收到消息后等待quiet_window秒，期间同一用户的新消息并入同一批次并重新计时；
+      自批次第一条消息起最多等待max_wait秒，达到max_fragments条时立即提交
+    - 每个用户同一时刻最多一个外部服务调用：上一批仍在生成时新消息先缓存，生成结束后再提交
+
+    submit(merged_msg, account)提交合并后的消息，返回外部服务调用的future（PendingReply），失败时返回None。
+    """
+
+    def __init__(self, submit: Callable[[Dict, object], Optional[Future]], quiet_window: float = 1.5,
+                 max_wait: float = 5.0, max_fragments: int = 10, timer: DeadlineTimer = deadline_timer):
+        self.submit = submit
+        self.quiet_window = quiet_window
+        self.max_wait = max(max_wait, quiet_window)
+        self.max_fragments = max(max_fragments, 1)
+        self.timer = timer
+        # 提交在单独的线程中进行，不占用定时器线程和外部服务的工作线程
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='coalescer')
+        self._users: Dict[str, _UserState] = {}
+        self._lock = Lock()
+        self.fragments = 0
+        self.batches = 0
+
+    @staticmethod
+    def accepts(msg) -> bool:
+        """只合并文本消息"""
+        return msg.get('MsgType') == 'text' and bool(msg.get('FromUserName'))
+
+    def add(self, msg, account=None) -> _Fragment:
+        openid = msg.get('FromUserName')
+        now = time.monotonic()
+        with self._lock:
+            state = self._users.get(openid)
+            if state is None:
+                state = self._users[openid] = _UserState(account)
+            fragment = _Fragment(opens_batch=not state.messages)
+            if not state.messages:
+                state.first_at = now
+            state.messages.append(msg)
+            state.fragments.append(fragment)
+            self.fragments += 1
+
+            if state.timer is not None:
+                state.timer.cancel()
+                state.timer = None
+            if len(state.messages) < self.max_fragments:
+                delay = min(self.quiet_window, state.first_at + self.max_wait - now)
+                if delay > 0:
+                    state.timer = self.timer.schedule(delay, self._on_quiet, openid)
+            batch = self._take_batch_locked(openid, state)
+        if batch:
+            self._executor.submit(self._submit_batch, openid, *batch)
+        return fragment
+
+    def _on_quiet(self, openid: str):
+        """静默窗口结束（定时器线程）"""
+        with self._lock:
+            state = self._users.get(openid)
+            if state is None:
+                return
+            state.timer = None
+            batch = self._take_batch_locked(openid, state)
+        if batch:
+            self._executor.submit(self._submit_batch, openid, *batch)
+
+    def _take_batch_locked(self, openid: str, state: _UserState):
+        """窗口已结束且该用户没有进行中的调用时取出待提交的批次"""
+        if state.timer is not None or state.in_flight:
+            return None
+        if not state.messages:
+            del self._users[openid]
+            return None
+        messages, fragments = state.messages, state.fragments
+        state.messages, state.fragments = [], []
+        state.in_flight = True
+        return messages, fragments, state.account
+
+    def _submit_batch(self, openid: str, messages: List, fragments: List[_Fragment], account=None):
+        if len(messages) == 1:
+            merged = messages[0]
+        else:
+            merged = dict(messages[-1])
+            merged['Content'] = '\n'.join(m.get('Content') or '' for m in messages)
+            logger.info("已合并%s条连续消息: %s", len(messages), openid)
+        self.batches += 1
+        try:
+            future = self.submit(merged, account)
+        except Exception as e:
+            logger.error("Coalesced submit failed: %s", e)
+            future = None
+        if future is None:
+            self._on_done(openid, fragments, None)
+            return
+        future.add_done_callback(lambda f: self._on_done(openid, fragments, f))
+
+    def _on_done(self, openid: str, fragments: List[_Fragment], future: Optional[Future]):
+        """批次的外部服务调用结束：完成其中的消息，并提交生成期间缓存的新消息"""
+        result = None
+        if future is not None and not future.cancelled() and future.exception() is None:
+            result = future.result()
+        for fragment in fragments:
+            fragment.set_result(result)
+        with self._lock:
+            state = self._users.get(openid)
+            if state is None:
+                return
+            state.in_flight = False
+            batch = self._take_batch_locked(openid, state)
+        if batch:
+            self._executor.submit(self._submit_batch, openid, *batch)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            waiting = sum(len(state.messages) for state in self._users.values())
+            users = len(self._users)
+        return {
+            'coalesce_fragments': self.fragments,
+            'coalesce_batches': self.batches,
+            'coalesce_waiting': waiting,
+            'coalesce_users': users,
+        }
@@ -0,0 +1,131 @@
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+from typing import Dict, List, Optional
+
+from app.utils.logger import logger
+
+
+class _UserHistory:
+    """单个用户的对话记录：固定长度的(用户消息, 助手回复)环形缓冲"""
+    __slots__ = ('turns', 'chars', 'last_seen')
+
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.chars = 0
+        self.last_seen = 0.0
+
+
+class ConversationStore:
+    """
+    按openid存储的对话上下文
+
+    每个用户保存最近若干轮对话，所有用户共享全局字符预算；
+    用户按最近访问顺序排列，超出预算、用户数上限或空闲超时的用户从最久未访问端淘汰。
+    记录与淘汰均为O(1)（均摊），适用于大量活跃用户。
+    """
+
+    def __init__(self, enabled: bool = False, max_turns: int = 6, max_users: int = 100000,
+                 max_total_chars: int = 20 * 1024 * 1024, idle_ttl: float = 1800,
+                 prompt_char_budget: int = 4000):
+        self._lock = Lock()
+        self._users: 'OrderedDict[str, _UserHistory]' = OrderedDict()
+        self.total_chars = 0
+        self.evictions = 0
+        self.configure(enabled, max_turns, max_users, max_total_chars, idle_ttl, prompt_char_budget)
+
+    def configure(self, enabled: bool, max_turns: int, max_users: int,
+                  max_total_chars: int, idle_ttl: float, prompt_char_budget: int):
+        with self._lock:
+            self.enabled = enabled
+            self.max_turns = max(max_turns, 1)
+            self.max_users = max_users
+            self.max_total_chars = max_total_chars
+            self.idle_ttl = idle_ttl
+            self.prompt_char_budget = prompt_char_budget
+            self._users.clear()
+            self.total_chars = 0
+        if enabled:
+            logger.info(f"对话上下文已启用: max_turns={self.max_turns}, max_users={max_users}, "
+                        f"max_total_chars={max_total_chars}, idle_ttl={idle_ttl}s")
+
+    def _evict_locked(self, now: float):
+        while self._users:
+            openid, history = next(iter(self._users.items()))
+            if (self.total_chars <= self.max_total_chars
+                    and len(self._users) <= self.max_users
+                    and now - history.last_seen < self.idle_ttl):
+                break
+            del self._users[openid]
+            self.total_chars -= history.chars
+            self.evictions += 1
+
+    def record_turn(self, openid: str, user_text: Optional[str], assistant_text: Optional[str]):
+        """记录一轮完整对话（仅在外部服务成功返回后调用）"""
+        if not self.enabled or not openid or not user_text or not assistant_text:
+            return
+        now = time.monotonic()
+        with self._lock:
+            history = self._users.get(openid)
+            if history is None or now - history.last_seen >= self.idle_ttl:
+                if history is not None:
+                    self.total_chars -= history.chars
+                history = _UserHistory(self.max_turns)
+                self._users[openid] = history
+            else:
+                self._users.move_to_end(openid)
+
+            if len(history.turns) == history.turns.maxlen:
+                old_user, old_assistant = history.turns[0]
+                dropped = len(old_user) + len(old_assistant)
+                history.chars -= dropped
+                self.total_chars -= dropped
+
+            added = len(user_text) + len(assistant_text)
+            history.turns.append((user_text, assistant_text))
+            history.chars += added
+            history.last_seen = now
+            self.total_chars += added
+            self._evict_locked(now)
+
+    def history(self, openid: str, current_chars: int = 0) -> List[tuple]:
+        """返回在单次提示字符预算内的最近对话（由旧到新）"""
+        if not self.enabled or not openid:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            history = self._users.get(openid)
+            if history is None or now - history.last_seen >= self.idle_ttl:
+                return []
+            turns = list(history.turns)
+
+        budget = self.prompt_char_budget - current_chars
+        selected = []
+        for user_text, assistant_text in reversed(turns):
+            budget -= len(user_text) + len(assistant_text)
+            if budget < 0:
+                break
+            selected.append((user_text, assistant_text))
+        selected.reverse()
+        return selected
+
+    def build_messages(self, openid: str, content: Optional[str]) -> List[Dict[str, str]]:
+        """构建OpenAI风格的messages列表（历史对话 + 当前消息）"""
+        messages = []
+        for user_text, assistant_text in self.history(openid, len(content or '')):
+            messages.append({"role": "user", "content": user_text})
+            messages.append({"role": "assistant", "content": assistant_text})
+        messages.append({"role": "user", "content": content})
+        return messages
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'conversation_users': len(self._users),
+                'conversation_chars': self.total_chars,
+                'conversation_evictions': self.evictions,
+            }
+
+
+# 默认共享实例（由init_routes根据配置启用）
+conversation_store = ConversationStore()
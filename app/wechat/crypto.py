@@ -1,16 +1,27 @@
 import base64
 import binascii
 import hashlib
-import random
-import string
+import logging
+import os
 import time
 from Crypto.Cipher import AES
 from app.utils.logger import logger
+from app.utils.metrics import stage_seconds
+
+# 微信消息加解密使用32字节块的PKCS7填充
+_BLOCK_SIZE = 32
+# 预生成的填充字节串：_PADDING[n] == bytes([n]) * n
+_PADDING = [bytes([n]) * n for n in range(_BLOCK_SIZE + 1)]
+_CDATA_PREFIX = '<![CDATA['
+_CDATA_SUFFIX = ']]>'
+# 明文头部：random(16B) + msg_len(4B)
+PLAINTEXT_HEADER_SIZE = 20
 
 class WeChatCrypto:
     def __init__(self, token, encoding_aes_key, app_id):
         self.token = token
         self.app_id = app_id
+        self._app_id_bytes = app_id.encode()
         self.aes_key = base64.b64decode(encoding_aes_key + "=")
         self.iv = self.aes_key[:16]
         logger.info('WeChatCrypto initialized')
@@ -21,101 +32,127 @@ class WeChatCrypto:
 
     def check_signature(self, signature, timestamp, nonce):
         """验证消息签名"""
+        start = time.perf_counter()
         params = sorted([self.token, timestamp, nonce])
         sha1 = hashlib.sha1(''.join(params).encode()).hexdigest()
         is_valid = sha1 == signature
+        stage_seconds.observe(time.perf_counter() - start, 'signature')
         if not is_valid:
-            logger.warning(f'Invalid signature: expected={sha1}, received={signature}')
+            logger.warning('Invalid signature: expected=%s, received=%s', sha1, signature)
         return is_valid
 
     def decrypt_message(self, encrypted_msg, signature, timestamp, nonce):
         """解密微信消息（新增签名验证）"""
+        return str(self.decrypt_to_bytes(encrypted_msg, signature, timestamp, nonce), 'utf-8')
+
+    def decrypt_to_bytes(self, encrypted_msg, signature, timestamp, nonce) -> memoryview:
+        """
+        解密微信消息，返回明文XML的memoryview（不复制解密缓冲区）
+
+        同时校验PKCS7填充、消息长度与尾部appid，任一不符即抛出ValueError。
+        """
         # 先验证消息签名
         if not self.check_signature(signature, timestamp, nonce):
             raise ValueError("Invalid message signature")
 
+        start = time.perf_counter()
         try:
             # 确保输入是字符串
-            if isinstance(encrypted_msg, bytes):
-                encrypted_msg = encrypted_msg.decode('utf-8')
+            if isinstance(encrypted_msg, (bytes, bytearray, memoryview)):
+                encrypted_msg = str(encrypted_msg, 'ascii')
             elif not isinstance(encrypted_msg, str):
-                logger.error(f'Invalid input type: {type(encrypted_msg)}')
+                logger.error('Invalid input type: %s', type(encrypted_msg))
                 raise ValueError('Encrypted message must be a string')
 
             # 移除CDATA包装（如果存在）
-            encrypted_msg = encrypted_msg.replace('<![CDATA[', '').replace(']]>', '')
-
-            logger.debug(f'Encrypted message after preprocessing: {encrypted_msg}')
+            encrypted_msg = encrypted_msg.strip()
+            if encrypted_msg.startswith(_CDATA_PREFIX) and encrypted_msg.endswith(_CDATA_SUFFIX):
+                encrypted_msg = encrypted_msg[len(_CDATA_PREFIX):-len(_CDATA_SUFFIX)]
 
-            # 处理base64填充
-            pad_length = len(encrypted_msg) % 4
-            if pad_length:
-                encrypted_msg += '=' * (4 - pad_length)
+            # 处理base64填充（仅在缺失时补齐）
+            missing = -len(encrypted_msg) % 4
+            if missing:
+                encrypted_msg += '=' * missing
 
             # 解密
-            cipher = self._create_cipher()
-            decrypted = cipher.decrypt(base64.b64decode(encrypted_msg))
+            decrypted = self._create_cipher().decrypt(binascii.a2b_base64(encrypted_msg))
+            view = memoryview(decrypted)
+            total = len(decrypted)
 
-            # 去除PKCS7填充
-            pad = decrypted[-1]
-            if not isinstance(pad, int):
-                pad = ord(pad)
-            content = decrypted[:-pad]
+            # 校验并去除PKCS7填充
+            pad = decrypted[-1] if total else 0
+            if not 1 <= pad <= _BLOCK_SIZE or pad > total or not decrypted.endswith(_PADDING[pad]):
+                raise ValueError('Invalid PKCS7 padding')
+            end = total - pad
 
             # 解析解密后的内容
             # content = random(16B) + msg_len(4B) + msg + appid
-            msg_len = int.from_bytes(content[16:20], byteorder='big')
-            xml_content = content[20:20+msg_len].decode('utf-8')
-
-            logger.debug(f'Message length from bytes: {msg_len}')
-            logger.debug(f'Extracted XML content: {xml_content}')
-
-            return xml_content
+            if end < 20:
+                raise ValueError('Decrypted content too short')
+            msg_len = int.from_bytes(view[16:20], byteorder='big')
+            msg_end = 20 + msg_len
+            if msg_end > end:
+                raise ValueError('Invalid message length')
+            if view[msg_end:end] != self._app_id_bytes:
+                raise ValueError('AppID mismatch')
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Message length from bytes: %d', msg_len)
+                logger.debug('Extracted XML content: %s', str(view[20:msg_end], 'utf-8', 'replace'))
+
+            stage_seconds.observe(time.perf_counter() - start, 'decrypt')
+            return view[20:msg_end]
 
         except binascii.Error as e:
-            logger.error(f'Base64 decoding error: {str(e)}', exc_info=True)
+            logger.error('Base64 decoding error: %s', e, exc_info=True)
             raise
         except Exception as e:
-            logger.error(f'Failed to decrypt message: {str(e)}', exc_info=True)
+            logger.error('Failed to decrypt message: %s', e, exc_info=True)
             raise
 
     def encrypt_message(self, reply_msg, nonce):
         """加密回复消息（新增nonce参数）"""
+        msg = reply_msg.encode() if isinstance(reply_msg, str) else reply_msg
+        buf = bytearray(PLAINTEXT_HEADER_SIZE)
+        buf += msg
+        return self.encrypt_buffer(buf).decode('ascii')
+
+    def encrypt_buffer(self, buf: bytearray) -> bytes:
+        """
+        就地加密明文缓冲区，返回base64编码的密文
+
+        buf的前PLAINTEXT_HEADER_SIZE字节为预留头部，其后是待加密的消息；
+        随机串、消息长度、appid与PKCS7填充都直接写入buf，不再拼接中间字节串。
+        """
+        start = time.perf_counter()
         try:
-            # 生成16字节的随机字符串
-            random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-
-            # 计算消息长度，转换为网络字节序(big-endian)
-            msg_len = len(reply_msg.encode())
-            msg_len_bytes = msg_len.to_bytes(4, byteorder='big')
-
-            # 拼接明文: random(16B) + msg_len(4B) + msg + appid
-            text = random_str.encode() + msg_len_bytes + reply_msg.encode() + self.app_id.encode()
+            msg_len = len(buf) - PLAINTEXT_HEADER_SIZE
+            if msg_len < 0:
+                raise ValueError('Plaintext buffer is missing the reserved header')
 
-            # PKCS7 填充
-            block_size = 32
-            amount_to_pad = block_size - (len(text) % block_size)
-            if amount_to_pad == 0:
-                amount_to_pad = block_size
-            pad = chr(amount_to_pad)
-            padded_text = text + (pad * amount_to_pad).encode()
+            # 明文: random(16B) + msg_len(4B) + msg + appid + padding
+            buf[0:16] = os.urandom(16)
+            buf[16:20] = msg_len.to_bytes(4, byteorder='big')
+            buf += self._app_id_bytes
+            amount_to_pad = _BLOCK_SIZE - (len(buf) % _BLOCK_SIZE)
+            buf += _PADDING[amount_to_pad]
 
             # 使用新的cipher实例进行加密
-            cipher = self._create_cipher()
-            encrypted = base64.b64encode(cipher.encrypt(padded_text))
+            encrypted = base64.b64encode(self._create_cipher().encrypt(buf))
 
-            logger.debug(f'Random str: {random_str}')
-            logger.debug(f'Message length: {msg_len}')
-            logger.debug(f'Padded text length: {len(padded_text)}')
-            logger.debug('Message encrypted successfully')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Message length: %d', msg_len)
+                logger.debug('Padded text length: %d', len(buf))
+                logger.debug('Message encrypted successfully')
 
-            return encrypted.decode('utf-8')
+            stage_seconds.observe(time.perf_counter() - start, 'encrypt')
+            return encrypted
 
         except Exception as e:
-            logger.error(f'Failed to encrypt message: {str(e)}', exc_info=True)
+            logger.error('Failed to encrypt message: %s', e, exc_info=True)
             raise
 
     def generate_signature(self, encrypted_msg, timestamp, nonce):
         """生成消息签名"""
         params = sorted([self.token, timestamp, nonce, encrypted_msg])
-        return hashlib.sha1(''.join(params).encode()).hexdigest()
\ No newline at end of file
+        return hashlib.sha1(''.join(params).encode()).hexdigest()
@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+from app.utils.logger import logger
+
+
+def _chain_future(source: Future, target: Future):
+    """将source的结果转发到target"""
+    def _done(f: Future):
+        if target.done():
+            return
+        if f.cancelled():
+            target.cancel()
+            return
+        exc = f.exception()
+        if exc is not None:
+            target.set_exception(exc)
+        else:
+            target.set_result(f.result())
+
+    source.add_done_callback(_done)
+
+
+class MessageDeduplicator:
+    """
+    微信消息去重（TTL + LRU）
+
+    微信服务器在5秒内未收到响应时会重发同一条消息（最多3次）。
+    以MsgId（事件消息使用FromUserName+CreateTime）为键缓存首次请求的future，
+    重试请求直接复用该future，不再重复调用外部服务。
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[float, Future]]' = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0        # 重试到达时首次请求已完成
+        self.coalesced = 0   # 重试到达时首次请求仍在处理中，复用其future
+        self.evictions = 0   # 因过期或容量淘汰的条目数
+
+    @staticmethod
+    def make_key(msg: Dict, namespace: Optional[str] = None) -> Optional[str]:
+        """
+        普通消息使用MsgId，事件消息使用FromUserName+CreateTime
+
+        namespace（公众号appid）不为空时作为前缀，多个公众号的消息互不冲突。
+        """
+        msg_id = msg.get('MsgId')
+        if msg_id:
+            key = f"id:{msg_id}"
+        else:
+            from_user = msg.get('FromUserName')
+            create_time = msg.get('CreateTime')
+            if not (from_user and create_time):
+                return None
+            key = f"ev:{from_user}:{create_time}"
+        return f"{namespace}/{key}" if namespace else key
+
+    @staticmethod
+    def namespace_of(key: str) -> Optional[str]:
+        """取出make_key生成的键中的namespace，没有时返回None"""
+        namespace, sep, _ = key.partition('/')
+        return namespace if sep else None
+
+    def _evict_locked(self, now: float):
+        # 条目按插入/访问顺序排列，从头部淘汰过期条目和超出容量的条目
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            del self._entries[key]
+            self.evictions += 1
+
+    def get_or_submit(self, key: str, submit: Callable[[], Optional[Future]]) -> Tuple[Optional[Future], bool]:
+        """
+        查找或提交请求
+
+        Args:
+            key: 去重键
+            submit: 首次请求时调用，返回外部服务调用的future
+
+        Returns:
+            (future, is_new): is_new为True时返回submit提交的future（提交失败时为None），
+            为False表示命中了已有请求
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                future = entry[1]
+                if future.done():
+                    self.hits += 1
+                else:
+                    self.coalesced += 1
+                return future, False
+
+            # 先占位，避免并发重试在submit期间重复提交
+            placeholder = Future()
+            self._entries[key] = (now + self.ttl, placeholder)
+            self._entries.move_to_end(key)
+            self._evict_locked(now)
+
+        try:
+            future = submit()
+        except Exception as e:
+            logger.error("Dedup submit failed: %s", e)
+            future = None
+
+        if future is None:
+            # 提交失败时移除占位，允许后续重试重新提交
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is placeholder:
+                    del self._entries[key]
+            placeholder.set_result(None)
+            return None, True
+
+        _chain_future(future, placeholder)
+        return future, True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'dedup_hits': self.hits,
+                'dedup_coalesced': self.coalesced,
+                'dedup_evictions': self.evictions,
+                'dedup_size': len(self._entries),
+            }
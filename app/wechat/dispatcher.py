@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from app.utils.logger import logger
+from app.utils.scheduler import DeadlineTimer, RetryLater, RetryPolicy, deadline_timer
+
+
+class DispatcherFullError(RuntimeError):
+    """发送队列已满且在等待时间内没有空位"""
+
+
+class TokenBucket:
+    """令牌桶限流（线程安全）"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预占一个令牌（不阻塞）；返回令牌可用前还需等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self) -> float:
+        """获取一个令牌，必要时阻塞等待；返回等待的秒数"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class OutboundDispatcher:
+    """
+    出站消息调度器
+
+    - 令牌桶限流，与公众号客服消息接口的调用配额匹配：提交时指定bucket（如appid）的任务
+      使用该bucket独立的令牌桶（add_bucket登记速率，默认与rate/burst相同），未指定时共用默认令牌桶。
+      令牌不足时任务延后到令牌可用时再执行，等待期间不占用工作线程，某个bucket限流不影响其他bucket
+    - 同一个key（openid）的任务严格按提交顺序串行执行
+    - 队列深度有上限，队列满时提交方最多等待enqueue_timeout秒后被拒绝（背压）
+    - 任务抛出RetryLater时按retry_policy退避重试：等待期间不占用工作线程，
+      该key保持占用，后续任务不会越过它先发送
+    """
+
+    def __init__(self, workers: int = 20, rate: float = 50, burst: int = 100,
+                 max_queue: int = 5000, enqueue_timeout: float = 1.0, name: str = 'dispatcher',
+                 retry_policy: Optional[RetryPolicy] = None, timer: DeadlineTimer = deadline_timer):
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(rate, burst)
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timer = timer
+        self.max_queue = max_queue
+        self.enqueue_timeout = enqueue_timeout
+        self._lock = threading.Lock()
+        self._has_ready = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._queues: Dict[Hashable, deque] = {}  # key -> 待执行任务；执行中的key也保留在此
+        self._ready: deque = deque()              # 可被领取的key
+        self._queued = 0
+        self._active = 0
+        self._retry_waiting = 0
+        self._throttle_waiting = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.retries = 0
+        self.retries_exhausted = 0
+        self.throttled = 0
+        self.throttle_wait_total = 0.0
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f'{name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def add_bucket(self, name: Hashable, rate: Optional[float] = None, burst: Optional[int] = None) -> TokenBucket:
+        """登记（或更新）一个独立限流的令牌桶；rate/burst为None时与默认令牌桶相同"""
+        bucket = TokenBucket(self.rate if rate is None else rate, self.burst if burst is None else burst)
+        with self._lock:
+            self._buckets[name] = bucket
+        return bucket
+
+    def submit(self, key: Hashable, fn: Callable, *args, bucket: Optional[Hashable] = None, **kwargs) -> Future:
+        """提交任务；同一key的任务按顺序执行，bucket指定所用的令牌桶（未登记的bucket按默认速率创建）"""
+        future = Future()
+        with self._lock:
+            if bucket is None:
+                limiter = self.bucket
+            else:
+                limiter = self._buckets.get(bucket)
+                if limiter is None:
+                    limiter = self._buckets[bucket] = TokenBucket(self.rate, self.burst)
+            if not self._not_full.wait_for(lambda: self._queued < self.max_queue, self.enqueue_timeout):
+                self.rejected += 1
+                future.set_exception(DispatcherFullError(f"dispatch queue full ({self.max_queue})"))
+                return future
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = deque()
+                self._queues[key] = queue
+                self._ready.append(key)
+                self._has_ready.notify()
+            queue.append((future, fn, args, kwargs, limiter, 0, False))
+            self._queued += 1
+            self.submitted += 1
+        return future
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._has_ready.wait()
+                key = self._ready.popleft()
+                future, fn, args, kwargs, limiter, attempt, reserved = self._queues[key].popleft()
+                if attempt == 0 and not reserved:
+                    self._queued -= 1
+                    self._not_full.notify()
+                self._active += 1
+
+            if not reserved and (attempt > 0 or future.set_running_or_notify_cancel()):
+                waited = limiter.reserve()
+                if waited > 0:
+                    # 令牌已预占：放回队首并释放工作线程，到期后由定时器线程重新放入就绪队列
+                    with self._lock:
+                        self._active -= 1
+                        self._queues[key].appendleft((future, fn, args, kwargs, limiter, attempt, True))
+                        self._throttle_waiting += 1
+                        self.throttled += 1
+                        self.throttle_wait_total += waited
+                    self.timer.schedule(waited, self._throttle_ready, key)
+                    continue
+                reserved = True
+
+            retry_delay = None
+            if reserved:  # 未被取消
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except RetryLater as e:
+                    if self.retry_policy.should_retry(attempt, e.errcode):
+                        retry_delay = self.retry_policy.backoff(attempt)
+                        logger.warning("任务失败，%.1f秒后重试 (尝试 %s/%s): %s",
+                                       retry_delay, attempt + 1, self.retry_policy.max_attempts, e)
+                    else:
+                        with self._lock:
+                            self.retries_exhausted += 1
+                        future.set_exception(e)
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._lock:
+                self._active -= 1
+                if retry_delay is not None:
+                    # 放回队首但不标记为可领取，到期后由定时器线程重新放入就绪队列
+                    self._queues[key].appendleft((future, fn, args, kwargs, limiter, attempt + 1, False))
+                    self._retry_waiting += 1
+                    self.retries += 1
+                else:
+                    self.completed += 1
+                    if self._queues[key]:
+                        self._ready.append(key)
+                        self._has_ready.notify()
+                    else:
+                        del self._queues[key]
+            if retry_delay is not None:
+                self.timer.schedule(retry_delay, self._retry_ready, key)
+
+    def _retry_ready(self, key: Hashable):
+        with self._lock:
+            self._retry_waiting -= 1
+            self._ready.append(key)
+            self._has_ready.notify()
+
+    def _throttle_ready(self, key: Hashable):
+        with self._lock:
+            self._throttle_waiting -= 1
+            self._ready.append(key)
+            self._has_ready.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'dispatch_queue_length': self._queued,
+                'dispatch_active': self._active,
+                'dispatch_keys': len(self._queues),
+                'dispatch_submitted': self.submitted,
+                'dispatch_completed': self.completed,
+                'dispatch_rejected': self.rejected,
+                'dispatch_retry_waiting': self._retry_waiting,
+                'dispatch_retries': self.retries,
+                'dispatch_retries_exhausted': self.retries_exhausted,
+                'dispatch_throttle_waiting': self._throttle_waiting,
+                'dispatch_throttled': self.throttled,
+                'dispatch_throttle_wait_seconds': self.throttle_wait_total,
+            }
@@ -0,0 +1,159 @@
+import html
+import re
+from typing import Any, Dict, Iterator, Optional, Union
+from xml.etree import ElementTree as ET
+
+_XML_OPEN = b'<xml>'
+_XML_CLOSE = re.compile(rb'\s*</xml\s*>')
+# 一级字段：<Tag><![CDATA[...]]></Tag> 或 <Tag>text</Tag>
+_ELEMENT = re.compile(
+    rb'\s*<(\w+)>\s*(?:<!\[CDATA\[([^\]]*(?:\](?!\]>)[^\]]*)*)\]\]>\s*|([^<]*))</\1>')
+
+BytesLike = Union[bytes, bytearray, memoryview, str]
+
+
+class EnvelopeParseError(ET.ParseError):
+    """微信消息XML格式错误"""
+
+
+class WeChatMessage:
+    """
+    解析后的微信消息
+
+    常用字段保存在__slots__中，其余字段放在extra字典里；
+    提供与dict相同的get/[]/in/keys/items接口，可直接替换原先的dict结果。
+    """
+    __slots__ = ('ToUserName', 'FromUserName', 'CreateTime', 'MsgType', 'Content', 'MsgId',
+                 'Event', 'EventKey', 'MediaId', 'PicUrl', 'Format', 'Recognition', 'Encrypt',
+                 'extra')
+    _FIELDS = frozenset(__slots__) - {'extra'}
+
+    def __init__(self):
+        self.ToUserName = self.FromUserName = self.CreateTime = self.MsgType = None
+        self.Content = self.MsgId = self.Event = self.EventKey = None
+        self.MediaId = self.PicUrl = self.Format = self.Recognition = self.Encrypt = None
+        self.extra = None
+
+    def _set(self, key: str, value: Optional[str]):
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in self._FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._set(key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self) -> Iterator[str]:
+        for key in self.__slots__[:-1]:
+            if getattr(self, key) is not None:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def items(self) -> Iterator[tuple]:
+        for key in self.keys():
+            yield key, self[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.keys())
+
+    def __bool__(self) -> bool:
+        return any(True for _ in self.keys())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def copy(self) -> 'WeChatMessage':
+        msg = WeChatMessage()
+        for key, value in self.items():
+            msg._set(key, value)
+        return msg
+
+    def __repr__(self) -> str:
+        return f"WeChatMessage({self.to_dict()!r})"
+
+
+_MISSING = object()
+
+
+def _decode_text(raw: bytes) -> str:
+    text = raw.decode('utf-8')
+    return html.unescape(text) if '&' in text else text
+
+
+def _parse_with_elementtree(data: bytes) -> WeChatMessage:
+    """嵌套结构（如部分事件推送）使用ElementTree解析，仅保留第一层字段"""
+    msg = WeChatMessage()
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise EnvelopeParseError(str(e)) from e
+    for child in root:
+        msg._set(child.tag, child.text)
+    return msg
+
+
+def parse_envelope(data: BytesLike) -> WeChatMessage:
+    """
+    单遍解析微信的扁平XML消息
+
+    用一个预编译的正则在字节上按顺序匹配每个一级字段：CDATA内容原样保留，
+    普通文本反转义XML实体（与ElementTree结果一致）。遇到嵌套元素、自闭合标签或被拆分的CDATA段时回退到ElementTree。
+
+    Raises:
+        EnvelopeParseError: XML格式错误
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
+        data = bytes(data)
+
+    start = data.find(_XML_OPEN)
+    if start < 0:
+        raise EnvelopeParseError('missing <xml> root element')
+    pos = start + len(_XML_OPEN)
+    msg = WeChatMessage()
+    fields = WeChatMessage._FIELDS
+    match = _ELEMENT.match
+
+    m = match(data, pos)
+    while m is not None:
+        tag, cdata, text = m.groups()
+        key = tag.decode('ascii')
+        if cdata is not None:
+            value = cdata.decode('utf-8')
+        else:
+            value = _decode_text(text) if text.strip() else None
+        if key in fields:
+            setattr(msg, key, value)
+        else:
+            msg._set(key, value)
+        pos = m.end()
+        m = match(data, pos)
+
+    if _XML_CLOSE.match(data, pos) is None:
+        # 非扁平结构，交给ElementTree处理
+        return _parse_with_elementtree(data[start:])
+    return msg
@@ -1,17 +1,69 @@
-import requests
 import json
 from typing import Optional, Dict, Any, Callable
-from app.utils.logger import logger
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-from app.wechat.token_manager import TokenManager
+from app.utils.logger import logger, payload_logging_enabled
+from app.utils.http_client import http_client
+from app.utils.scheduler import RetryLater, RetryPolicy, deadline_timer
+from app.utils.circuit_breaker import CircuitBreakerRegistry
+from app.utils.load_balancer import Endpoint, EndpointPool
+from app.utils.metrics import (InstrumentedThreadPoolExecutor, custom_message_errcodes, custom_message_seconds,
+                               external_service_seconds)
+from concurrent.futures import Future, ThreadPoolExecutor
+from app.wechat.token_manager import TOKEN_INVALID_ERRCODES, WECHAT_API_BASE, TokenManager
+from app.wechat.conversation import conversation_store
+from app.wechat.streaming import STREAM_PARSERS, SegmentBuffer
+from app.wechat.dispatcher import DispatcherFullError, OutboundDispatcher
+from app.wechat.dedup import MessageDeduplicator
+from app.wechat.outbox import DurableOutbox
+from app.wechat.media import MediaPipeline
+from threading import Event, Lock
+from collections import OrderedDict
+import hashlib
+import re
 import time
 
+# 客服消息接口不可重试的错误码（重试也不会成功），其余错误码与网络异常按退避策略重试：
+# 40003 openid无效，40008 消息类型无效，43004 用户未关注，45002 内容超长，45009 接口调用超过日限额，
+# 45015 回复时间超过限制（48小时），45047 客服接口下行条数超过上限，48001 接口未授权，61007 接口未授权给第三方平台
+CUSTOM_MESSAGE_FATAL_ERRCODES = (40003, 40008, 43004, 45002, 45009, 45015, 45047, 48001, 61007)
+
+# 记录对话上下文的服务类型（其映射器会读取历史对话）
+CONVERSATION_SERVICE_TYPES = ('openai', 'ollama')
+
+# 以base64内联图片的服务类型，其余服务类型以文件引用（本地路径）传递图片与语音
+MEDIA_INLINE_SERVICE_TYPES = ('openai', 'ollama')
+
+# 图片消息没有文字内容时随图片发送的提示词
+IMAGE_PROMPT = '请描述这张图片。'
+
 class AsyncResponseHandler:
-    def __init__(self, token_manager: TokenManager, appid: str, appsecret: str):
+    def __init__(self, token_manager: TokenManager, appid: str, appsecret: str,
+                 rate: float = 50, burst: int = 100, max_queue: int = 5000, enqueue_timeout: float = 1.0,
+                 outbox: Optional[DurableOutbox] = None, api_base: str = WECHAT_API_BASE,
+                 max_workers: int = 20, retry_policy: Optional[RetryPolicy] = None,
+                 dispatcher: Optional[OutboundDispatcher] = None, max_queued: int = 0):
         self.token_manager = token_manager
+        self.max_workers = max_workers
+        self.api_base = api_base
         self.appid = appid
         self.appsecret = appsecret
-        self.executor = ThreadPoolExecutor(max_workers=20)
+        self.outbox = outbox
+        # 客服消息经调度器发送：按appid限流 + 同一openid顺序发送 + 有界队列；多公众号时共用同一个调度器
+        self.dispatcher = dispatcher or OutboundDispatcher(
+            workers=self.max_workers,
+            rate=rate,
+            burst=burst,
+            max_queue=max_queue,
+            enqueue_timeout=enqueue_timeout,
+            name='custom-send',
+            retry_policy=retry_policy or RetryPolicy(fatal_errcodes=CUSTOM_MESSAGE_FATAL_ERRCODES)
+        )
+        # 客服消息接口的调用配额按公众号计算：共享调度器中每个公众号使用自己的令牌桶
+        self.dispatcher.add_bucket(appid, rate, burst)
+        # 本公众号在调度器中排队+发送中的消息数上限（0表示不限），避免单个公众号占满共享队列
+        self.max_queued = max_queued
+        self._queued = 0
+        self._queued_lock = Lock()
+        self.quota_rejected = 0
 
     def _build_message_payload(self, external_resp: Dict, openid: str) -> Optional[Dict]:
         """增加默认消息处理"""
@@ -29,7 +81,7 @@ class AsyncResponseHandler:
                 if '\\u' in content:
                     content = bytes(content, 'utf-8').decode('unicode_escape')
             except Exception as e:
-                logger.warning(f"Content decode failed: {str(e)}")
+                logger.warning("Content decode failed: %s", e)
 
         payload = {
             "touser": openid,
@@ -39,141 +91,818 @@ class AsyncResponseHandler:
 
         return payload
 
-    def _send_custom_message(self, openid: str, payload: Dict, max_retries: int = 3):
-        """实际发送客服消息"""
-        for attempt in range(max_retries):
-            try:
-                access_token = self.token_manager.get_token(self.appid, self.appsecret)
-                if not access_token:
-                    logger.error("Failed to get access token for customer service message")
-                    return
+    def _post_custom_message(self, access_token: str, payload: Dict) -> Dict:
+        url = f"{self.api_base}/cgi-bin/message/custom/send?access_token={access_token}"
+        start = time.perf_counter()
+        try:
+            response = http_client.post(url, data=json.dumps(payload, ensure_ascii=False).encode('utf-8'), timeout=5)
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            custom_message_errcodes.inc('exception')
+            raise
+        finally:
+            custom_message_seconds.observe(time.perf_counter() - start)
+        custom_message_errcodes.inc(str(result.get('errcode', 0)))
+        return result
 
-                # 确保消息内容已解码
-                if isinstance(payload.get('text', {}).get('content'), str):
-                    content = payload['text']['content']
-                    if '\\u' in content:
-                        try:
-                            decoded_content = bytes(content, 'utf-8').decode('unicode_escape')
-                            payload['text']['content'] = decoded_content
-                        except Exception as e:
-                            logger.warning(f"Content decode failed in send: {str(e)}")
-
-                url = f"https://api.weixin.qq.com/cgi-bin/message/custom/send?access_token={access_token}"
-                response = requests.post(url, data=json.dumps(payload, ensure_ascii=False).encode('utf-8'), timeout=5)
-                response.raise_for_status()
+    def _send_custom_message(self, openid: str, payload: Dict) -> bool:
+        """
+        实际发送客服消息
+
+        可重试的失败抛出RetryLater，由调度器按退避策略稍后重新执行，不在工作线程中等待；
+        不可重试的错误码直接返回False。
+        """
+        access_token = self.token_manager.get_token(self.appid, self.appsecret)
+        if not access_token:
+            if self.token_manager.last_error_retryable:
+                raise RetryLater(f"access_token unavailable: {self.token_manager.last_error}")
+            logger.error("Failed to get access token for customer service message")
+            return False
 
-                result = response.json()
-                if result.get("errcode") == 0:
-                    return True
+        # 确保消息内容已解码
+        if isinstance(payload.get('text', {}).get('content'), str):
+            content = payload['text']['content']
+            if '\\u' in content:
+                try:
+                    decoded_content = bytes(content, 'utf-8').decode('unicode_escape')
+                    payload['text']['content'] = decoded_content
+                except Exception as e:
+                    logger.warning("Content decode failed in send: %s", e)
 
-                if attempt < max_retries - 1:  # 非最后一次重试
-                    logger.warning(f"重试发送客服消息 (尝试 {attempt + 1}/{max_retries})")
-                    time.sleep(2 ** attempt)  # 指数退避
-                    continue
+        try:
+            result = self._post_custom_message(access_token, payload)
+            if result.get("errcode") in TOKEN_INVALID_ERRCODES:
+                # token已失效：单飞刷新后立即用新token重发一次
+                new_token = self.token_manager.invalidate(self.appid, self.appsecret, access_token)
+                if new_token:
+                    result = self._post_custom_message(new_token, payload)
+        except Exception as e:
+            raise RetryLater(f"request error: {e}") from e
 
-                logger.error(f"Failed to send customer service message: {result}")
+        errcode = result.get("errcode", 0)
+        if errcode == 0:
+            return True
+        if self.dispatcher.retry_policy.retryable(errcode):
+            raise RetryLater(f"{errcode}: {result.get('errmsg')}", errcode=errcode)
+        logger.error("Failed to send customer service message: %s", result)
+        return False
 
-            except Exception as e:
-                if attempt < max_retries - 1:  # 非最后一次重试
-                    logger.warning(f"重试发送客服消息 (尝试 {attempt + 1}/{max_retries})")
-                    time.sleep(2 ** attempt)  # 指数退避
-                    continue
-                logger.error(f"Error sending customer service message: {str(e)}")
-
-    def send_async_response(self, openid: str, external_resp: Dict):
-        """异步发送客服消息"""
-        # 使用ensure_ascii=False来正确显示中文
-        logger.debug(f"Sending customer service message to {openid}: \n{json.dumps(external_resp, ensure_ascii=False, indent=2)}")
-        future = self.executor.submit(self._send_custom_message, openid, external_resp)
+    def send_async_response(self, openid: str, external_resp: Dict, outbox_key: Optional[str] = None) -> Future:
+        """
+        异步发送客服消息，返回发送任务的future
+
+        outbox_key不为空且启用了持久化队列时，消息在发送前先落盘，发送结束后标记完成，
+        进程重启后未完成的消息会被重新发送。
+        """
+        if payload_logging_enabled(openid):
+            # 使用ensure_ascii=False来正确显示中文
+            logger.debug("Sending customer service message to %s: \n%s",
+                         openid, json.dumps(external_resp, ensure_ascii=False, indent=2))
+        durable = self.outbox is not None and outbox_key is not None
+        if durable:
+            self.outbox.enqueue(outbox_key, 'reply', openid, external_resp)
+        if self._take_quota():
+            send = self._send_unless_done if durable else self._send_custom_message
+            args = (outbox_key, openid, external_resp) if durable else (openid, external_resp)
+            future = self.dispatcher.submit(openid, send, *args, bucket=self.appid)
+            future.add_done_callback(self._release_quota)
+        else:
+            self.quota_rejected += 1
+            future = Future()
+            future.set_exception(DispatcherFullError(f"account send quota exceeded ({self.max_queued})"))
 
         def _callback(future):
+            rejected = False
             try:
                 result = future.result()
                 if result:
-                    logger.info(f"Successfully sent message to {openid}")
+                    logger.info("Successfully sent message to %s", openid)
                 else:
-                    logger.error(f"Failed to send message to {openid}")
+                    logger.error("Failed to send message to %s", openid)
+            except DispatcherFullError as e:
+                rejected = True
+                logger.error("Message to %s rejected: %s", openid, e)
+            except RetryLater as e:
+                logger.error("Failed to send message to %s after retries: %s", openid, e)
             except Exception as e:
-                logger.error(f"Message sending callback error: {str(e)}")
+                logger.error("Message sending callback error: %s", e)
+            finally:
+                if durable:
+                    if rejected:
+                        # 未发送（队列满或超出配额）：保留为未完成并交还租约，由replay稍后重新投递
+                        self.outbox.release(outbox_key)
+                    else:
+                        # 发送失败（已用尽重试）同样标记完成，避免重启后反复重放
+                        self.outbox.complete(outbox_key)
 
         future.add_done_callback(_callback)
+        return future
+
+    def _send_unless_done(self, outbox_key: str, openid: str, external_resp: Dict) -> bool:
+        """重放的消息在发送前确认尚未送达（上次运行或其他进程可能已发送过同一key）"""
+        if self.outbox.is_done(outbox_key):
+            self.outbox.skipped += 1
+            logger.info("Message %s already delivered, skipped", outbox_key)
+            return True
+        return self._send_custom_message(openid, external_resp)
+
+    def _take_quota(self) -> bool:
+        with self._queued_lock:
+            if self.max_queued and self._queued >= self.max_queued:
+                return False
+            self._queued += 1
+            return True
+
+    def _release_quota(self, _future: Optional[Future] = None):
+        with self._queued_lock:
+            self._queued -= 1
+
+    def quota_stats(self) -> Dict[str, int]:
+        with self._queued_lock:
+            return {'account_send_queued': self._queued, 'account_send_rejected': self.quota_rejected}
+
+
+class PendingReply(Future):
+    """
+    外部服务调用的待投递回复
+
+    结果只会通过一种方式投递给用户：在被动回复窗口内被路由取走（passive），
+    或者通过客服消息接口异步下发（async）。
+    """
+
+    def __init__(self, async_handler: AsyncResponseHandler, openid: str, passive: bool = False,
+                 outbox_key: Optional[str] = None, account=None):
+        super().__init__()
+        self.async_handler = async_handler
+        self.openid = openid
+        self.outbox_key = outbox_key
+        self.account = account  # 所属公众号（Account），用于归还该公众号的准入配额
+        self._claim_lock = Lock()
+        self._ready = Event()
+        self._mode = 'waiting' if passive else 'async'
+        self._response = None
+        self._resolved = False
+        self.busy = False  # 因外部服务繁忙被拒绝，回复应直接以被动回复返回
+
+    @classmethod
+    def rejected(cls, async_handler: AsyncResponseHandler, openid: str, busy_response: Dict) -> 'PendingReply':
+        """不调用外部服务的请求（准入控制拒绝、语音没有识别结果）：由路由直接被动回复busy_response"""
+        pending = cls(async_handler, openid, passive=True)
+        pending.busy = True
+        pending._mode = 'passive'
+        pending._response = busy_response
+        pending._resolved = True
+        pending._ready.set()
+        pending.set_result(busy_response)
+        return pending
+
+    def resolve(self, mapped_response: Optional[Dict]) -> bool:
+        """
+        设置映射后的回复，若已转为异步模式则立即通过客服消息下发
+
+        只有第一次调用生效（外部服务的返回与截止时间先到者为准），返回是否生效。
+        """
+        with self._claim_lock:
+            if self._resolved:
+                return False
+            self._resolved = True
+            self._response = mapped_response
+            deliver = self._mode == 'async'
+        self._ready.set()
+        if deliver:
+            self._deliver_async(mapped_response)
+            self._complete_request()
+        self.set_result(mapped_response)
+        return True
+
+    def _complete_request(self):
+        """回复已交付（被动回复或已写入待发送队列），标记持久化的请求记录完成"""
+        outbox = self.async_handler.outbox
+        if outbox is not None and self.outbox_key is not None:
+            outbox.complete(self.outbox_key)
+
+    def wait_passive(self, timeout: float) -> Optional[Dict]:
+        """
+        在被动回复预算内等待结果
+
+        Returns:
+            Dict: 在预算内拿到的回复，调用方负责以被动回复返回
+            None: 超时，回复转由客服消息异步下发
+        """
+        if self._mode != 'waiting':
+            return None
+        self._ready.wait(max(timeout, 0))
+        with self._claim_lock:
+            if self._mode == 'waiting' and self._response is not None:
+                self._mode = 'passive'
+                response = self._response
+            else:
+                # 超时后转为异步模式，结果就绪时由resolve通过客服消息下发
+                self._mode = 'async'
+                return None
+        self._complete_request()
+        return response
+
+    def reply_key(self, suffix: str = 'reply') -> Optional[str]:
+        """客服消息在持久化队列中的幂等键"""
+        return f"{self.outbox_key}#{suffix}" if self.outbox_key else None
+
+    def _deliver_async(self, mapped_response: Optional[Dict]):
+        if not mapped_response:
+            return
+        payload = self.async_handler._build_message_payload(mapped_response, self.openid)
+        if payload:
+            self.async_handler.send_async_response(self.openid, payload, outbox_key=self.reply_key())
+
+# 全角字符（！到～）与全角空格转换为半角
+_WIDTH_FOLD_TABLE = {code: code - 0xFEE0 for code in range(0xFF01, 0xFF5F)}
+_WIDTH_FOLD_TABLE[0x3000] = 0x20
+_WHITESPACE_RE = re.compile(r'\s+')
+
+class ResponseCache:
+    """
+    外部服务响应缓存（LRU + TTL + 内存上限）
+
+    以映射后的请求payload为键（经过空白/大小写/全半角归一化），
+    缓存映射后的回复。仅对显式启用的服务类型生效，避免缓存个性化回复。
+    """
+
+    def __init__(self, service_types=(), ttl: float = 300, max_bytes: int = 16 * 1024 * 1024,
+                 normalize=('whitespace', 'case', 'width'),
+                 ignore_fields=('user_id', 'timestamp', 'session_id', 'metadata')):
+        self.service_types = set(service_types)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.normalize = set(normalize)
+        self.ignore_fields = set(ignore_fields)
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()  # key -> (expires_at, size, value)
+        self._lock = Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled_for(self, service_type: str) -> bool:
+        return service_type in self.service_types
+
+    def _normalize_text(self, text: str) -> str:
+        if 'width' in self.normalize:
+            text = text.translate(_WIDTH_FOLD_TABLE)
+        if 'case' in self.normalize:
+            text = text.lower()
+        if 'whitespace' in self.normalize:
+            text = _WHITESPACE_RE.sub(' ', text).strip()
+        return text
+
+    def _normalize_value(self, value):
+        if isinstance(value, str):
+            return self._normalize_text(value)
+        if isinstance(value, dict):
+            return {k: self._normalize_value(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._normalize_value(v) for v in value]
+        return value
+
+    def make_key(self, service_type: str, request_payload: Dict) -> str:
+        """根据归一化后的请求payload生成缓存键"""
+        payload = {k: v for k, v in request_payload.items() if k not in self.ignore_fields}
+        raw = json.dumps(self._normalize_value(payload), ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(f"{service_type}:{raw}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.bytes_used -= size
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Dict):
+        size = len(key) + len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes_used -= old[1]
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.bytes_used += size
+            # 超出内存上限时按LRU淘汰
+            while self.bytes_used > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_ratio': self.hits / total if total else 0.0,
+                'cache_bytes_used': self.bytes_used,
+                'cache_entries': len(self._entries),
+                'cache_evictions': self.evictions,
+            }
 
 class ExternalServiceAdapter:
-    def __init__(self, async_handler: AsyncResponseHandler, timeout: int = 5):
-        self.executor = ThreadPoolExecutor(max_workers=10)
+    def __init__(self, async_handler: AsyncResponseHandler, timeout: int = 5,
+                 response_cache: Optional[ResponseCache] = None,
+                 stream: bool = False, segment_max_bytes: int = 2000, segment_min_chars: int = 60,
+                 max_workers: int = 10, max_pending: int = 100,
+                 timeout_msg: str = '请求处理超时，请稍后再试',
+                 error_msg: str = '服务暂时不可用，请稍后重试',
+                 busy_msg: str = '当前咨询人数较多，请稍后再试',
+                 breakers: Optional[CircuitBreakerRegistry] = None,
+                 endpoints: Optional[EndpointPool] = None, hedge_delay: float = 0,
+                 media: Optional[MediaPipeline] = None,
+                 media_error_msg: str = '图片/语音获取失败，请稍后重试',
+                 voice_unrecognized_msg: str = '未能识别语音内容，请重新发送或改用文字'):
+        self.max_workers = max_workers
+        self.executor = InstrumentedThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='external')
+        # 超时提示的下发（可能在客服消息队列满时阻塞）不在定时器线程中执行
+        self._timeout_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='external-timeout')
+        # 准入控制：已提交但未完成（排队+执行中）的请求数上限
+        self.max_pending = max(max_pending, max_workers)
+        self._pending_count = 0
+        self._pending_lock = Lock()
+        self.rejected = 0
+        self.timed_out = 0
+        self.timeout_msg = timeout_msg
+        self.error_msg = error_msg
+        self.busy_msg = busy_msg
+        # 按endpoint熔断：后端持续失败时快速失败，不再占用线程等待超时
+        self.breakers = breakers if breakers is not None else CircuitBreakerRegistry(enabled=False)
+        self.short_circuited = 0
+        # 多个后端节点：最少未完成请求路由 + 摘除 + 可选的对冲请求
+        if endpoints is None:
+            raise ValueError("ExternalServiceAdapter需要配置endpoints")
+        self.endpoints = endpoints
+        self.hedge_delay = hedge_delay
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
         self.timeout = timeout
         self.async_handler = async_handler
+        self.response_cache = response_cache
+        self.stream = stream
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_min_chars = segment_min_chars
+        # 图片/语音消息的媒体下载与预处理，未配置时按文本消息处理
+        self.media = media
+        self.media_error_msg = media_error_msg
+        self.voice_unrecognized_msg = voice_unrecognized_msg
 
-    def _send_request(self, url: str, payload: Dict) -> Optional[Dict]:
+    def _send_request(self, url: str, payload: Dict, service_type: str = 'default') -> Optional[Dict]:
+        breaker = self.breakers.get(url)
+        started_at = time.monotonic()
+        start = time.perf_counter()
         try:
-            response = requests.post(url, json=payload, headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+            response = http_client.post(url, json=payload, headers={'Content-Type': 'application/json'}, timeout=self.timeout)
             response.raise_for_status()
-            return response.json()
+            result = response.json()
         except Exception as e:
-            logger.error(f"External service request failed: {str(e)}")
+            elapsed = time.perf_counter() - start
+            external_service_seconds.observe(elapsed, service_type, 'error')
+            if breaker is not None:
+                breaker.record(False, elapsed, started_at)
+            logger.error("External service request failed: %s", e)
             return None
+        elapsed = time.perf_counter() - start
+        external_service_seconds.observe(elapsed, service_type, 'ok')
+        if breaker is not None:
+            breaker.record(True, elapsed, started_at)
+        return result
+
+    def _send_stream_request(self, url: str, payload: Dict, service_type: str,
+                             pending: PendingReply, user_content: Optional[str] = None):
+        """
+        流式调用外部服务，按句子/段落切分后依次通过客服消息下发
+
+        每个片段完成后立即提交发送，调度器保证同一用户的片段按顺序送达。
+        """
+        openid = pending.openid
+        parser = STREAM_PARSERS[service_type]
+        segmenter = SegmentBuffer(max_bytes=self.segment_max_bytes, min_chars=self.segment_min_chars)
+        parts = []
+        sent = 0
+        started_at = time.monotonic()
+        start = time.perf_counter()
+        outcome = 'ok'
+
+        def _emit(segment: str):
+            nonlocal sent
+            payload_msg = self.async_handler._build_message_payload({"msg_type": "text", "content": segment}, openid)
+            self.async_handler.send_async_response(openid, payload_msg, outbox_key=pending.reply_key(f"seg{sent}"))
+            sent += 1
+
+        try:
+            with http_client.post(url, json=payload, headers={'Content-Type': 'application/json'},
+                                  timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                response.encoding = response.encoding or 'utf-8'
+                for text in parser(response.iter_lines(decode_unicode=True)):
+                    parts.append(text)
+                    for segment in segmenter.feed(text):
+                        _emit(segment)
+            for segment in segmenter.flush():
+                _emit(segment)
+            if user_content and parts:
+                conversation_store.record_turn(openid, user_content, ''.join(parts))
+            if not sent:
+                _emit("未收到有效回复")
+        except Exception as e:
+            outcome = 'error'
+            logger.error("External service stream failed after %s segments: %s", sent, e)
+            for segment in segmenter.flush():
+                _emit(segment)
+            _emit(self.error_msg if not sent else "（回复中断）")
+        finally:
+            external_service_seconds.observe(time.perf_counter() - start, service_type, outcome)
+            breaker = self.breakers.get(url)
+            if breaker is not None:
+                # 流式请求的总耗时取决于回复长度，不参与慢调用统计
+                breaker.record(outcome == 'ok', started_at=started_at)
+            pending.resolve(None)
+        return outcome == 'ok'
 
     def call_service(
         self,
         wechat_msg: Dict,
-        endpoint: str,
         request_mapper: Callable,
         response_mapper: Callable,
-        openid: str
-    ) -> Optional[Dict]:
+        openid: str,
+        passive: bool = False,
+        service_type: str = 'default',
+        account=None
+    ) -> Optional[PendingReply]:
+        """
+        提交外部服务调用，后端节点由endpoints按负载选择
+
+        passive为True时，回复先保留给路由在被动回复窗口内取用（见PendingReply.wait_passive），
+        否则结果直接通过客服消息异步下发。
+        account为消息所属的公众号（Account）：回复通过该公众号发送，并计入其准入配额；
+        未指定时使用构造时传入的async_handler。
+        """
+        async_handler = account.async_handler if account is not None else self.async_handler
+        # openai/ollama只使用语音识别结果：未开启语音识别或识别结果为空时没有可发送的内容，直接回复提示
+        if (service_type in MEDIA_INLINE_SERVICE_TYPES and wechat_msg.get("MsgType") == "voice"
+                and not (message_text(wechat_msg) or "").strip()):
+            logger.info("语音消息没有识别结果，不调用外部服务: %s", openid)
+            return PendingReply.rejected(async_handler, openid,
+                                         {"msg_type": "text", "content": self.voice_unrecognized_msg})
+        # 准入控制：排队+执行中的请求已达上限（全局或该公众号的配额）时直接以繁忙提示被动回复，不再排队等待
+        if not self._admit(account):
+            self.rejected += 1
+            logger.warning("外部服务繁忙，已拒绝请求: %s (pending=%s)", openid, self._pending_count)
+            return PendingReply.rejected(async_handler, openid, {"msg_type": "text", "content": self.busy_msg})
+
         try:
-            request_payload = request_mapper(wechat_msg)
-            logger.debug(f"External request payload: {json.dumps(request_payload, ensure_ascii=False, indent=2)}")
+            # 成功后记录本轮对话，供后续请求的映射器读取上下文
+            user_content = message_text(wechat_msg) if service_type in CONVERSATION_SERVICE_TYPES else None
 
-            future = self.executor.submit(self._send_request, endpoint, request_payload)
+            # 启用持久化队列时先记录请求，进程重启后可重新调用
+            outbox_key = None
+            outbox = async_handler.outbox
+            if outbox is not None:
+                appid = account.appid if account is not None else None
+                outbox_key = MessageDeduplicator.make_key(wechat_msg, namespace=appid)
+                if outbox_key is not None:
+                    outbox.enqueue(outbox_key, 'request', openid, {
+                        "wechat_msg": dict(wechat_msg),
+                        "service_type": service_type,
+                        "appid": appid
+                    })
 
-            # 先立即返回success，后续异步处理
-            self.executor.submit(self._handle_async_response, future, response_mapper, openid)
+            # 流式模式：边生成边下发，不走被动回复、响应缓存与对冲请求
+            stream = self.stream and service_type in STREAM_PARSERS
+            pending = PendingReply(async_handler, openid, passive=passive and not stream, outbox_key=outbox_key,
+                                   account=account)
+        except Exception as e:
+            logger.error("Service call error: %s", e)
+            self._release(account)
             return None
 
+        # 图片/语音消息先在媒体线程池中下载，准备完成后再映射请求；准入名额在此期间保留
+        if self.media is not None and self.media.handles(wechat_msg):
+            try:
+                future = self.media.prepare(wechat_msg, async_handler)
+            except Exception as e:
+                logger.error("Media prepare submit failed: %s", e)
+                self._release(account)
+                pending.resolve({"msg_type": "text", "content": self.error_msg})
+                return pending
+            future.add_done_callback(lambda f: self._on_media_ready(
+                f, pending, wechat_msg, request_mapper, response_mapper, service_type, stream, user_content))
+            return pending
+
+        self._dispatch(pending, wechat_msg, request_mapper, response_mapper, service_type, stream, user_content)
+        return pending
+
+    def _on_media_ready(self, future: Future, pending: PendingReply, wechat_msg: Dict, request_mapper: Callable,
+                        response_mapper: Callable, service_type: str, stream: bool, user_content: Optional[str]):
+        """媒体准备完成（在媒体线程中执行）：附加到消息后继续调用外部服务，失败时通知用户"""
+        if future.cancelled() or future.exception() is not None:
+            logger.error("Media prepare failed: %s (%s)", wechat_msg.get("MediaId"),
+                         'cancelled' if future.cancelled() else future.exception())
+            self._release(pending.account)
+            pending.resolve({"msg_type": "text", "content": self.media_error_msg})
+            return
+        # 不修改原消息（去重器与持久化队列中保存的仍是原始消息）
+        wechat_msg = dict(wechat_msg)
+        wechat_msg["media"] = future.result()
+        self._dispatch(pending, wechat_msg, request_mapper, response_mapper, service_type, stream, user_content)
+
+    def _dispatch(self, pending: PendingReply, wechat_msg: Dict, request_mapper: Callable, response_mapper: Callable,
+                  service_type: str, stream: bool, user_content: Optional[str]):
+        """映射请求并提交到后端节点；准入名额移交给提交的任务，失败时释放名额并通知用户"""
+        openid = pending.openid
+        released = False  # 准入名额是否已移交给线程池任务或已释放
+        try:
+            request_payload = request_mapper(wechat_msg)
+            if payload_logging_enabled(openid):
+                logger.debug("External request payload: %s", json.dumps(request_payload, ensure_ascii=False, indent=2))
+
+            if stream:
+                request_payload["stream"] = True
+                released = True
+                endpoint = self.endpoints.choose()
+                if endpoint is None:
+                    self._fail_fast(pending)
+                    return
+                try:
+                    future = self._submit(self._send_stream_request, endpoint.url, request_payload,
+                                          service_type, pending, user_content, account=pending.account)
+                except Exception:
+                    # 未发出：归还节点的未完成计数与半开探测名额（准入名额已由_submit释放）
+                    self.endpoints.release(endpoint, None)
+                    raise
+                self._track(future, endpoint)
+                return
+
+            # 命中响应缓存时直接投递，不再调用外部服务
+            cache_key = None
+            if self.response_cache and self.response_cache.enabled_for(service_type):
+                cache_key = self.response_cache.make_key(service_type, request_payload)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    logger.debug("Response cache hit: %s", cache_key)
+                    released = True
+                    self._release(pending.account)
+                    pending.resolve(dict(cached))
+                    return
+
+            released = True
+            endpoint = self.endpoints.choose()
+            if endpoint is None:
+                self._fail_fast(pending)
+                return
+
+            # 结果通过完成回调处理，超时与对冲由集中定时器触发，不再占用线程阻塞等待
+            call = _ServiceCall(pending, request_payload, service_type, response_mapper, cache_key, user_content)
+            call.outstanding = 1
+            # 先登记定时器再发出请求：请求很快返回时，完成回调中的cancel_all能取消这些定时器
+            call.deadline = deadline_timer.schedule(self.timeout, self._on_deadline, call)
+            if self.hedge_delay > 0 and len(self.endpoints) > 1:
+                call.hedge_timer = deadline_timer.schedule(self.hedge_delay, self._hedge, call)
+            try:
+                self._launch(call, endpoint, admitted=True)
+            except Exception:
+                call.cancel_all()
+                raise
+
         except Exception as e:
-            logger.error(f"Service call error: {str(e)}")
-            return None
+            logger.error("Service call error: %s", e)
+            if not released:
+                self._release(pending.account)
+            pending.resolve({"msg_type": "text", "content": self.error_msg})
+
+    def _fail_fast(self, pending: PendingReply):
+        """所有节点均处于熔断状态：释放准入名额，直接以错误提示回复（被动回复或客服消息）"""
+        self._release(pending.account)
+        self.short_circuited += 1
+        logger.warning("外部服务熔断中，快速失败: %s", pending.openid)
+        pending.resolve({"msg_type": "text", "content": self.error_msg})
 
-    def _handle_async_response(self, future, response_mapper: Callable, openid: str):
+    def _admit(self, account=None) -> bool:
+        with self._pending_lock:
+            if self._pending_count >= self.max_pending:
+                return False
+            if account is not None:
+                if account.max_pending and account.pending >= account.max_pending:
+                    account.rejected += 1
+                    return False
+                account.pending += 1
+            self._pending_count += 1
+            return True
+
+    def _release(self, account=None):
+        with self._pending_lock:
+            self._pending_count -= 1
+            if account is not None:
+                account.pending -= 1
+
+    def _submit(self, fn: Callable, *args, admitted: bool = True, account=None) -> Future:
+        """提交到线程池；admitted为True时任务结束（含取消）后释放准入名额（含account的配额）"""
         try:
-            result = future.result(timeout=self.timeout)
-            if result:
-                mapped_response = response_mapper(result)
-                if mapped_response:
-                    payload = self.async_handler._build_message_payload(mapped_response, openid)
-                    if payload:
-                        self.async_handler.send_async_response(openid, payload)
-        except TimeoutError:
-            logger.warning("External service timeout, sending notification")
-            # 构建超时提示消息
-            timeout_msg = {
-                "msg_type": "text",
-                "content": "请求处理超时，请稍后再试"
-            }
-            payload = self.async_handler._build_message_payload(timeout_msg, openid)
-            if payload:
-                self.async_handler.send_async_response(openid, payload)
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            if admitted:
+                self._release(account)
+            raise
+        if admitted:
+            future.add_done_callback(lambda _f: self._release(account))
+        return future
+
+    def _track(self, future: Future, endpoint: Endpoint):
+        """请求结束后归还节点的未完成计数并回报成败"""
+        def _done(f: Future):
+            if f.cancelled():
+                self.endpoints.release(endpoint, None)
+            else:
+                self.endpoints.release(endpoint, f.exception() is None and bool(f.result()))
+        future.add_done_callback(_done)
+
+    def _launch(self, call: '_ServiceCall', endpoint: Endpoint, admitted: bool):
+        """发出一个请求；调用方已为其计入call.outstanding"""
+        try:
+            future = self._submit(self._send_request, endpoint.url, call.payload, call.service_type,
+                                  admitted=admitted, account=call.pending.account)
+        except Exception:
+            self.endpoints.release(endpoint, None)
+            raise
+        call.attempts.append((future, endpoint))
+        self._track(future, endpoint)
+        future.add_done_callback(lambda f: self._on_response(f, call))
+
+    def _hedge(self, call: '_ServiceCall') -> bool:
+        """
+        对冲请求（在定时器线程中执行）：首个请求在hedge_delay内未返回时向另一个节点再发一次，先返回者为准
+
+        只在线程池有空闲时发出，避免过载时放大后端压力；对冲请求不占用准入名额。
+        决定对冲时即在call.lock内计入outstanding，最终未能发出时由_leave归还，
+        因此首个请求的失败结果不会在对冲请求发出前抢先回复。
+        """
+        with call.lock:
+            if call.hedged or call.pending.done():
+                return False
+            call.hedged = True
+            call.outstanding += 1
+        with self._pending_lock:
+            busy = self._pending_count >= self.max_workers
+        if busy:
+            self.hedges_skipped += 1
+            self._leave(call)
+            return False
+        endpoint = self.endpoints.choose(exclude=[ep for _, ep in call.attempts])
+        if endpoint is None:
+            self.hedges_skipped += 1
+            self._leave(call)
+            return False
+        self.hedged += 1
+        try:
+            self._launch(call, endpoint, admitted=False)
         except Exception as e:
-            logger.error(f"Async response handling failed: {str(e)}")
+            logger.error("Hedged request submit failed: %s", e)
+            self._leave(call)
+            return False
+        return True
+
+    def _on_deadline(self, call: '_ServiceCall'):
+        """截止时间已到仍未返回（定时器线程）：仍在排队的请求直接取消，超时提示交给线程池下发"""
+        call.cancel_all()
+        if not call.pending.done():
+            self._timeout_executor.submit(self._notify_timeout, call)
+
+    def _notify_timeout(self, call: '_ServiceCall'):
+        """通知用户超时；异步模式下经客服消息调度器发送，队列满时最多阻塞enqueue_timeout秒"""
+        if call.pending.resolve({"msg_type": "text", "content": self.timeout_msg}):
+            self.timed_out += 1
+            logger.warning("External service timeout, sending notification: %s", call.pending.openid)
+
+    def _on_response(self, future: Future, call: '_ServiceCall'):
+        """某个请求返回（在完成请求的工作线程中执行）；成功者或最后一个失败者决定回复"""
+        if future.cancelled():
+            # 被截止时间、成功的请求或提交失败取消，回复由取消方负责
+            with call.lock:
+                call.outstanding -= 1
+            return
+        result = future.result()
+        if result:
+            self._resolve(call, future, result)
+        elif not call.pending.done() and self.hedge_delay > 0 and len(self.endpoints) > 1:
+            # 首个请求在对冲前即失败：立即改投其他节点（对冲已由定时器发出时无操作）
+            self._hedge(call)
+        self._leave(call)
+
+    def _leave(self, call: '_ServiceCall'):
+        """一个请求结束（或对冲请求未能发出）；最后一个结束时仍未回复说明所有请求均已失败"""
+        with call.lock:
+            call.outstanding -= 1
+            if call.outstanding > 0:
+                return  # 对冲请求仍在进行，等待其结果
+        if call.pending.done():
+            return
+        call.cancel_all()
+        # 请求失败（已记录日志并计入熔断统计），通知用户稍后重试；已有成功结果时resolve不生效
+        call.pending.resolve({"msg_type": "text", "content": self.error_msg})
+
+    def _resolve(self, call: '_ServiceCall', future: Future, result: Dict):
+        """以成功的结果回复（先返回者为准）"""
+        if call.pending.done():
+            return
+        call.cancel_all()
+        pending = call.pending
+        try:
+            if future is not call.attempts[0][0]:
+                self.hedge_wins += 1
+            mapped_response = call.response_mapper(result)
+            if call.cache_key and mapped_response:
+                self.response_cache.put(call.cache_key, mapped_response)
+            if call.user_content and mapped_response:
+                conversation_store.record_turn(pending.openid, call.user_content, mapped_response.get("content"))
+            pending.resolve(mapped_response)
+        except Exception as e:
+            logger.error("Async response handling failed: %s", e)
             # 发送通用错误提示
-            error_msg = {
+            pending.resolve({
                 "msg_type": "text",
-                "content": "服务暂时不可用，请稍后重试"
-            }
-            payload = self.async_handler._build_message_payload(error_msg, openid)
-            if payload:
-                self.async_handler.send_async_response(openid, payload)
+                "content": self.error_msg
+            })
+
+    def stats(self) -> Dict[str, int]:
+        with self._pending_lock:
+            pending = self._pending_count
+        return {
+            'external_pending': pending,
+            'external_max_pending': self.max_pending,
+            'external_rejected': self.rejected,
+            'external_timeouts': self.timed_out,
+            'external_short_circuited': self.short_circuited,
+            'external_hedged': self.hedged,
+            'external_hedge_wins': self.hedge_wins,
+            'external_hedges_skipped': self.hedges_skipped,
+        }
+
+
+class _ServiceCall:
+    """一次外部服务调用（可能包含对冲请求）的状态"""
+    __slots__ = ('pending', 'payload', 'service_type', 'response_mapper', 'cache_key', 'user_content',
+                 'attempts', 'outstanding', 'hedged', 'deadline', 'hedge_timer', 'lock')
+
+    def __init__(self, pending: PendingReply, payload: Dict, service_type: str, response_mapper: Callable,
+                 cache_key: Optional[str], user_content: Optional[str]):
+        self.pending = pending
+        self.payload = payload
+        self.service_type = service_type
+        self.response_mapper = response_mapper
+        self.cache_key = cache_key
+        self.user_content = user_content
+        self.attempts = []  # [(future, endpoint)]
+        self.outstanding = 0
+        self.hedged = False
+        self.deadline = None
+        self.hedge_timer = None
+        self.lock = Lock()
+
+    def cancel_all(self):
+        """取消定时器与仍在排队的请求（已发出的HTTP请求无法中断，其结果被忽略）"""
+        for timer in (self.deadline, self.hedge_timer):
+            if timer is not None:
+                timer.cancel()
+        for future, _ in self.attempts:
+            future.cancel()
+
+
+def message_text(wechat_msg: Dict) -> Optional[str]:
+    """消息的文本内容：文本消息取Content，语音消息取微信的语音识别结果"""
+    if wechat_msg.get("MsgType") == "voice":
+        return wechat_msg.get("Recognition")
+    return wechat_msg.get("Content")
 
-# 默认请求/响应映射器示例
 def default_request_mapper(wechat_msg: Dict) -> Dict:
     """将微信消息转换为默认请求格式"""
-    return {
+    request = {
         "user_id": wechat_msg.get("FromUserName"),
         "message_type": wechat_msg.get("MsgType"),
-        "content": wechat_msg.get("Content"),
+        "content": message_text(wechat_msg),
         "timestamp": wechat_msg.get("CreateTime")
     }
+    media = wechat_msg.get("media")
+    if media is not None:
+        request["media"] = media.as_ref()
+    return request
 
 def default_response_mapper(external_resp: Dict) -> Dict:
     """将外部服务响应转换为微信回复格式"""
@@ -184,9 +913,18 @@ def default_response_mapper(external_resp: Dict) -> Dict:
 
 def openai_request_mapper(wechat_msg: Dict) -> Dict:
     """将微信消息转换为OpenAI请求格式"""
+    content = message_text(wechat_msg)
+    messages = conversation_store.build_messages(wechat_msg.get("FromUserName"), content)
+    media = wechat_msg.get("media")
+    if media is not None and media.base64 is not None:
+        # 图片以data URL内联（多模态消息格式）
+        messages[-1]["content"] = [
+            {"type": "text", "text": content or IMAGE_PROMPT},
+            {"type": "image_url", "image_url": {"url": media.data_url()}},
+        ]
     return {
         # "model": "gpt-3.5-turbo",
-        "messages": [{"role": "user", "content": wechat_msg.get("Content")}],
+        "messages": messages,
         "stream": False,
     }
 
@@ -198,13 +936,13 @@ def openai_response_mapper(external_resp: Dict) -> Dict:
             "content": external_resp['choices'][0]['message']['content']
         }
     except KeyError as e:
-        logger.error(f"OpenAI响应格式错误，缺少关键字段: {str(e)}")
+        logger.error("OpenAI响应格式错误，缺少关键字段: %s", e)
         return {
             "msg_type": "text",
             "content": "OpenAI 响应错误，请联系管理员"
         }
     except Exception as e:
-        logger.error(f"OpenAI response mapping failed: {str(e)}")
+        logger.error("OpenAI response mapping failed: %s", e)
         return {
             "msg_type": "text",
             "content": "OpenAI 响应错误，请联系管理员"
@@ -212,11 +950,29 @@ def openai_response_mapper(external_resp: Dict) -> Dict:
 
 def ollama_request_mapper(wechat_msg: Dict) -> Dict:
     """将微信消息转换为Ollama请求格式"""
-    return {
+    media = wechat_msg.get("media")
+    content = message_text(wechat_msg)
+    if media is not None and media.base64 is not None:
+        content = content or IMAGE_PROMPT
+    history = conversation_store.history(wechat_msg.get("FromUserName"), len(content or ""))
+    if history:
+        # /api/generate 只接受单个prompt，历史对话以对话记录的形式拼接在前
+        lines = []
+        for user_text, assistant_text in history:
+            lines.append(f"User: {user_text}")
+            lines.append(f"Assistant: {assistant_text}")
+        lines.append(f"User: {content}")
+        lines.append("Assistant:")
+        content = "\n".join(lines)
+    request = {
         "model": "llama2",
-        "prompt": wechat_msg.get("Content"),
+        "prompt": content,
         "stream": False
     }
+    if media is not None and media.base64 is not None:
+        # 多模态模型（如llava）通过images字段接收base64图片
+        request["images"] = [media.base64]
+    return request
 
 def ollama_response_mapper(external_resp: Dict) -> Dict:
     """将Ollama响应转换为微信回复格式"""
@@ -226,7 +982,7 @@ def ollama_response_mapper(external_resp: Dict) -> Dict:
             "content": external_resp.get("response", "未收到有效回复")
         }
     except Exception as e:
-        logger.error(f"Ollama response mapping failed: {str(e)}")
+        logger.error("Ollama response mapping failed: %s", e)
         return {
             "msg_type": "text",
             "content": "Ollama 服务响应异常"
@@ -234,18 +990,30 @@ def ollama_response_mapper(external_resp: Dict) -> Dict:
 
 def custom_request_mapper(wechat_msg: Dict) -> Dict:
     """自定义请求格式（需用户实现）"""
-    return {
+    request = {
         "session_id": f"{wechat_msg['FromUserName']}_{wechat_msg['CreateTime']}",
-        "query": wechat_msg.get("Content"),
+        "query": message_text(wechat_msg),
         "metadata": {
             "msg_type": wechat_msg.get("MsgType"),
             "user_id": wechat_msg.get("FromUserName")
         }
     }
+    media = wechat_msg.get("media")
+    if media is not None:
+        request["metadata"]["media"] = media.as_ref()
+    return request
 
 def custom_response_mapper(external_resp: Dict) -> Dict:
     """自定义响应解析（需用户实现）"""
     return {
         "msg_type": external_resp.get("msg_type", "text"),
         "content": external_resp.get("text", "未识别响应格式")
-    }
\ No newline at end of file
+    }
+
+# 服务类型 -> (请求映射器, 响应映射器)
+SERVICE_MAPPERS = {
+    'default': (default_request_mapper, default_response_mapper),
+    'openai': (openai_request_mapper, openai_response_mapper),
+    'ollama': (ollama_request_mapper, ollama_response_mapper),
+    'custom': (custom_request_mapper, custom_response_mapper)
+}
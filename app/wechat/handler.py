@@ -1,38 +1,27 @@
 from xml.etree import ElementTree as ET
-import time
-import logging
 from app.utils.logger import logger
+from app.wechat.crypto import WeChatCrypto
+from app.wechat.envelope import WeChatMessage, parse_envelope
+from app.wechat.reply import render_encrypted_reply, render_reply
 from typing import Union
 
 class MessageHandler:
     @classmethod
-    def parse_message(cls, xml_data: Union[bytes, str]) -> dict:
-        """支持解析加密和明文两种格式"""
+    def parse_message(cls, xml_data: Union[bytes, bytearray, memoryview, str]) -> WeChatMessage:
+        """支持解析加密和明文两种格式（单遍解析，正确处理CDATA）"""
         try:
-            if isinstance(xml_data, bytes):
-                xml_str = xml_data.decode('utf-8')
-            else:
-                xml_str = xml_data
-
-            # 移除可能存在的CDATA包装
-            xml_str = xml_str.replace('<![CDATA[', '').replace(']]>', '')
-            root = ET.fromstring(xml_str)
-            return {child.tag: child.text for child in root}
+            return parse_envelope(xml_data)
         except ET.ParseError as e:
-            logger.error(f"XML解析错误: {str(e)}")
-            return {}
+            logger.error("XML解析错误: %s", e)
+            return WeChatMessage()
+
+    @classmethod
+    def build_reply(cls, msg_type: str, from_user: str, to_user: str, content: str = None, **fields) -> bytes:
+        """生成明文模式的被动回复（预编译字节模板）"""
+        return render_reply(msg_type, from_user, to_user, content=content, **fields)
 
     @classmethod
-    def build_reply(cls, msg_type: str, content: str, from_user: str, to_user: str) -> str:
-        """生成兼容明文/加密模式的回复"""
-        create_time = str(int(time.time()))
-        base_xml = f"""
-        <xml>
-            <ToUserName><![CDATA[{to_user}]]></ToUserName>
-            <FromUserName><![CDATA[{from_user}]]></FromUserName>
-            <CreateTime>{create_time}</CreateTime>
-            <MsgType><![CDATA[{msg_type}]]></MsgType>
-            <Content><![CDATA[{content}]]></Content>
-        </xml>
-        """
-        return base_xml.strip()
\ No newline at end of file
+    def build_encrypted_reply(cls, crypto: WeChatCrypto, msg_type: str, from_user: str, to_user: str,
+                              content: str = None, **fields) -> bytes:
+        """生成安全模式的被动回复：渲染后直接在填充缓冲区内加密，并封装为带签名的加密XML"""
+        return render_encrypted_reply(crypto, msg_type, from_user, to_user, content=content, **fields)
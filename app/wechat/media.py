@@ -0,0 +1,377 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+from app.utils.http_client import http_client
+from app.utils.logger import logger
+from app.utils.metrics import InstrumentedThreadPoolExecutor, media_download_seconds
+from app.wechat.token_manager import TOKEN_INVALID_ERRCODES, WECHAT_API_BASE
+
+# Content-Type -> 缓存文件扩展名（重启后按扩展名恢复Content-Type）
+_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'audio/amr': '.amr',
+    'audio/speex': '.speex',
+    'audio/mpeg': '.mp3',
+    'audio/wav': '.wav',
+}
+_CONTENT_TYPES = {ext: content_type for content_type, ext in _EXTENSIONS.items()}
+_DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+_TMP_SUFFIX = '.tmp'
+# base64按3字节对齐分块编码，拼接结果与整体编码一致
+_ENCODE_CHUNK = 3 * 64 * 1024
+# PicUrl允许的域名（含子域名）：微信图片CDN
+PIC_URL_HOSTS = ('qpic.cn',)
+
+
+def pic_url_allowed(url: str, hosts: Iterable[str] = PIC_URL_HOSTS) -> bool:
+    """PicUrl来自消息内容，只允许https访问hosts中的域名或其子域名，避免被用来访问内网地址"""
+    try:
+        parsed = urlsplit(url)
+        port = parsed.port
+    except ValueError:
+        return False
+    host = (parsed.hostname or '').lower()
+    return (parsed.scheme == 'https' and port in (None, 443)
+            and any(host == h or host.endswith('.' + h) for h in hosts))
+
+
+class MediaError(Exception):
+    """媒体下载失败；errcode为微信接口返回的错误码（网络异常等为None）"""
+
+    def __init__(self, reason: str, errcode: Optional[int] = None):
+        super().__init__(reason)
+        self.errcode = errcode
+
+
+class MediaFile:
+    """缓存在本地磁盘上的媒体文件；base64仅在需要内联时由工作线程预先编码"""
+    __slots__ = ('media_id', 'path', 'content_type', 'size', 'base64')
+
+    def __init__(self, media_id: str, path: str, content_type: str, size: int):
+        self.media_id = media_id
+        self.path = path
+        self.content_type = content_type
+        self.size = size
+        self.base64: Optional[str] = None
+
+    @property
+    def is_image(self) -> bool:
+        return self.content_type.startswith('image/')
+
+    def read_base64(self) -> str:
+        """分块读取并编码，不需要把原始文件整体读入内存"""
+        parts = []
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(_ENCODE_CHUNK)
+                if not chunk:
+                    break
+                parts.append(base64.b64encode(chunk).decode('ascii'))
+        return ''.join(parts)
+
+    def data_url(self) -> str:
+        return f"data:{self.content_type};base64,{self.base64}"
+
+    def as_ref(self) -> Dict:
+        """以文件引用的形式交给外部服务（需与本服务共享存储）"""
+        return {
+            'media_id': self.media_id,
+            'path': self.path,
+            'content_type': self.content_type,
+            'size': self.size,
+        }
+
+
+class MediaCache:
+    """
+    媒体文件磁盘缓存（按缓存键，LRU + 总大小上限）
+
+    文件名为缓存键的sha1加上扩展名，重启后按修改时间恢复LRU顺序；命中时更新修改时间。
+    多进程共享同一目录时，其他进程淘汰的文件在下次读取时视为未命中。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, Tuple[str, int]]' = OrderedDict()  # key -> (path, size)
+        self._lock = Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def _key(cache_key: str) -> str:
+        return hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        """扫描缓存目录重建索引，清理上次未完成下载留下的临时文件"""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(_TMP_SUFFIX):
+                    os.unlink(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, os.path.splitext(name)[0], path, stat.st_size))
+        files.sort()
+        with self._lock:
+            for _, key, path, size in files:
+                self._entries[key] = (path, size)
+                self.bytes_used += size
+            self._evict_locked()
+        if files:
+            logger.info(f"已加载媒体缓存: {len(self._entries)}个文件, {self.bytes_used}字节")
+
+    def get(self, cache_key: str, media_id: str) -> Optional[MediaFile]:
+        key = self._key(cache_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            path, size = entry
+            try:
+                os.utime(path)
+            except OSError:
+                # 已被其他进程淘汰
+                with self._lock:
+                    if self._entries.get(key) == entry:
+                        del self._entries[key]
+                        self.bytes_used -= size
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        ext = os.path.splitext(path)[1]
+        return MediaFile(media_id, path, _CONTENT_TYPES.get(ext, _DEFAULT_CONTENT_TYPE), size)
+
+    def temp_file(self) -> Tuple[int, str]:
+        """在缓存目录中创建下载用的临时文件，返回(fd, path)"""
+        return tempfile.mkstemp(dir=self.directory, prefix='.media.', suffix=_TMP_SUFFIX)
+
+    def put(self, cache_key: str, media_id: str, tmp_path: str, content_type: str) -> MediaFile:
+        """下载完成的临时文件原子改名为缓存文件，超出总大小时按LRU淘汰"""
+        key = self._key(cache_key)
+        path = os.path.join(self.directory, key + _EXTENSIONS.get(content_type, '.bin'))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes_used -= old[1]
+                if old[0] != path:
+                    _unlink_quietly(old[0])
+            self._entries[key] = (path, size)
+            self.bytes_used += size
+            self._evict_locked(keep=key)
+        return MediaFile(media_id, path, content_type if content_type in _EXTENSIONS else _DEFAULT_CONTENT_TYPE, size)
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        while self.bytes_used > self.max_bytes and self._entries:
+            key, (path, size) = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            self.bytes_used -= size
+            self.evictions += 1
+            _unlink_quietly(path)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'media_cache_hits': self.hits,
+                'media_cache_misses': self.misses,
+                'media_cache_bytes_used': self.bytes_used,
+                'media_cache_files': len(self._entries),
+                'media_cache_evictions': self.evictions,
+            }
+
+
+def _unlink_quietly(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class MediaPipeline:
+    """
+    图片/语音消息的媒体准备
+
+    - 按MediaId通过临时素材接口（/cgi-bin/media/get）下载，图片下载失败时改用PicUrl
+      （仅限pic_url_hosts中的https地址，不跟随重定向）；响应分块流式写入磁盘，内存占用与文件大小无关
+    - 下载结果按appid+MediaId进入MediaCache，同一MediaId并发请求只下载一次
+    - 在独立线程池中完成下载与base64编码，inline_base64为False时只提供文件引用
+
+    openai/ollama只能内联图片，语音消息使用微信的语音识别结果（Recognition），不下载语音文件。
+    所有公众号共用线程池与缓存，下载时使用消息所属公众号的access_token。
+    """
+
+    def __init__(self, cache: MediaCache, api_base: str = WECHAT_API_BASE, workers: int = 4,
+                 inline_base64: bool = True, max_file_bytes: int = 10 * 1024 * 1024,
+                 chunk_size: int = 64 * 1024, timeout: float = 10, pic_url_hosts: Iterable[str] = PIC_URL_HOSTS):
+        self.cache = cache
+        self.api_base = api_base
+        self.inline_base64 = inline_base64
+        self.max_file_bytes = max_file_bytes
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.pic_url_hosts = tuple(h.lower().lstrip('.') for h in pic_url_hosts)
+        self.workers = workers
+        self.executor = InstrumentedThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self._inflight: Dict[str, Future] = {}
+        self._lock = Lock()
+        self.downloads = 0
+        self.download_errors = 0
+        self.bytes_downloaded = 0
+
+    def handles(self, msg) -> bool:
+        """该消息是否需要先准备媒体再调用外部服务"""
+        if not msg.get('MediaId'):
+            return False
+        msg_type = msg.get('MsgType')
+        if msg_type == 'image':
+            return True
+        return msg_type == 'voice' and not self.inline_base64
+
+    def prepare(self, msg, credentials) -> Future:
+        """
+        提交媒体准备任务，返回Future[MediaFile]；同一MediaId进行中的任务直接复用
+
+        credentials: 消息所属公众号的token_manager/appid/appsecret（如该公众号的AsyncResponseHandler）
+        """
+        # MediaId只在公众号内唯一，缓存与进行中的任务按appid区分
+        cache_key = f"{credentials.appid}/{msg.get('MediaId')}"
+        with self._lock:
+            future = self._inflight.get(cache_key)
+            if future is not None:
+                return future
+            future = self._inflight[cache_key] = self.executor.submit(self._prepare, msg, credentials, cache_key)
+        future.add_done_callback(lambda f: self._forget(cache_key, f))
+        return future
+
+    def _forget(self, cache_key: str, future: Future):
+        with self._lock:
+            if self._inflight.get(cache_key) is future:
+                del self._inflight[cache_key]
+
+    def _prepare(self, msg, credentials, cache_key: str) -> MediaFile:
+        media = self.cache.get(cache_key, msg.get('MediaId'))
+        if media is None:
+            media = self._download(msg, credentials, cache_key)
+        if self.inline_base64 and media.is_image:
+            media.base64 = media.read_base64()
+        return media
+
+    def _download(self, msg, credentials, cache_key: str) -> MediaFile:
+        media_id = msg.get('MediaId')
+        try:
+            return self._download_media(media_id, credentials, cache_key)
+        except Exception as e:
+            pic_url = msg.get('PicUrl')
+            if msg.get('MsgType') != 'image' or not pic_url:
+                raise
+            if not pic_url_allowed(pic_url, self.pic_url_hosts):
+                logger.warning("临时素材下载失败，PicUrl不是微信图片地址，不予下载: %s %r", media_id, pic_url)
+                raise
+            logger.warning("临时素材下载失败，改用PicUrl: %s (%s)", media_id, e)
+            return self._fetch(cache_key, media_id, pic_url, None, 'pic_url')
+
+    def _download_media(self, media_id: str, credentials, cache_key: str) -> MediaFile:
+        url = f"{self.api_base}/cgi-bin/media/get"
+        token_manager = credentials.token_manager
+        access_token = token_manager.get_token(credentials.appid, credentials.appsecret)
+        if not access_token:
+            raise MediaError(f"access_token unavailable: {token_manager.last_error}")
+        try:
+            return self._fetch(cache_key, media_id, url, {'access_token': access_token, 'media_id': media_id}, 'media_api')
+        except MediaError as e:
+            if e.errcode not in TOKEN_INVALID_ERRCODES:
+                raise
+            # token已失效：单飞刷新后用新token重新下载一次
+            access_token = token_manager.invalidate(credentials.appid, credentials.appsecret, access_token)
+            if not access_token:
+                raise
+            return self._fetch(cache_key, media_id, url, {'access_token': access_token, 'media_id': media_id}, 'media_api')
+
+    def _fetch(self, cache_key: str, media_id: str, url: str, params: Optional[Dict], source: str) -> MediaFile:
+        """流式下载到缓存目录的临时文件，完成后放入缓存"""
+        start = time.perf_counter()
+        outcome = 'error'
+        size = 0
+        try:
+            # 不跟随重定向：允许的域名不能被用来跳转到其他地址
+            with http_client.get(url, params=params, stream=True, timeout=self.timeout,
+                                 allow_redirects=False) as response:
+                if response.is_redirect:
+                    raise MediaError(f"媒体地址返回重定向: {response.status_code}")
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type in ('application/json', 'text/plain'):
+                    # 接口出错时返回JSON错误信息而不是文件
+                    body = next(response.iter_content(4096), b'')
+                    try:
+                        data = json.loads(body)
+                    except ValueError:
+                        data = {}
+                    raise MediaError(f"{data.get('errcode')}: {data.get('errmsg')}", errcode=data.get('errcode'))
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > self.max_file_bytes:
+                    raise MediaError(f"媒体文件过大: {length}字节")
+
+                fd, tmp_path = self.cache.temp_file()
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in response.iter_content(self.chunk_size):
+                            size += len(chunk)
+                            if size > self.max_file_bytes:
+                                raise MediaError(f"媒体文件超过{self.max_file_bytes}字节")
+                            f.write(chunk)
+                    if not size:
+                        raise MediaError("媒体文件为空")
+                    media = self.cache.put(cache_key, media_id, tmp_path, content_type)
+                except BaseException:
+                    _unlink_quietly(tmp_path)
+                    raise
+            outcome = 'ok'
+        finally:
+            media_download_seconds.observe(time.perf_counter() - start, source, outcome)
+            with self._lock:
+                self.downloads += 1
+                if outcome == 'ok':
+                    self.bytes_downloaded += size
+                else:
+                    self.download_errors += 1
+        return media
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {
+                'media_downloads': self.downloads,
+                'media_download_errors': self.download_errors,
+                'media_bytes_downloaded': self.bytes_downloaded,
+                'media_inflight': len(self._inflight),
+            }
+        stats.update(self.cache.stats())
+        return stats
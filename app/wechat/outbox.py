@@ -0,0 +1,239 @@
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from app.utils.logger import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    openid TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    done_at REAL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+_PENDING_INDEX = "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (done_at, created_at)"
+# 旧版本创建的表没有以下列，启动时补上（旧记录视为租约已过期、尚未重放过）
+_ADDED_COLUMNS = (('owner', 'TEXT'), ('lease_until', 'REAL'), ('attempts', 'INTEGER NOT NULL DEFAULT 0'))
+
+
+class DurableOutbox:
+    """
+    基于SQLite（WAL模式）的持久化出站队列
+
+    记录尚未完成的外部服务请求（kind='request'）和待发送的客服消息（kind='reply'），
+    进程重启后由replay重新投递。写入由后台线程批量提交，每批只触发一次fsync，
+    避免持久化成为发送链路的吞吐瓶颈。key为幂等键：重复写入同一key会被忽略。
+
+    多个进程（gunicorn worker）共用同一个文件：每条记录属于写入它的进程（owner），
+    该进程存活期间定期续租；replay只认领租约已过期的记录（进程退出或崩溃后），
+    认领在同一个写事务中完成，同一条记录只会被一个进程重放。
+
+    投递被拒绝（发送队列满、超出配额）或重放失败的记录通过release交还，下一个租约周期重新认领；
+    重放max_attempts次仍未完成的记录不再认领，作为死信保留在文件中（不会被清理）。
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.05, batch_size: int = 256,
+                 retention: float = 86400, lease: float = 30, max_attempts: int = 5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.lease = lease
+        self.max_attempts = max(max_attempts, 1)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{time.time():.0f}"
+        self._ops: 'queue.Queue' = queue.Queue()
+        self._local = threading.local()
+        self.enqueued = 0
+        self.completed = 0
+        self.replayed = 0
+        self.skipped = 0
+        self.released = 0
+        self.dead_letters = 0
+        self.flushes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            for name, column_type in _ADDED_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE outbox ADD COLUMN {name} {column_type}")
+            conn.execute(_PENDING_INDEX)
+        self._writer = threading.Thread(target=self._write_loop, name='outbox-writer', daemon=True)
+        self._writer.start()
+        logger.info(f"持久化出站队列已启用: {path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def is_done(self, key: str) -> bool:
+        """该任务是否已完成（例如重放前已由其他进程或上次运行发送过）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        try:
+            row = conn.execute("SELECT done_at FROM outbox WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"读取持久化队列失败: {str(e)}")
+            return False
+        return row is not None and row[0] is not None
+
+    def enqueue(self, key: str, kind: str, openid: str, payload: Dict):
+        """记录待投递的任务（异步批量写入）"""
+        now = time.time()
+        self._ops.put(('insert', key, kind, openid, json.dumps(payload, ensure_ascii=False), now, self.owner,
+                       now + self.lease))
+        self.enqueued += 1
+
+    def complete(self, key: str):
+        """标记任务已完成（异步批量写入）"""
+        self._ops.put(('complete', key, time.time()))
+        self.completed += 1
+
+    def release(self, key: str):
+        """放弃本进程对未完成任务的租约（异步批量写入），由replay在下一个周期重新认领"""
+        self._ops.put(('release', key))
+        self.released += 1
+
+    def _write_loop(self):
+        conn = self._connect()
+        last_prune = last_renew = time.time()
+        while True:
+            try:
+                ops = [self._ops.get(timeout=self.lease / 3)]
+            except queue.Empty:
+                ops = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(ops) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    ops.append(self._ops.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for op in ops:
+                        if op[0] == 'insert':
+                            conn.execute(
+                                "INSERT OR IGNORE INTO outbox (key, kind, openid, payload, created_at, owner, lease_until) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", op[1:])
+                        elif op[0] == 'complete':
+                            conn.execute("UPDATE outbox SET done_at = ? WHERE key = ? AND done_at IS NULL",
+                                         (op[2], op[1]))
+                        else:
+                            conn.execute("UPDATE outbox SET owner = NULL, lease_until = NULL "
+                                         "WHERE key = ? AND done_at IS NULL", (op[1],))
+                    now = time.time()
+                    if now - last_renew > self.lease / 3:
+                        # 续租本进程未完成的记录，其他进程不会重放它们
+                        conn.execute("UPDATE outbox SET lease_until = ? WHERE owner = ? AND done_at IS NULL",
+                                     (now + self.lease, self.owner))
+                        last_renew = now
+                    if now - last_prune > 60:
+                        conn.execute("DELETE FROM outbox WHERE done_at IS NOT NULL AND done_at < ?",
+                                     (now - self.retention,))
+                        last_prune = now
+                if ops:
+                    self.flushes += 1
+            except sqlite3.Error as e:
+                logger.error(f"写入持久化队列失败（{len(ops)}条操作）: {str(e)}")
+            finally:
+                for _ in ops:
+                    self._ops.task_done()
+
+    def flush(self, timeout: Optional[float] = None):
+        """等待已提交的写操作落盘"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._ops.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(self.flush_interval)
+        return True
+
+    def _claim(self, conn: sqlite3.Connection) -> List[tuple]:
+        """
+        认领租约已过期（所属进程已退出）或已被交还的未完成记录，在同一个写事务中改为本进程所有
+
+        返回(key, kind, openid, payload, attempts)，attempts为包括本次在内的重放次数
+        """
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT key, kind, openid, payload, attempts + 1 FROM outbox "
+                "WHERE done_at IS NULL AND (lease_until IS NULL OR lease_until < ?) AND attempts < ? "
+                "ORDER BY created_at", (now, self.max_attempts)).fetchall()
+            conn.executemany("UPDATE outbox SET owner = ?, lease_until = ?, attempts = attempts + 1 WHERE key = ?",
+                             [(self.owner, now + self.lease, row[0]) for row in rows])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def replay(self, handlers: Dict[str, Callable[[str, str, Dict], None]]):
+        """
+        在后台线程中重新投递已退出进程（包括上次运行）未完成的任务
+
+        启动时执行一次，之后每个租约周期检查一次：其他worker崩溃后，
+        其未完成的任务在租约过期后由某一个存活的进程认领并重放。
+        handler抛出异常时交还租约，下个周期重试，达到max_attempts次后成为死信。
+
+        Args:
+            handlers: kind -> handler(key, openid, payload)
+        """
+        def _run():
+            conn = self._connect()
+            conn.isolation_level = None
+            while True:
+                try:
+                    rows = self._claim(conn)
+                except sqlite3.Error as e:
+                    logger.error(f"读取持久化队列失败: {str(e)}")
+                    rows = []
+
+                if rows:
+                    logger.info(f"开始重放未完成的出站任务: {len(rows)}条")
+                for key, kind, openid, payload, attempts in rows:
+                    try:
+                        handler = handlers.get(kind)
+                        if handler is None:
+                            raise ValueError(f"未知的出站任务类型: {kind}")
+                        handler(key, openid, json.loads(payload))
+                        self.replayed += 1
+                    except Exception as e:
+                        logger.error(f"重放出站任务失败（第{attempts}次）: {key}: {str(e)}")
+                        self.release(key)
+                        if attempts >= self.max_attempts:
+                            self.dead_letters += 1
+                            logger.error(f"出站任务已重放{attempts}次仍失败，保留为死信: {key}")
+                time.sleep(self.lease)
+
+        threading.Thread(target=_run, name='outbox-replay', daemon=True).start()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'outbox_enqueued': self.enqueued,
+            'outbox_completed': self.completed,
+            'outbox_replayed': self.replayed,
+            'outbox_skipped': self.skipped,
+            'outbox_released': self.released,
+            'outbox_dead_letters': self.dead_letters,
+            'outbox_pending_writes': self._ops.qsize(),
+            'outbox_flushes': self.flushes,
+        }
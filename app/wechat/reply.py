@@ -0,0 +1,110 @@
+import os
+import time
+from typing import Dict, List, Optional
+
+from app.wechat.crypto import PLAINTEXT_HEADER_SIZE, WeChatCrypto
+
+# 被动回复模板：紧凑的字节模板，预先编译，渲染时只做一次 bytes % 格式化
+_HEADER = (b'<xml><ToUserName><![CDATA[%b]]></ToUserName>'
+           b'<FromUserName><![CDATA[%b]]></FromUserName>'
+           b'<CreateTime>%d</CreateTime>'
+           b'<MsgType><![CDATA[%b]]></MsgType>')
+
+_TEXT = _HEADER + b'<Content><![CDATA[%b]]></Content></xml>'
+_IMAGE = _HEADER + b'<Image><MediaId><![CDATA[%b]]></MediaId></Image></xml>'
+_VOICE = _HEADER + b'<Voice><MediaId><![CDATA[%b]]></MediaId></Voice></xml>'
+_VIDEO = (_HEADER + b'<Video><MediaId><![CDATA[%b]]></MediaId>'
+          b'<Title><![CDATA[%b]]></Title><Description><![CDATA[%b]]></Description></Video></xml>')
+_MUSIC = (_HEADER + b'<Music><Title><![CDATA[%b]]></Title>'
+          b'<Description><![CDATA[%b]]></Description>'
+          b'<MusicUrl><![CDATA[%b]]></MusicUrl>'
+          b'<HQMusicUrl><![CDATA[%b]]></HQMusicUrl>'
+          b'<ThumbMediaId><![CDATA[%b]]></ThumbMediaId></Music></xml>')
+_NEWS = _HEADER + b'<ArticleCount>%d</ArticleCount><Articles>%b</Articles></xml>'
+_NEWS_ITEM = (b'<item><Title><![CDATA[%b]]></Title>'
+              b'<Description><![CDATA[%b]]></Description>'
+              b'<PicUrl><![CDATA[%b]]></PicUrl>'
+              b'<Url><![CDATA[%b]]></Url></item>')
+
+_ENCRYPTED = (b'<xml><Encrypt><![CDATA[%b]]></Encrypt>'
+              b'<MsgSignature><![CDATA[%b]]></MsgSignature>'
+              b'<TimeStamp>%b</TimeStamp>'
+              b'<Nonce><![CDATA[%b]]></Nonce></xml>')
+
+# 图文消息最多8条
+MAX_NEWS_ARTICLES = 8
+REPLY_TYPES = ('text', 'image', 'voice', 'video', 'music', 'news')
+
+
+class UnsupportedReplyError(ValueError):
+    """被动回复类型不在REPLY_TYPES中（与签名校验、解密失败的ValueError区分）"""
+
+
+def cdata(value) -> bytes:
+    """编码为CDATA内容，内容中的 ]]> 拆分到相邻的两个CDATA段"""
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        # 未命中时replace直接返回原对象，只扫描一遍
+        return value.replace(']]>', ']]]]><![CDATA[>').encode('utf-8')
+    return bytes(value).replace(b']]>', b']]]]><![CDATA[>')
+
+
+def _render_body(msg_type: str, header: tuple, fields: Dict) -> bytes:
+    get = fields.get
+    if msg_type == 'text':
+        return _TEXT % (header + (cdata(get('content')),))
+    if msg_type == 'image':
+        return _IMAGE % (header + (cdata(get('media_id')),))
+    if msg_type == 'voice':
+        return _VOICE % (header + (cdata(get('media_id')),))
+    if msg_type == 'video':
+        return _VIDEO % (header + (cdata(get('media_id')), cdata(get('title')), cdata(get('description'))))
+    if msg_type == 'music':
+        return _MUSIC % (header + (cdata(get('title')), cdata(get('description')), cdata(get('music_url')),
+                                   cdata(get('hq_music_url')), cdata(get('thumb_media_id'))))
+    if msg_type == 'news':
+        articles: List[Dict] = list(get('articles') or ())[:MAX_NEWS_ARTICLES]
+        items = b''.join(
+            _NEWS_ITEM % (cdata(a.get('title')), cdata(a.get('description')),
+                          cdata(a.get('pic_url')), cdata(a.get('url')))
+            for a in articles)
+        return _NEWS % (header + (len(articles), items))
+    raise UnsupportedReplyError(f"Unsupported reply type: {msg_type}")
+
+
+def render_reply(msg_type: str, from_user: Optional[str], to_user: Optional[str],
+                 out: Optional[bytearray] = None, create_time: Optional[int] = None, **fields) -> bytes:
+    """
+    渲染被动回复XML；msg_type不受支持时抛出UnsupportedReplyError
+
+    Args:
+        msg_type: text/image/voice/video/music/news
+        from_user: 公众号原始ID（回复的FromUserName）
+        to_user: 用户openid（回复的ToUserName）
+        out: 可选的输出缓冲区，渲染结果追加到其末尾并返回该缓冲区
+        **fields: 各类型的字段，如content、media_id、title、description、music_url、
+                  hq_music_url、thumb_media_id、articles（[{title, description, pic_url, url}]）
+    """
+    if msg_type not in REPLY_TYPES:
+        raise UnsupportedReplyError(f"Unsupported reply type: {msg_type}")
+    header = (cdata(to_user), cdata(from_user),
+              int(time.time()) if create_time is None else create_time, msg_type.encode('ascii'))
+    body = _render_body(msg_type, header, fields)
+    if out is None:
+        return body
+    out += body
+    return out
+
+
+def render_encrypted_reply(crypto: WeChatCrypto, msg_type: str, from_user: Optional[str],
+                           to_user: Optional[str], **fields) -> bytes:
+    """渲染并加密被动回复，返回带签名的加密XML"""
+    buf = bytearray(PLAINTEXT_HEADER_SIZE)
+    render_reply(msg_type, from_user, to_user, out=buf, **fields)
+    encrypted = crypto.encrypt_buffer(buf)
+
+    timestamp = str(int(time.time()))
+    nonce = os.urandom(8).hex()
+    signature = crypto.generate_signature(encrypted.decode('ascii'), timestamp, nonce)
+    return _ENCRYPTED % (encrypted, signature.encode('ascii'), timestamp.encode('ascii'), nonce.encode('ascii'))
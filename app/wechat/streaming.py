@@ -0,0 +1,120 @@
+import json
+import re
+from typing import Iterable, Iterator, List
+
+from app.utils.logger import logger
+
+# 微信客服文本消息内容上限为2048字节，预留少量余量
+STREAM_SEGMENT_MAX_BYTES_DEFAULT = 2000
+STREAM_SEGMENT_MIN_CHARS_DEFAULT = 60
+
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+_SENTENCE_RE = re.compile(r'[。！？；!?;]+[」』”’"\')）]*|\.(?=\s)|\n')
+
+
+def iter_openai_sse(lines: Iterable[str]) -> Iterator[str]:
+    """解析OpenAI兼容接口的SSE流，逐个产出增量文本"""
+    for line in lines:
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        try:
+            chunk = json.loads(data)
+            choices = chunk.get('choices') or []
+            if not choices:
+                continue
+            delta = choices[0].get('delta') or {}
+            text = delta.get('content')
+            if text:
+                yield text
+        except (ValueError, AttributeError) as e:
+            logger.warning("Invalid SSE chunk ignored: %s", e)
+
+
+def iter_ollama_ndjson(lines: Iterable[str]) -> Iterator[str]:
+    """解析Ollama的NDJSON流，逐个产出增量文本"""
+    for line in lines:
+        if not line:
+            continue
+        try:
+            chunk = json.loads(line)
+        except ValueError as e:
+            logger.warning("Invalid NDJSON chunk ignored: %s", e)
+            continue
+        text = chunk.get('response')
+        if text:
+            yield text
+        if chunk.get('done'):
+            break
+
+
+# 服务类型 -> 流式解析器
+STREAM_PARSERS = {
+    'openai': iter_openai_sse,
+    'ollama': iter_ollama_ndjson,
+}
+
+
+def _truncate_to_bytes(text: str, max_bytes: int) -> int:
+    """返回text在不超过max_bytes字节时可保留的字符数"""
+    encoded = text.encode('utf-8')[:max_bytes]
+    return len(encoded.decode('utf-8', errors='ignore'))
+
+
+class SegmentBuffer:
+    """
+    将流式增量文本切分为适合客服消息发送的片段
+
+    累计到min_chars后在第一个段落或句子边界处切分，
+    超过max_bytes时在字节上限内的最后一个边界处（没有边界则直接）截断。
+    """
+
+    def __init__(self, max_bytes: int = STREAM_SEGMENT_MAX_BYTES_DEFAULT,
+                 min_chars: int = STREAM_SEGMENT_MIN_CHARS_DEFAULT):
+        self.max_bytes = max_bytes
+        self.min_chars = min_chars
+        self._buffer = ''
+
+    @staticmethod
+    def _first_boundary(text: str, start: int) -> int:
+        paragraph = _PARAGRAPH_RE.search(text, start)
+        sentence = _SENTENCE_RE.search(text, start)
+        ends = [m.end() for m in (paragraph, sentence) if m]
+        return min(ends) if ends else -1
+
+    @staticmethod
+    def _last_boundary(text: str) -> int:
+        end = -1
+        for m in _SENTENCE_RE.finditer(text):
+            end = m.end()
+        return end
+
+    def feed(self, text: str) -> List[str]:
+        """追加增量文本，返回已完成的片段"""
+        self._buffer += text
+        segments = []
+        while self._buffer:
+            limit = _truncate_to_bytes(self._buffer, self.max_bytes)
+            if limit < len(self._buffer):
+                head = self._buffer[:limit]
+                cut = self._last_boundary(head)
+                cut = cut if cut > 0 else limit
+            elif len(self._buffer) >= self.min_chars:
+                cut = self._first_boundary(self._buffer, self.min_chars - 1)
+                if cut <= 0:
+                    break
+            else:
+                break
+            segment = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> List[str]:
+        """返回剩余文本（流结束时调用）"""
+        segment = self._buffer.strip()
+        self._buffer = ''
+        return [segment] if segment else []
@@ -1,138 +1,321 @@
 import time
+import random
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
+from contextlib import contextmanager
 from app.utils.logger import logger
+from app.utils.http_client import http_client
+from app.utils.metrics import token_refresh_seconds
+from app.utils.scheduler import RetryPolicy, deadline_timer
 import os
 import json
+import tempfile
 from flask import current_app
 
+try:
+    import fcntl
+except ImportError:  # 非POSIX平台（本地开发）退化为进程内锁
+    fcntl = None
+
+WECHAT_API_BASE = "https://api.weixin.qq.com"
+
+# access_token无效/过期的错误码：40001 token无效，40014 不合法的token，42001 token过期
+TOKEN_INVALID_ERRCODES = (40001, 40014, 42001)
+
+# 所有公众号共用的后台刷新线程：刷新时间由集中定时器调度，到期后在此执行网络请求，
+# 线程数不随公众号数量增长
+_refresh_executor = None
+_refresh_executor_lock = Lock()
+
+
+def _submit_refresh(fn):
+    global _refresh_executor
+    with _refresh_executor_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='token-refresher')
+    _refresh_executor.submit(fn)
+
+
 class TokenManager:
-    _instance = None
-    _lock = Lock()
-
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            with cls._lock:
-                if not cls._instance:
-                    cls._instance = super().__new__(cls)
-        return cls._instance
-
-    def __init__(self, token_file_path: str = None):
-        if hasattr(self, '_initialized'):  # 防止重复初始化
-            return
+    """
+    单个公众号的access_token管理（每个appid一个实例）
+
+    appid/appsecret用于启动时校验token文件；未传入时读取当前Flask应用的WECHAT_APPID/WECHAT_APPSECRET。
+    """
 
-        self.access_token = None
-        self.expires_at = 0
+    def __init__(self, token_file_path: str = None, file_check_interval: float = 1.0,
+                 api_base: str = WECHAT_API_BASE, appid: str = None, appsecret: str = None):
+        # (access_token, expires_at) 作为整体原子替换，读取时无需加锁
+        self._state = (None, 0)
         self.last_error = None
+        self.last_error_retryable = True  # 最近一次失败是否为可重试的错误（系统繁忙、网络异常）
         self.retry_count = 0
         self.max_retries = 3
+        # 后台刷新失败后的退避策略（带抖动，多进程不会同时重试）
+        self.retry_policy = RetryPolicy(base=1.0, max_delay=60.0)
         self.lock = Lock()
         self.token_file = token_file_path  # 通过参数传入路径
-        self._load_from_file()
-        self._initialized = True  # 标记已初始化
+        self.lock_file = f"{token_file_path}.lock" if token_file_path else None
+        self.file_check_interval = file_check_interval
+        self.api_base = api_base
+        self._file_mtime = 0
+        self._last_file_check = 0
+        self._refresh_args = None
+        self._refresh_failures = 0
+        self._load_from_file(appid, appsecret)
 
-    def _load_from_file(self):
-        """从文件加载token"""
-        try:
-            if os.path.exists(self.token_file):
-                with open(self.token_file, 'r') as f:
-                    data = json.load(f)
+    @property
+    def access_token(self):
+        return self._state[0]
 
-                    # 验证配置一致性
-                    current_appid = current_app.config['WECHAT_APPID']
-                    current_appsecret = current_app.config['WECHAT_APPSECRET']
+    @property
+    def expires_at(self):
+        return self._state[1]
 
-                    # 检查appid和appsecret是否匹配（前3位验证）
-                    file_appsecret_prefix = data.get('appsecret', '')[:3]
-                    current_appsecret_prefix = current_appsecret[:3]
+    def _read_file(self, appid, appsecret):
+        """读取token文件，返回(access_token, expires_at)；配置不一致或已过期时返回None"""
+        with open(self.token_file, 'r') as f:
+            data = json.load(f)
 
-                    if (data.get('appid') != current_appid or
-                        file_appsecret_prefix != current_appsecret_prefix):
-                        logger.warning("配置信息变更，已存储的access_token失效")
-                        return
+        # 检查appid和appsecret是否匹配（前3位验证）
+        file_appsecret_prefix = data.get('appsecret', '')[:3]
+        current_appsecret_prefix = appsecret[:3]
 
-                    # 检查有效期
-                    if data['expires_at'] > time.time() + 300:
-                        self.access_token = data['access_token']
-                        self.expires_at = data['expires_at']
-                        logger.info(f"从文件加载有效access_token，有效期至{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.expires_at))}")
+        if (data.get('appid') != appid or
+            file_appsecret_prefix != current_appsecret_prefix):
+            logger.warning("配置信息变更，已存储的access_token失效")
+            return None
 
+        # 检查有效期
+        if data['expires_at'] > time.time() + 300:
+            return data['access_token'], data['expires_at']
+        return None
+
+    def _load_from_file(self, appid=None, appsecret=None):
+        """从文件加载token"""
+        try:
+            if os.path.exists(self.token_file):
+                self._file_mtime = os.stat(self.token_file).st_mtime
+                # 验证配置一致性
+                state = self._read_file(
+                    appid or current_app.config['WECHAT_APPID'],
+                    appsecret or current_app.config['WECHAT_APPSECRET']
+                )
+                if state:
+                    self._state = state
+                    logger.info(f"从文件加载有效access_token，有效期至{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.expires_at))}")
+
+        except Exception as e:
+            logger.warning(f"加载token文件失败: {str(e)}")
+
+    def _reload_if_changed(self, appid, appsecret) -> bool:
+        """其他进程刷新token后会替换文件，检测到文件变化时直接加载，无需访问网络"""
+        try:
+            mtime = os.stat(self.token_file).st_mtime
+        except OSError:
+            return False
+        if mtime == self._file_mtime:
+            return False
+        try:
+            state = self._read_file(appid, appsecret)
         except Exception as e:
             logger.warning(f"加载token文件失败: {str(e)}")
+            return False
+        self._file_mtime = mtime
+        if state and state[0] != self.access_token:
+            self._state = state
+            self.appid = appid
+            self.appsecret = appsecret
+            logger.info(f"已加载其他进程刷新的access_token，有效期至{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state[1]))}")
+            return True
+        return False
 
     def _save_to_file(self):
-        """保存token到文件"""
+        """保存token到文件（写入临时文件后原子替换，其他进程不会读到半写入的文件）"""
         try:
-            os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
-            with open(self.token_file, 'w') as f:
-                json.dump({
-                    "access_token": self.access_token,
-                    "expires_at": self.expires_at,
-                    "appid": self.appid,
-                    "appsecret": self.appsecret[:3] + "***"  # 安全记录
-                }, f, indent=2)
+            token_dir = os.path.dirname(self.token_file)
+            os.makedirs(token_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=token_dir, prefix='.access_token.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({
+                        "access_token": self.access_token,
+                        "expires_at": self.expires_at,
+                        "appid": self.appid,
+                        "appsecret": self.appsecret[:3] + "***"  # 安全记录
+                    }, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.token_file)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._file_mtime = os.stat(self.token_file).st_mtime
         except Exception as e:
             logger.error(f"保存token文件失败: {str(e)}")
 
+    @contextmanager
+    def _refresh_lock(self):
+        """进程内线程锁 + 跨进程文件锁，保证同一时刻只有一个进程刷新token"""
+        with self.lock:
+            if fcntl is None or not self.lock_file:
+                yield
+                return
+            try:
+                os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+                lock_fd = open(self.lock_file, 'a')
+            except OSError as e:
+                logger.warning(f"无法打开token锁文件，仅使用进程内锁: {str(e)}")
+                yield
+                return
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                lock_fd.close()
+
     def get_token(self, appid, appsecret):
-        """获取当前有效的access_token"""
-        if time.time() < self.expires_at - 300:  # 提前5分钟刷新
-            return self.access_token
+        """获取当前有效的access_token（热路径无锁）"""
+        now = time.time()
+        if now - self._last_file_check >= self.file_check_interval:
+            self._last_file_check = now
+            self._reload_if_changed(appid, appsecret)
+        token, expires_at = self._state
+        if now < expires_at - 300:  # 提前5分钟刷新
+            return token
         return self.refresh_token(appid, appsecret)
 
-    def refresh_token(self, appid, appsecret):
-        """主动刷新access_token"""
-        with self.lock:
-            url = "https://api.weixin.qq.com/cgi-bin/token"
-            params = {
-                "grant_type": "client_credential",
-                "appid": appid,
-                "secret": appsecret
-            }
-
-            for attempt in range(self.max_retries):
-                try:
-                    response = requests.get(url, params=params, timeout=5)
-                    data = response.json()
-
-                    if 'access_token' in data:
-                        self.access_token = data['access_token']
-                        self.expires_at = time.time() + data['expires_in']
-                        self.appid = appid
-                        self.appsecret = appsecret
-                        self._save_to_file()
-                        self.retry_count = 0
-                        logger.info(f"Access token刷新成功，有效期至{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.expires_at))}")
-                        return self.access_token
-
-                    # 错误处理逻辑
-                    errcode = data.get('errcode', -1)
-                    errmsg = data.get('errmsg', 'unknown error')
-                    self.last_error = f"{errcode}: {errmsg}"
-
-                    if errcode == -1:  # 系统繁忙
-                        wait = 2 ** attempt
-                        logger.warning(f"系统繁忙，{wait}秒后重试。错误信息: {errcode} {errmsg}")
-                        time.sleep(wait)
-                        continue
-
-                    if errcode == 40164:  # IP白名单错误
-                        logger.error(f"IP未在白名单中，请登录微信公众平台配置。错误信息: {errcode} {errmsg}")
-                        break
-
-                    if errcode == 89503:  # 需要管理员确认
-                        logger.critical(f"{errcode} 需要管理员在微信公众平台确认此IP的调用权限")
-                        break
-
-                    logger.error(f"获取access_token失败: {errcode} {errmsg}")
-                    break
-
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"网络请求异常: {str(e)}")
-                    self.last_error = str(e)
-                    time.sleep(1)
-
-            self.retry_count += 1
-            if self.retry_count >= self.max_retries:
-                logger.critical("连续获取access_token失败，停止重试")
-            return None
\ No newline at end of file
+    def refresh_token(self, appid, appsecret, stale_token=None):
+        """
+        主动刷新access_token
+
+        单飞刷新：等待锁期间若token已被其他线程/进程换成新的有效token，直接复用。
+        每次调用只请求一次，失败时不在调用线程中sleep重试：发送路径由调度器退避后重新执行，
+        后台刷新线程按retry_policy退避。
+
+        Args:
+            stale_token: 调用方认为已失效的token（例如收到40001），默认为当前token
+        """
+        if stale_token is None:
+            stale_token = self.access_token
+
+        with self._refresh_lock():
+            # 等锁期间其他线程/进程可能已完成刷新，直接复用
+            self._reload_if_changed(appid, appsecret)
+            if (self.access_token and self.access_token != stale_token
+                    and time.time() < self.expires_at - 300):
+                return self.access_token
+
+            token = self._request_token(appid, appsecret)
+        if token:
+            self.retry_count = 0
+            return token
+
+        self.retry_count += 1
+        if self.retry_count >= self.max_retries:
+            logger.critical(f"连续{self.retry_count}次获取access_token失败")
+        return None
+
+    def _request_token(self, appid, appsecret):
+        """
+        请求一次access_token
+
+        成功时返回token；失败时返回None，并通过last_error_retryable标记该错误是否值得重试
+        """
+        url = f"{self.api_base}/cgi-bin/token"
+        params = {
+            "grant_type": "client_credential",
+            "appid": appid,
+            "secret": appsecret
+        }
+
+        start = time.perf_counter()
+        try:
+            try:
+                response = http_client.get(url, params=params, timeout=5)
+                data = response.json()
+            except Exception:
+                token_refresh_seconds.observe(time.perf_counter() - start, 'exception')
+                raise
+            token_refresh_seconds.observe(time.perf_counter() - start, 'ok' if 'access_token' in data else 'error')
+
+            if 'access_token' in data:
+                self._state = (data['access_token'], time.time() + data['expires_in'])
+                self.appid = appid
+                self.appsecret = appsecret
+                self.last_error_retryable = True
+                self._save_to_file()
+                logger.info(f"Access token刷新成功，有效期至{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.expires_at))}")
+                return self.access_token
+
+            # 错误处理逻辑
+            errcode = data.get('errcode', -1)
+            errmsg = data.get('errmsg', 'unknown error')
+            self.last_error = f"{errcode}: {errmsg}"
+            self.last_error_retryable = errcode == -1
+
+            if errcode == -1:  # 系统繁忙
+                logger.warning(f"系统繁忙，稍后重试。错误信息: {errcode} {errmsg}")
+            elif errcode == 40164:  # IP白名单错误
+                logger.error(f"IP未在白名单中，请登录微信公众平台配置。错误信息: {errcode} {errmsg}")
+            elif errcode == 89503:  # 需要管理员确认
+                logger.critical(f"{errcode} 需要管理员在微信公众平台确认此IP的调用权限")
+            else:
+                logger.error(f"获取access_token失败: {errcode} {errmsg}")
+            return None
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"网络请求异常: {str(e)}")
+            self.last_error = str(e)
+            self.last_error_retryable = True
+            return None
+
+    def start_background_refresh(self, appid, appsecret, margin: float = 600, jitter: float = 120):
+        """
+        启动后台刷新
+
+        在token过期前margin秒（再随机提前0~jitter秒，避免多进程同时刷新）主动刷新，
+        请求路径上的get_token因此不会因刷新而阻塞。刷新时间由集中定时器调度，
+        所有公众号共用同一个刷新线程池，不再各自常驻一个线程。
+        """
+        if self._refresh_args is not None:
+            return
+        self._refresh_args = (appid, appsecret, margin, jitter)
+        self._schedule_refresh()
+        logger.info(f"access_token后台刷新已启动: {appid}（提前{margin}秒，抖动{jitter}秒）")
+
+    def _schedule_refresh(self):
+        _, _, margin, jitter = self._refresh_args
+        if self.access_token and self._refresh_failures == 0:
+            delay = self.expires_at - margin - random.uniform(0, jitter) - time.time()
+        else:
+            delay = self.retry_policy.backoff(self._refresh_failures - 1) if self._refresh_failures else 0
+        deadline_timer.schedule(max(delay, 0), _submit_refresh, self._background_refresh)
+
+    def _background_refresh(self):
+        appid, appsecret, margin, _ = self._refresh_args
+        # 其他进程（最先到期的那个）已刷新并写入文件时，加载新token后按新的有效期重新调度，不访问网络
+        self._reload_if_changed(appid, appsecret)
+        if self.access_token and time.time() < self.expires_at - margin:
+            self._refresh_failures = 0
+            self._schedule_refresh()
+            return
+        try:
+            # 等锁期间其他进程完成刷新时refresh_token直接复用文件中的新token
+            ok = self.refresh_token(appid, appsecret)
+        except Exception as e:
+            logger.error(f"后台刷新access_token失败: {str(e)}")
+            ok = False
+        self._refresh_failures = 0 if ok else self._refresh_failures + 1
+        self._schedule_refresh()
+
+    def invalidate(self, appid, appsecret, bad_token):
+        """
+        token被微信判定无效（40001/40014/42001）时立即单飞刷新
+
+        多个发送线程同时发现同一个无效token时，只有一个线程访问网络，其余线程复用其结果。
+        """
+        logger.warning("access_token已失效，立即刷新")
+        return self.refresh_token(appid, appsecret, stale_token=bad_token)
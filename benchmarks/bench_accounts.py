@@ -0,0 +1,96 @@
+"""
+多公众号资源占用基准
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_accounts [--accounts 1,12,50]
+
+对每个公众号数量，在独立子进程中以ACCOUNTS_FILE启动应用（微信API由本地替身服务代替），
+发送每个公众号一条消息后统计线程数与常驻内存（RSS），
+并与“每个公众号一个进程”（单公众号进程的占用 × 公众号数量）对比。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.stubs import StubBackendServer, StubWeChatServer
+
+AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+
+
+def _rss_kb() -> int:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(count: int):
+    """子进程：启动应用并向每个公众号发送一条明文消息"""
+    import hashlib
+    from app import create_app
+
+    app = create_app()
+    client = app.test_client()
+    for i in range(count):
+        token, timestamp, nonce = f"token{i}", str(int(time.time())), 'bench'
+        signature = hashlib.sha1(''.join(sorted([token, timestamp, nonce])).encode()).hexdigest()
+        xml = (f"<xml><ToUserName><![CDATA[gh_{i}]]></ToUserName><FromUserName><![CDATA[user{i}]]></FromUserName>"
+               f"<CreateTime>{timestamp}</CreateTime><MsgType><![CDATA[text]]></MsgType>"
+               f"<Content><![CDATA[hello]]></Content><MsgId>{i + 1}</MsgId></xml>")
+        client.post(f"/wechat/wxbench{i:010d}", data=xml.encode(),
+                    query_string={'signature': signature, 'timestamp': timestamp, 'nonce': nonce})
+    time.sleep(1.0)  # 等待客服消息发送完成，线程池达到稳态
+    print(json.dumps({'threads': threading.active_count(), 'rss_kb': _rss_kb()}))
+
+
+def measure(count: int, wechat: StubWeChatServer, backend: StubBackendServer, workdir: str) -> dict:
+    accounts_file = os.path.join(workdir, f"accounts_{count}.json")
+    with open(accounts_file, 'w') as f:
+        json.dump([{'appid': f"wxbench{i:010d}", 'appsecret': f"secret{i}", 'token': f"token{i}",
+                    'aes_key': AES_KEY} for i in range(count)], f)
+    env = dict(os.environ,
+               ACCOUNTS_FILE=accounts_file,
+               WECHAT_API_BASE=wechat.base_url,
+               EXTERNAL_SERVICE_URL=f"{backend.base_url}/api",
+               TOKEN_FILE_PATH=os.path.join(workdir, f"tokens_{count}", 'access_token.json'),
+               LOG_DIR=os.path.join(workdir, 'logs'),
+               LOG_LEVEL='WARNING')
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_accounts', '--child', str(count)],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-account resource benchmark')
+    parser.add_argument('--accounts', default='1,12,50', help='逗号分隔的公众号数量')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        return child(args.child)
+
+    wechat = StubWeChatServer().start()
+    backend = StubBackendServer('default').start()
+    counts = [int(c) for c in args.accounts.split(',')]
+    with tempfile.TemporaryDirectory() as workdir:
+        single = measure(1, wechat, backend, workdir)
+        print(f"{'accounts':>8} {'threads':>8} {'rss_mb':>8} {'1-proc-per-account threads':>28} {'rss_mb':>8}")
+        for count in counts:
+            result = single if count == 1 else measure(count, wechat, backend, workdir)
+            print(f"{count:>8} {result['threads']:>8} {result['rss_kb'] / 1024:>8.1f} "
+                  f"{single['threads'] * count:>28} {single['rss_kb'] * count / 1024:>8.1f}")
+    wechat.stop()
+    backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+WeChatCrypto 加解密微基准
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_crypto [--iterations 20000]
+
+对 256B~4KB 的典型消息分别测量加密、解密的吞吐（条/秒）与单条消息的内存分配峰值，
+并与优化前的实现（legacy）对比。
+"""
+import argparse
+import base64
+import hashlib
+import random
+import string
+import time
+import tracemalloc
+
+from Crypto.Cipher import AES
+
+from app.wechat.crypto import WeChatCrypto
+
+TOKEN = 'bench_token'
+AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+APPID = 'wx1234567890abcdef'
+SIZES = (256, 1024, 4096)  # 最短的文本消息XML约250字节
+
+
+class LegacyCrypto:
+    """优化前的加解密实现（仅用于对比，不含日志）"""
+
+    def __init__(self, token, encoding_aes_key, app_id):
+        self.token = token
+        self.app_id = app_id
+        self.aes_key = base64.b64decode(encoding_aes_key + "=")
+        self.iv = self.aes_key[:16]
+
+    def decrypt_message(self, encrypted_msg, signature, timestamp, nonce):
+        if hashlib.sha1(''.join(sorted([self.token, timestamp, nonce])).encode()).hexdigest() != signature:
+            raise ValueError("Invalid message signature")
+        encrypted_msg = encrypted_msg.replace('<![CDATA[', '').replace(']]>', '')
+        pad_length = len(encrypted_msg) % 4
+        if pad_length:
+            encrypted_msg += '=' * (4 - pad_length)
+        cipher = AES.new(self.aes_key, AES.MODE_CBC, self.iv)
+        decrypted = cipher.decrypt(base64.b64decode(encrypted_msg))
+        pad = decrypted[-1]
+        content = decrypted[:-pad]
+        msg_len = int.from_bytes(content[16:20], byteorder='big')
+        return content[20:20 + msg_len].decode('utf-8')
+
+    def encrypt_message(self, reply_msg):
+        random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        msg_len = len(reply_msg.encode())
+        text = random_str.encode() + msg_len.to_bytes(4, byteorder='big') + reply_msg.encode() + self.app_id.encode()
+        amount_to_pad = 32 - (len(text) % 32)
+        padded_text = text + (chr(amount_to_pad) * amount_to_pad).encode()
+        cipher = AES.new(self.aes_key, AES.MODE_CBC, self.iv)
+        return base64.b64encode(cipher.encrypt(padded_text)).decode('utf-8')
+
+
+def make_payload(size: int) -> str:
+    """生成约size字节（UTF-8）的明文XML消息，中英文混合"""
+    head = ('<xml><ToUserName><![CDATA[gh_1a2b3c]]></ToUserName>'
+            '<FromUserName><![CDATA[oAbCdEfGhIjKlMnOpQrStUvWxYz0]]></FromUserName>'
+            '<CreateTime>1700000000</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[')
+    tail = ']]></Content><MsgId>23456789</MsgId></xml>'
+    filler_len = max(size - len(head.encode()) - len(tail.encode()), 0)
+    filler = ('你好hello' * (filler_len // 11 + 1)).encode()[:filler_len].decode('utf-8', 'ignore')
+    return head + filler + tail
+
+
+def measure(fn, iterations: int):
+    """返回(条/秒, 单次调用的内存分配峰值字节数)"""
+    for _ in range(min(iterations, 200)):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    samples = []
+    for _ in range(50):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        samples.append(peak - base)
+    tracemalloc.stop()
+    samples.sort()
+    return iterations / elapsed, samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WeChatCrypto microbenchmark')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    crypto = WeChatCrypto(TOKEN, AES_KEY, APPID)
+    legacy = LegacyCrypto(TOKEN, AES_KEY, APPID)
+    timestamp, nonce = '1700000000', 'nonce123'
+    signature = hashlib.sha1(''.join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+
+    print(f"{'size':>6} {'op':<8} {'impl':<7} {'msg/s':>12} {'alloc B/msg':>12}")
+    for size in SIZES:
+        payload = make_payload(size)
+        encrypted = crypto.encrypt_message(payload, nonce)
+        assert crypto.decrypt_message(encrypted, signature, timestamp, nonce) == payload
+        assert legacy.decrypt_message(encrypted, signature, timestamp, nonce) == payload
+
+        cases = [
+            ('encrypt', 'legacy', lambda: legacy.encrypt_message(payload)),
+            ('encrypt', 'fast', lambda: crypto.encrypt_message(payload, nonce)),
+            ('decrypt', 'legacy', lambda: legacy.decrypt_message(encrypted, signature, timestamp, nonce)),
+            ('decrypt', 'fast', lambda: crypto.decrypt_message(encrypted, signature, timestamp, nonce)),
+        ]
+        for op, impl, fn in cases:
+            rate, alloc = measure(fn, args.iterations)
+            print(f"{size:>6} {op:<8} {impl:<7} {rate:>12,.0f} {alloc:>12,}")
+
+
+if __name__ == '__main__':
+    main()
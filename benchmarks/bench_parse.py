@@ -0,0 +1,57 @@
+"""
+加密消息解析路径基准
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_parse [--iterations 20000]
+
+对比两条路径处理一条加密POST的耗时与内存分配：
+- legacy: ElementTree解析外层XML -> decrypt_message -> 全局替换CDATA -> ElementTree解析明文
+- envelope: parse_envelope解析外层XML -> decrypt_to_bytes -> parse_envelope解析明文
+"""
+import argparse
+import hashlib
+from xml.etree import ElementTree as ET
+
+from app.wechat.crypto import WeChatCrypto
+from app.wechat.envelope import parse_envelope
+from benchmarks.bench_crypto import AES_KEY, APPID, SIZES, TOKEN, make_payload, measure
+
+
+def legacy_parse(crypto, body, signature, timestamp, nonce):
+    encrypted_msg = ET.fromstring(body).find('Encrypt').text
+    xml_str = crypto.decrypt_message(encrypted_msg, signature, timestamp, nonce)
+    xml_str = xml_str.replace('<![CDATA[', '').replace(']]>', '')
+    root = ET.fromstring(xml_str)
+    return {child.tag: child.text for child in root}
+
+
+def envelope_parse(crypto, body, signature, timestamp, nonce):
+    encrypted_msg = parse_envelope(body).get('Encrypt')
+    return parse_envelope(crypto.decrypt_to_bytes(encrypted_msg, signature, timestamp, nonce))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WeChat envelope parsing benchmark')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    crypto = WeChatCrypto(TOKEN, AES_KEY, APPID)
+    timestamp, nonce = '1700000000', 'nonce123'
+    signature = hashlib.sha1(''.join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+
+    print(f"{'size':>6} {'impl':<9} {'msg/s':>12} {'alloc B/msg':>12}")
+    for size in SIZES:
+        encrypted = crypto.encrypt_message(make_payload(size), nonce)
+        body = (f'<xml><ToUserName><![CDATA[gh_123456789abc]]></ToUserName>'
+                f'<Encrypt><![CDATA[{encrypted}]]></Encrypt></xml>').encode()
+
+        expected = legacy_parse(crypto, body, signature, timestamp, nonce)
+        assert envelope_parse(crypto, body, signature, timestamp, nonce).to_dict() == expected
+
+        for impl, fn in (('legacy', legacy_parse), ('envelope', envelope_parse)):
+            rate, alloc = measure(lambda: fn(crypto, body, signature, timestamp, nonce), args.iterations)
+            print(f"{size:>6} {impl:<9} {rate:>12,.0f} {alloc:>12,}")
+
+
+if __name__ == '__main__':
+    main()
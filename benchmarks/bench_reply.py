@@ -0,0 +1,82 @@
+"""
+被动回复渲染基准
+
+用法（在项目根目录执行）:
+    python -m benchmarks.bench_reply [--iterations 20000]
+
+对比两条路径生成一条加密被动回复的耗时与内存分配：
+- legacy: 多行f-string渲染 -> strip -> encrypt_message拼接明文 -> f-string封装加密XML -> 编码为响应字节
+- template: 预编译字节模板渲染到预留头部的缓冲区 -> encrypt_buffer就地填充加密 -> 字节模板封装
+"""
+import argparse
+import random
+import string
+import time
+
+from app.wechat.crypto import WeChatCrypto
+from app.wechat.reply import render_encrypted_reply, render_reply
+from benchmarks.bench_crypto import AES_KEY, APPID, SIZES, TOKEN, LegacyCrypto, measure
+
+
+def legacy_build_reply(msg_type, content, from_user, to_user):
+    create_time = str(int(time.time()))
+    base_xml = f"""
+        <xml>
+            <ToUserName><![CDATA[{to_user}]]></ToUserName>
+            <FromUserName><![CDATA[{from_user}]]></FromUserName>
+            <CreateTime>{create_time}</CreateTime>
+            <MsgType><![CDATA[{msg_type}]]></MsgType>
+            <Content><![CDATA[{content}]]></Content>
+        </xml>
+        """
+    return base_xml.strip()
+
+
+def legacy_encrypted_reply(legacy, crypto, content):
+    reply_xml = legacy_build_reply('text', content, 'gh_123456789abc', 'oAbCdEfGhIjKlMnOpQrStUvWxYz0')
+    encrypted_reply = legacy.encrypt_message(reply_xml)
+    timestamp = str(int(time.time()))
+    new_nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    msg_signature = crypto.generate_signature(encrypted_reply, timestamp, new_nonce)
+    encrypted_xml = f"""
+                <xml>
+                    <Encrypt><![CDATA[{encrypted_reply}]]></Encrypt>
+                    <MsgSignature><![CDATA[{msg_signature}]]></MsgSignature>
+                    <TimeStamp>{timestamp}</TimeStamp>
+                    <Nonce><![CDATA[{new_nonce}]]></Nonce>
+                </xml>
+                """
+    return encrypted_xml.strip().encode()
+
+
+def template_encrypted_reply(crypto, content):
+    return render_encrypted_reply(crypto, 'text', 'gh_123456789abc', 'oAbCdEfGhIjKlMnOpQrStUvWxYz0',
+                                  content=content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Passive reply rendering benchmark')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    crypto = WeChatCrypto(TOKEN, AES_KEY, APPID)
+    legacy = LegacyCrypto(TOKEN, AES_KEY, APPID)
+
+    print(f"{'size':>6} {'mode':<9} {'impl':<9} {'msg/s':>12} {'alloc B/msg':>12}")
+    for size in SIZES:
+        content = ('你好hello' * (size // 11 + 1)).encode()[:size].decode('utf-8', 'ignore')
+        cases = [
+            ('plain', 'legacy', lambda: legacy_build_reply('text', content, 'gh_123456789abc',
+                                                           'oAbCdEfGhIjKlMnOpQrStUvWxYz0').encode()),
+            ('plain', 'template', lambda: render_reply('text', 'gh_123456789abc',
+                                                       'oAbCdEfGhIjKlMnOpQrStUvWxYz0', content=content)),
+            ('aes', 'legacy', lambda: legacy_encrypted_reply(legacy, crypto, content)),
+            ('aes', 'template', lambda: template_encrypted_reply(crypto, content)),
+        ]
+        for mode, impl, fn in cases:
+            rate, alloc = measure(fn, args.iterations)
+            print(f"{size:>6} {mode:<9} {impl:<9} {rate:>12,.0f} {alloc:>12,}")
+
+
+if __name__ == '__main__':
+    main()
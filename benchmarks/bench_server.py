@@ -0,0 +1,139 @@
+"""
+服务进程吞吐基准：run.py（Flask开发服务器）对比 gunicorn（gunicorn.conf.py）
+
+用法（在项目根目录执行，需先 cp app/config.example.py app/config.py）:
+    python -m benchmarks.bench_server [--duration 10] [--concurrency 64] [--workers 4] [--threads 32]
+
+两种方式分别在子进程中启动服务（微信API与外部服务由 benchmarks.stubs 中的本地替身代替），
+/readyz 就绪后以固定并发（闭环）发送签名的微信文本消息，统计每秒请求数与响应耗时 p50/p99。
+默认不启用被动回复，测量的是请求线程本身的处理能力（签名校验、解析、提交外部服务调用）。
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import requests
+
+from benchmarks.loadtest import AES_KEY, APPID, TOKEN, MessageFactory, percentile, wait_ready
+from benchmarks.stubs import Faults, StubBackendServer, StubWeChatServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(mode: str, port: int, env: Dict[str, str]) -> subprocess.Popen:
+    if mode == 'run.py':
+        command = [sys.executable, 'run.py']
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'run:app']
+    env = dict(env, SERVER_BIND=f"127.0.0.1:{port}")
+    # 独立进程组：gunicorn的worker子进程随master一起停止
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+def stop_server(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=60)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def drive(base_url: str, factory: MessageFactory, concurrency: int, duration: float) -> Dict:
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        local, failed = [], 0
+        while time.monotonic() < stop_at:
+            _, _, query, body = factory.make('text')
+            start = time.perf_counter()
+            try:
+                response = session.post(f"{base_url}/wechat", params=query, data=body, timeout=10)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'errors': errors[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run.py vs gunicorn throughput benchmark')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per server')
+    parser.add_argument('--concurrency', type=int, default=64, help='client threads')
+    parser.add_argument('--workers', type=int, default=4, help='SERVER_WORKERS for gunicorn')
+    parser.add_argument('--threads', type=int, default=32, help='SERVER_THREADS for gunicorn')
+    parser.add_argument('--backend-latency', type=float, default=0.2)
+    parser.add_argument('--modes', default='run.py,gunicorn', help='comma separated: run.py,gunicorn')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(ROOT, 'app', 'config.py')):
+        sys.exit('app/config.py not found: run `cp app/config.example.py app/config.py` first')
+
+    wechat = StubWeChatServer(Faults(latency=0.02)).start()
+    backend = StubBackendServer('default', Faults(latency=args.backend_latency)).start()
+    workdir = tempfile.mkdtemp(prefix='wxb-bench-server-')
+    env = dict(os.environ,
+               WECHAT_TOKEN=TOKEN,
+               WECHAT_AES_KEY=AES_KEY,
+               WECHAT_APPID=APPID,
+               WECHAT_APPSECRET='loadtest_secret',
+               WECHAT_API_BASE=wechat.base_url,
+               EXTERNAL_SERVICE_URL=f"{backend.base_url}/api",
+               EXTERNAL_SERVICE_MAX_PENDING='100000',
+               CUSTOM_MESSAGE_RATE='100000',
+               CUSTOM_MESSAGE_BURST='100000',
+               TOKEN_FILE_PATH=os.path.join(workdir, 'access_token.json'),
+               LOG_DIR=os.path.join(workdir, 'logs'),
+               LOG_LEVEL='WARNING',
+               SERVER_WORKERS=str(args.workers),
+               SERVER_THREADS=str(args.threads))
+
+    print(f"{'server':>10} {'req/s':>9} {'p50_ms':>8} {'p99_ms':>8} {'errors':>7}")
+    for port, mode in enumerate(args.modes.split(','), start=18700):
+        process = start_server(mode, port, env)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            wait_ready(base_url)
+            factory = MessageFactory(None, encrypted=False, users=1000, content_size=64)
+            result = drive(base_url, factory, args.concurrency, args.duration)
+        finally:
+            stop_server(process)
+        label = mode if mode == 'run.py' else f"gunicorn {args.workers}x{args.threads}"
+        print(f"{label:>10} {result['rps']:>9.1f} {result['p50'] * 1000:>8.1f} "
+              f"{result['p99'] * 1000:>8.1f} {result['errors']:>7}")
+    wechat.stop()
+    backend.stop()
+
+
+if __name__ == '__main__':
+    main()
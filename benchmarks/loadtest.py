@@ -0,0 +1,409 @@
+"""
+端到端压测（完全离线）
+
+用法（在项目根目录执行，需先 cp app/config.example.py app/config.py）:
+    python -m benchmarks.loadtest --rate 50 --duration 20
+    python -m benchmarks.loadtest --service-type openai --encrypted --backend-latency 2 --passive
+    python -m benchmarks.loadtest --find-max --rate 20 --duration 10
+
+在本进程内用 create_app() 启动服务，微信API与外部服务都由 benchmarks.stubs 中的本地替身代替；
+按指定速率（开环）和消息配比发送经过签名（可选加密）的微信POST，统计：
+- 被动回复耗时 p50/p99 以及在预算内直接返回结果的比例
+- 异步回复从发出请求到客服消息送达的耗时 p50/p99
+- 图片/语音消息（--mix image=...,voice=...）经媒体管道从替身的 /cgi-bin/media/get 下载后转发，按类型统计送达数
+- --find-max 时逐级提高速率，报告满足SLO的最大QPS
+"""
+import argparse
+import hashlib
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from benchmarks.stubs import Faults, StubBackendServer, StubWeChatServer
+
+TOKEN = 'loadtest_token'
+AES_KEY = 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG'
+APPID = 'wxloadtest0000000'
+ACCOUNT = 'gh_loadtest'
+PLACEHOLDER = 'AI处理中'
+_MARKER_RE = re.compile(r'bench-(\d+)')
+MESSAGE_KINDS = ('text', 'image', 'voice', 'event', 'retry')
+# 会收到外部服务回复的消息类型（event与retry不产生新的回复）
+REPLY_KINDS = ('text', 'image', 'voice')
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """text=0.9,event=0.05,retry=0.05 -> 归一化后的权重"""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGE_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown message kind: {kind}")
+        mix[kind] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError('message mix must have a positive weight')
+    return {kind: weight / total for kind, weight in mix.items()}
+
+
+class MessageFactory:
+    """生成带签名（可选加密）的微信推送"""
+
+    def __init__(self, crypto, encrypted: bool, users: int, content_size: int, pic_base: str = ''):
+        self.crypto = crypto
+        self.pic_base = pic_base
+        self.encrypted = encrypted
+        self.users = [f"oLoadTestUser{i:06d}" for i in range(users)]
+        self.content_size = content_size
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._recent: List[tuple] = []  # 用于模拟微信重试的历史消息
+
+    def _next_seq(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def _plain_xml(self, kind: str, seq: int, openid: str) -> str:
+        now = int(time.time())
+        if kind == 'event':
+            return (f"<xml><ToUserName><![CDATA[{ACCOUNT}]]></ToUserName>"
+                    f"<FromUserName><![CDATA[{openid}]]></FromUserName><CreateTime>{now}{seq}</CreateTime>"
+                    f"<MsgType><![CDATA[event]]></MsgType><Event><![CDATA[subscribe]]></Event></xml>")
+        header = (f"<xml><ToUserName><![CDATA[{ACCOUNT}]]></ToUserName>"
+                  f"<FromUserName><![CDATA[{openid}]]></FromUserName><CreateTime>{now}</CreateTime>")
+        if kind == 'image':
+            # MediaId带序号：替身服务生成的图片内容以MediaId开头，回显中可还原出序号
+            media_id = f"img-bench-{seq}"
+            return (f"{header}<MsgType><![CDATA[image]]></MsgType>"
+                    f"<PicUrl><![CDATA[{self.pic_base}/pic/{media_id}]]></PicUrl>"
+                    f"<MediaId><![CDATA[{media_id}]]></MediaId><MsgId>{seq}</MsgId></xml>")
+        if kind == 'voice':
+            return (f"{header}<MsgType><![CDATA[voice]]></MsgType>"
+                    f"<MediaId><![CDATA[voice-bench-{seq}]]></MediaId><Format><![CDATA[amr]]></Format>"
+                    f"<Recognition><![CDATA[bench-{seq} 语音消息]]></Recognition><MsgId>{seq}</MsgId></xml>")
+        content = f"bench-{seq} " + '压测消息' * max(0, (self.content_size - 12) // 12)
+        return (f"{header}<MsgType><![CDATA[text]]></MsgType><Content><![CDATA[{content}]]></Content>"
+                f"<MsgId>{seq}</MsgId></xml>")
+
+    def make(self, kind: str):
+        """返回(seq, kind, query, body)；retry为重发一条之前的消息"""
+        if kind == 'retry':
+            with self._lock:
+                if self._recent:
+                    seq, query, body = random.choice(self._recent)
+                    return seq, 'retry', query, body
+            kind = 'text'
+
+        seq = self._next_seq()
+        xml = self._plain_xml(kind, seq, random.choice(self.users))
+        timestamp, nonce = str(int(time.time())), f"n{seq}"
+        signature = hashlib.sha1(''.join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+        query = {'signature': signature, 'timestamp': timestamp, 'nonce': nonce}
+        if self.encrypted:
+            encrypted = self.crypto.encrypt_message(xml, nonce)
+            query.update(encrypt_type='aes', msg_signature=self.crypto.generate_signature(encrypted, timestamp, nonce))
+            body = (f"<xml><ToUserName><![CDATA[{ACCOUNT}]]></ToUserName>"
+                    f"<Encrypt><![CDATA[{encrypted}]]></Encrypt></xml>").encode()
+        else:
+            body = xml.encode()
+        if kind == 'text':
+            with self._lock:
+                self._recent.append((seq, query, body))
+                del self._recent[:-200]
+        return seq, kind, query, body
+
+
+class LoadRunner:
+    def __init__(self, base_url: str, factory: MessageFactory, crypto, wechat: StubWeChatServer,
+                 concurrency: int, mix: Dict[str, float]):
+        self.url = f"{base_url}/wechat"
+        self.factory = factory
+        self.crypto = crypto
+        self.wechat = wechat
+        self.mix = mix
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='loadtest')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _reply_text(self, body: bytes) -> str:
+        if not self.factory.encrypted or not body.startswith(b'<xml><Encrypt>'):
+            return body.decode('utf-8', 'replace')
+        from app.wechat.envelope import parse_envelope
+        envelope = parse_envelope(body)
+        timestamp, nonce = envelope['TimeStamp'], envelope['Nonce']
+        signature = hashlib.sha1(''.join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+        return self.crypto.decrypt_message(envelope['Encrypt'], signature, timestamp, nonce)
+
+    def _send(self, seq: int, kind: str, query: Dict, body: bytes, results: List[Dict]):
+        start = time.monotonic()
+        record = {'seq': seq, 'kind': kind, 'start': start, 'status': None, 'passive': False}
+        try:
+            response = self._session().post(self.url, params=query, data=body, timeout=30)
+            record['latency'] = time.monotonic() - start
+            record['status'] = response.status_code
+            if response.status_code == 200 and kind in REPLY_KINDS:
+                text = self._reply_text(response.content)
+                record['passive'] = 'echo:' in text and PLACEHOLDER not in text
+        except Exception as e:
+            record['latency'] = time.monotonic() - start
+            record['error'] = str(e)
+        with self._lock:
+            results.append(record)
+
+    def run_stage(self, rate: float, duration: float, drain: float) -> Dict:
+        """以rate条/秒开环发送duration秒，再等待drain秒收集客服消息"""
+        results: List[Dict] = []
+        kinds, weights = zip(*self.mix.items())
+        self.wechat.take_deliveries()
+        media_requests = self.wechat.media_requests
+        total = int(rate * duration)
+        begin = time.monotonic()
+        behind = 0
+        for i in range(total):
+            due = begin + i / rate
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+            elif now - due > 0.1:
+                behind += 1
+            seq, kind, query, body = self.factory.make(random.choices(kinds, weights)[0])
+            self.executor.submit(self._send, seq, kind, query, body, results)
+        send_elapsed = time.monotonic() - begin
+
+        # 等待在途请求完成与客服消息送达
+        deadline = time.monotonic() + drain
+        while time.monotonic() < deadline:
+            with self._lock:
+                done = len(results) >= total
+            if done and self._pending_deliveries(results) == 0:
+                break
+            time.sleep(0.1)
+        summary = self._summarize(rate, results, send_elapsed, behind, total)
+        summary['media_downloads'] = self.wechat.media_requests - media_requests
+        return summary
+
+    def _pending_deliveries(self, results: List[Dict]) -> int:
+        with self._lock:
+            expected = {r['seq'] for r in results
+                        if r['kind'] in REPLY_KINDS and r['status'] == 200 and not r['passive']}
+        with self.wechat.lock:
+            delivered = {int(m.group(1)) for _, _, content in self.wechat.deliveries
+                         for m in [_MARKER_RE.search(content)] if m}
+        return len(expected - delivered)
+
+    def _summarize(self, rate: float, results: List[Dict], send_elapsed: float, behind: int, total: int) -> Dict:
+        deliveries = {}
+        for delivered_at, _, content in self.wechat.take_deliveries():
+            match = _MARKER_RE.search(content)
+            if match:
+                deliveries.setdefault(int(match.group(1)), delivered_at)
+
+        latencies = [r['latency'] for r in results if r['status'] == 200]
+        errors = sum(1 for r in results if r['status'] != 200)
+        texts = [r for r in results if r['kind'] in REPLY_KINDS and r['status'] == 200]
+        passive = [r for r in texts if r['passive']]
+        async_records = [r for r in texts if not r['passive']]
+        e2e = [deliveries[r['seq']] - r['start'] for r in async_records if r['seq'] in deliveries]
+        by_kind = {}
+        for r in async_records:
+            expected, delivered = by_kind.get(r['kind'], (0, 0))
+            by_kind[r['kind']] = (expected + 1, delivered + (r['seq'] in deliveries))
+        return {
+            'rate': rate,
+            'sent': len(results),
+            'scheduled': total,
+            'achieved_qps': len(results) / send_elapsed if send_elapsed else 0.0,
+            'client_behind': behind,
+            'errors': errors,
+            'passive_p50': percentile(latencies, 50),
+            'passive_p99': percentile(latencies, 99),
+            'passive_hits': len(passive),
+            'texts': len(texts),
+            'async_expected': len(async_records),
+            'async_delivered': len(e2e),
+            'delivery_p50': percentile(e2e, 50),
+            'delivery_p99': percentile(e2e, 99),
+            'delivered_by_kind': by_kind,
+        }
+
+
+def _fmt(value: Optional[float]) -> str:
+    return '-' if value is None else f"{value * 1000:.0f}ms"
+
+
+def print_report(summary: Dict):
+    print(f"rate={summary['rate']:.1f}/s sent={summary['sent']}/{summary['scheduled']} "
+          f"achieved={summary['achieved_qps']:.1f}/s errors={summary['errors']} "
+          f"client_behind={summary['client_behind']}")
+    print(f"  passive reply  p50={_fmt(summary['passive_p50'])} p99={_fmt(summary['passive_p99'])} "
+          f"hits={summary['passive_hits']}/{summary['texts']}")
+    print(f"  cs delivery    p50={_fmt(summary['delivery_p50'])} p99={_fmt(summary['delivery_p99'])} "
+          f"delivered={summary['async_delivered']}/{summary['async_expected']}")
+    media_kinds = {kind: counts for kind, counts in summary['delivered_by_kind'].items() if kind != 'text'}
+    if media_kinds:
+        print(f"  media          downloads={summary['media_downloads']} " + ' '.join(
+            f"{kind}={delivered}/{expected}" for kind, (expected, delivered) in sorted(media_kinds.items())))
+
+
+def sustainable(summary: Dict, slo: float) -> bool:
+    """无错误、发送速率跟得上、被动回复p99在SLO内、异步回复全部送达"""
+    if summary['sent'] == 0:
+        return False
+    return (summary['errors'] / summary['sent'] < 0.01
+            and summary['client_behind'] / summary['sent'] < 0.05
+            and summary['achieved_qps'] >= 0.95 * summary['rate']
+            and (summary['passive_p99'] or 0) <= slo
+            and summary['async_delivered'] >= 0.99 * summary['async_expected'])
+
+
+def wait_ready(base_url: str, timeout: float = 30):
+    """等待/readyz返回200（access_token已获取、连接已预热），否则首个阶段的请求会因token未就绪而失败"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/readyz", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"服务未在{timeout}秒内就绪: {base_url}")
+
+
+def configure_environment(args, wechat: StubWeChatServer, backends: List[StubBackendServer], workdir: str):
+    """在导入app之前设置环境变量（Config在导入时读取）"""
+    os.environ.update({
+        'WECHAT_TOKEN': TOKEN,
+        'WECHAT_AES_KEY': AES_KEY,
+        'WECHAT_APPID': APPID,
+        'WECHAT_APPSECRET': 'loadtest_secret',
+        'WECHAT_API_BASE': wechat.base_url,
+        'EXTERNAL_SERVICE_URL': ','.join(f"{backend.base_url}/api" for backend in backends),
+        'EXTERNAL_SERVICE_HEDGE_DELAY': str(args.hedge_delay),
+        'EXTERNAL_SERVICE_TYPE': args.service_type,
+        'EXTERNAL_SERVICE_TIMEOUT': str(args.timeout),
+        'EXTERNAL_SERVICE_STREAM': 'true' if args.stream else 'false',
+        'PASSIVE_REPLY_ENABLED': 'true' if args.passive else 'false',
+        'CUSTOM_MESSAGE_RATE': str(args.send_rate),
+        'CUSTOM_MESSAGE_BURST': str(max(int(args.send_rate), 1)),
+        'TOKEN_FILE_PATH': os.path.join(workdir, 'access_token.json'),
+        'OUTBOX_PATH': os.path.join(workdir, 'outbox.db'),
+        'MEDIA_ENABLED': 'true' if {'image', 'voice'} & set(args.mix) else 'false',
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media'),
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end load test')
+    parser.add_argument('--rate', type=float, default=20, help='offered requests per second (start rate for --find-max)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per stage')
+    parser.add_argument('--drain', type=float, default=15, help='seconds to wait for async deliveries after each stage')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('text=0.9,event=0.05,retry=0.05'),
+                        help='message mix, e.g. text=0.8,image=0.05,voice=0.05,event=0.05,retry=0.05')
+    parser.add_argument('--users', type=int, default=200, help='number of distinct openids')
+    parser.add_argument('--content-size', type=int, default=64, help='approximate text message size in bytes')
+    parser.add_argument('--encrypted', action='store_true', help='send AES-encrypted messages (safe mode)')
+    parser.add_argument('--service-type', default='default', choices=('default', 'openai', 'ollama', 'custom'))
+    parser.add_argument('--stream', action='store_true', help='enable EXTERNAL_SERVICE_STREAM (openai/ollama)')
+    parser.add_argument('--passive', action='store_true', help='enable PASSIVE_REPLY_ENABLED')
+    parser.add_argument('--timeout', type=int, default=10, help='EXTERNAL_SERVICE_TIMEOUT')
+    parser.add_argument('--send-rate', type=float, default=1000, help='CUSTOM_MESSAGE_RATE')
+    parser.add_argument('--backend-latency', type=float, default=0.5)
+    parser.add_argument('--backend-jitter', type=float, default=0.2)
+    parser.add_argument('--backend-error-rate', type=float, default=0.0)
+    parser.add_argument('--backends', type=int, default=1, help='number of backend nodes')
+    parser.add_argument('--slow-backend-latency', type=float, default=None,
+                        help='latency of the first backend node (the others use --backend-latency)')
+    parser.add_argument('--hedge-delay', type=float, default=0.0, help='EXTERNAL_SERVICE_HEDGE_DELAY')
+    parser.add_argument('--wechat-latency', type=float, default=0.02)
+    parser.add_argument('--wechat-jitter', type=float, default=0.01)
+    parser.add_argument('--wechat-error-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=256, help='client threads')
+    parser.add_argument('--find-max', action='store_true', help='raise the rate stage by stage until the SLO breaks')
+    parser.add_argument('--step', type=float, default=1.5, help='rate multiplier between --find-max stages')
+    parser.add_argument('--max-rate', type=float, default=2000)
+    parser.add_argument('--slo', type=float, default=4.5, help='passive reply p99 limit in seconds (WeChat allows 5s)')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(os.path.dirname(__file__), '..', 'app', 'config.py')):
+        sys.exit('app/config.py not found: run `cp app/config.example.py app/config.py` first')
+
+    wechat = StubWeChatServer(Faults(args.wechat_latency, args.wechat_jitter, args.wechat_error_rate)).start()
+    backends = []
+    for i in range(max(args.backends, 1)):
+        latency = args.slow_backend_latency if i == 0 and args.slow_backend_latency is not None else args.backend_latency
+        backends.append(StubBackendServer(args.service_type,
+                                          Faults(latency, args.backend_jitter, args.backend_error_rate)).start())
+    workdir = tempfile.mkdtemp(prefix='wxb-loadtest-')
+    configure_environment(args, wechat, backends, workdir)
+
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # 不输出每个请求的访问日志
+    from app import create_app
+    from app.wechat.crypto import WeChatCrypto
+
+    app = create_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    wait_ready(base_url)
+
+    crypto = WeChatCrypto(TOKEN, AES_KEY, APPID)
+    factory = MessageFactory(crypto, args.encrypted, args.users, args.content_size, pic_base=wechat.base_url)
+    runner = LoadRunner(base_url, factory, crypto, wechat, args.concurrency, args.mix)
+    print(f"service_type={args.service_type} encrypted={args.encrypted} passive={args.passive} "
+          f"stream={args.stream} backend={args.backend_latency}s+{args.backend_jitter}s "
+          f"errors={args.backend_error_rate:.0%}/{args.wechat_error_rate:.0%} "
+          f"backends={len(backends)} slow={args.slow_backend_latency} hedge={args.hedge_delay}s")
+
+    try:
+        if not args.find_max:
+            print_report(runner.run_stage(args.rate, args.duration, args.drain))
+            return
+
+        rate, best = args.rate, None
+        while rate <= args.max_rate:
+            summary = runner.run_stage(rate, args.duration, args.drain)
+            print_report(summary)
+            if not sustainable(summary, args.slo):
+                break
+            best = rate
+            rate *= args.step
+        print(f"max sustainable QPS: {best:.1f}" if best else "max sustainable QPS: below the start rate")
+    finally:
+        # 积压的任务在替身服务关闭后会失败，不再输出这些日志
+        logging.getLogger('wx-backend').setLevel(logging.CRITICAL)
+        server.shutdown()
+        wechat.stop()
+        for backend in backends:
+            backend.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+压测用的本地替身服务（完全离线）
+
+- StubWeChatServer: 模拟 api.weixin.qq.com 的 /cgi-bin/token 与 /cgi-bin/message/custom/send，
+  记录每条客服消息的送达时间；/cgi-bin/media/get 与 /pic/<MediaId> 按MediaId返回确定内容的图片/语音
+- StubBackendServer: 模拟 default/openai/ollama/custom 外部服务，回显用户消息，
+  openai/ollama 在请求 stream=true 时分别以 SSE/NDJSON 流式返回
+
+两者都支持固定延迟 + 随机抖动与按比例注入错误。
+"""
+import base64
+import binascii
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class Faults:
+    """延迟与错误注入配置"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        wait = self.latency + (random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, handler, faults: Faults):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.faults = faults
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> '_StubServer':
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body) if body else {}
+
+    def _send_json(self, obj: Dict, status: int = 200):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_media_bytes(media_id: str, size: int) -> bytes:
+    """替身服务为MediaId生成的文件内容（确定性，可用于校验下载结果）"""
+    seed = media_id.encode('utf-8') + b'|'
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class _WeChatHandler(_JsonHandler):
+    server: 'StubWeChatServer'
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        if path == '/cgi-bin/media/get':
+            query = parse_qs(parsed.query)
+            if query.get('access_token', [''])[0] != self.server.access_token:
+                return self._send_json({'errcode': 40001, 'errmsg': 'invalid credential'})
+            return self._send_media(query.get('media_id', [''])[0])
+        if path.startswith('/pic/'):
+            return self._send_media(path[len('/pic/'):])
+        if path != '/cgi-bin/token':
+            return self._send_json({'errcode': 404, 'errmsg': 'not found'}, 404)
+        self.server.faults.delay()
+        with self.server.lock:
+            self.server.token_requests += 1
+        self._send_json({'access_token': self.server.access_token, 'expires_in': 7200})
+
+    def _send_media(self, media_id: str):
+        """MediaId以voice开头时返回AMR语音，以invalid开头时返回40007，其余返回JPEG图片"""
+        server = self.server
+        server.faults.delay()
+        with server.lock:
+            server.media_requests += 1
+        if not media_id or media_id.startswith('invalid'):
+            return self._send_json({'errcode': 40007, 'errmsg': 'invalid media_id'})
+        body = stub_media_bytes(media_id, server.media_size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/amr' if media_id.startswith('voice') else 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # 分块写出，模拟大文件的传输
+        for i in range(0, len(body), 64 * 1024):
+            self.wfile.write(body[i:i + 64 * 1024])
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path != '/cgi-bin/message/custom/send':
+            return self._send_json({'errcode': 404, 'errmsg': 'not found'}, 404)
+        payload = self._read_json()
+        self.server.faults.delay()
+        token = parse_qs(parsed.query).get('access_token', [''])[0]
+        if token != self.server.access_token:
+            return self._send_json({'errcode': 40001, 'errmsg': 'invalid credential'})
+        if self.server.faults.should_fail():
+            with self.server.lock:
+                self.server.send_errors += 1
+            return self._send_json({'errcode': -1, 'errmsg': 'system error'})
+        content = payload.get('text', {}).get('content', '')
+        with self.server.lock:
+            self.server.deliveries.append((time.monotonic(), payload.get('touser'), content))
+        self._send_json({'errcode': 0, 'errmsg': 'ok'})
+
+
+class StubWeChatServer(_StubServer):
+    """模拟微信API（access_token、客服消息与临时素材接口）"""
+
+    def __init__(self, faults: Optional[Faults] = None, access_token: str = 'STUB_ACCESS_TOKEN',
+                 media_size: int = 256 * 1024):
+        super().__init__(_WeChatHandler, faults or Faults())
+        self.access_token = access_token
+        self.media_size = media_size
+        self.token_requests = 0
+        self.media_requests = 0
+        self.send_errors = 0
+        self.deliveries: List[Tuple[float, str, str]] = []  # (送达时间, openid, 内容)
+
+    def take_deliveries(self) -> List[Tuple[float, str, str]]:
+        with self.lock:
+            deliveries, self.deliveries = self.deliveries, []
+        return deliveries
+
+
+def _inline_media_id(data: str) -> str:
+    """内联图片（base64或data URL）对应的MediaId：stub_media_bytes生成的内容以 "MediaId|" 开头"""
+    data = data.partition(',')[2] if data.startswith('data:') else data
+    try:
+        head = base64.b64decode(data[:128])
+    except (binascii.Error, ValueError):
+        return '?'
+    return head.partition(b'|')[0].decode('utf-8', 'replace')
+
+
+def _user_content(service_type: str, payload: Dict) -> str:
+    """从各服务类型的请求中取出用户本轮的消息；媒体以MediaId代替（压测按其中的序号统计送达）"""
+    if service_type == 'openai':
+        messages = payload.get('messages') or [{}]
+        content = messages[-1].get('content')
+        if isinstance(content, list):
+            return ' '.join(part['text'] if part.get('type') == 'text'
+                            else f"[image {_inline_media_id(part.get('image_url', {}).get('url', ''))}]"
+                            for part in content)
+        return str(content)
+    if service_type == 'ollama':
+        prompt = str(payload.get('prompt'))
+        images = ''.join(f" [image {_inline_media_id(image)}]" for image in payload.get('images') or ())
+        # 带历史时prompt最后两行为 "User: ..." 和 "Assistant:"
+        lines = prompt.splitlines()
+        if len(lines) >= 2 and lines[-1] == 'Assistant:' and lines[-2].startswith('User: '):
+            return lines[-2][len('User: '):] + images
+        return prompt + images
+    if service_type == 'custom':
+        text, media = payload.get('query'), (payload.get('metadata') or {}).get('media')
+    else:
+        text, media = payload.get('content'), payload.get('media')
+    if media:
+        return f"{text} [{media['content_type']} {media['media_id']} {media['size']}B]"
+    return str(text)
+
+
+class _BackendHandler(_JsonHandler):
+    server: 'StubBackendServer'
+
+    def do_POST(self):
+        payload = self._read_json()
+        server = self.server
+        server.faults.delay()
+        with server.lock:
+            server.requests += 1
+        if server.faults.should_fail():
+            return self._send_json({'error': 'injected failure'}, 500)
+
+        reply = f"echo:{_user_content(server.service_type, payload)}"
+        if payload.get('stream') and server.service_type in ('openai', 'ollama'):
+            return self._stream(reply)
+
+        if server.service_type == 'openai':
+            self._send_json({'choices': [{'message': {'role': 'assistant', 'content': reply}}]})
+        elif server.service_type == 'ollama':
+            self._send_json({'response': reply, 'done': True})
+        elif server.service_type == 'custom':
+            self._send_json({'msg_type': 'text', 'text': reply})
+        else:
+            self._send_json({'message_type': 'text', 'content': reply})
+
+    def _stream(self, reply: str):
+        openai = self.server.service_type == 'openai'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream' if openai else 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # 按句切分为若干块，模拟逐token输出
+        chunks = [reply[i:i + 8] for i in range(0, len(reply), 8)] + ['。']
+        for chunk in chunks:
+            if openai:
+                line = 'data: ' + json.dumps({'choices': [{'delta': {'content': chunk}}]}, ensure_ascii=False) + '\n\n'
+            else:
+                line = json.dumps({'response': chunk, 'done': False}, ensure_ascii=False) + '\n'
+            self.wfile.write(line.encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.server.chunk_interval)
+        self.wfile.write(b'data: [DONE]\n\n' if openai else b'{"response": "", "done": true}\n')
+        self.close_connection = True
+
+
+class StubBackendServer(_StubServer):
+    """模拟外部服务（default/openai/ollama/custom）"""
+
+    def __init__(self, service_type: str = 'default', faults: Optional[Faults] = None,
+                 chunk_interval: float = 0.01):
+        super().__init__(_BackendHandler, faults or Faults())
+        self.service_type = service_type
+        self.chunk_interval = chunk_interval
+        self.requests = 0
@@ -0,0 +1,48 @@
+"""
+生产环境启动配置
+
+    gunicorn -c gunicorn.conf.py run:app
+
+参数取自 app/config.py 中的 Config（SERVER_*），与应用使用同一份配置。
+master进程只读取配置、不导入app：每个worker在fork之后各自执行create_app()，
+线程池、客服消息调度器、定时器、日志线程、HTTP连接池与TokenManager都在worker进程内创建，
+不会继承fork前的线程与连接。
+"""
+import importlib.util
+import os
+import sys
+
+
+def _load_config():
+    """只加载配置模块本身（不触发app包的导入）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'config.py')
+    spec = importlib.util.spec_from_file_location('_wxb_server_config', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Config
+
+
+Config = _load_config()
+
+bind = Config.SERVER_BIND
+workers = Config.SERVER_WORKERS
+threads = Config.SERVER_THREADS
+worker_class = 'gthread'
+timeout = Config.SERVER_TIMEOUT
+graceful_timeout = Config.SERVER_GRACEFUL_TIMEOUT
+keepalive = Config.SERVER_KEEPALIVE
+# 必须在fork之后创建应用，见模块说明
+preload_app = False
+
+
+def on_starting(server):
+    if server.cfg.preload_app:
+        raise RuntimeError("不支持--preload：应用的后台线程与连接必须在worker进程中创建")
+
+
+def worker_exit(server, worker):
+    """worker退出前（已停止接收请求）等待进行中的回复发送完成"""
+    run = sys.modules.get('run')
+    app = getattr(run, 'app', None)
+    if app is not None:
+        app.drain(Config.SHUTDOWN_DRAIN_TIMEOUT)
@@ -3,4 +3,7 @@ from app import create_app
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=80, debug=True)
\ No newline at end of file
+    # 开发服务器（单进程）；生产环境使用 gunicorn -c gunicorn.conf.py run:app
+    # 关闭重载器：重载器会在子进程中再导入一次本模块，create_app()（后台线程、token刷新、出站队列重放）执行两次
+    host, _, port = app.config['SERVER_BIND'].rpartition(':')
+    app.run(host=host or '0.0.0.0', port=int(port), debug=True, use_reloader=False)